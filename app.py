@@ -4,69 +4,623 @@ Flask版 統合大学ポータルシステム v6.1 (NameError修正版)
  - ゲーム機能、ポイント送金機能など全機能搭載
 """
 import os
+import sys
 import json
 import hashlib
+import hmac
 import calendar
 import uuid
-from collections import defaultdict
-from datetime import datetime, timedelta, date
+import base64
+import sqlite3
+import threading
+import time
+import math
+import bisect
+import unicodedata
+import io
+import re
+import queue
+import atexit
+import asyncio
+from collections import defaultdict, Counter, deque, OrderedDict
+from datetime import datetime, timedelta, date, timezone
 from functools import wraps
+from contextlib import contextmanager
 try:
-    from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, jsonify
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows では複数プロセスモードのみ使えない
+try:
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgiInstance
+except ImportError:
+    WsgiToAsgiInstance = None  # ASGI サーバーで動かすときだけ必要 ('pip install asgiref')
+try:
+    from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, jsonify, g, Response
 except ImportError:
     raise ImportError("Flaskがインストールされていません。'pip install flask' を実行してください。")
 
 # ───────── グローバル設定 ─────────
-DATA_DIR = "."
+DATA_DIR = os.environ.get("PORTAL_DATA_DIR", ".")
 USER_FILE = os.path.join(DATA_DIR, "portal_users.json")
 POST_FILE = os.path.join(DATA_DIR, "portal_posts.json")
 RESV_FILE = os.path.join(DATA_DIR, "portal_reservations.json")
 ANNOUNCE_FILE = os.path.join(DATA_DIR, "portal_announcements.json")
 SCHEDULE_FILE = os.path.join(DATA_DIR, "portal_schedules.json")
+POST_INDEX_FILE = os.path.join(DATA_DIR, "portal_posts_index.json")
+TITLE_FILE = os.path.join(DATA_DIR, "portal_titles.json")
+LEDGER_FILE = os.path.join(DATA_DIR, "portal_ledger.json")
+DB_FILE = os.path.join(DATA_DIR, "portal.db")
+STORAGE_BACKEND = os.environ.get("PORTAL_STORAGE", "sqlite")  # "sqlite" (レコード単位upsert) / "journal" (追記ログ+スナップショット) / "json" (従来の全体書き換え)
+JOURNAL_FILE = os.path.join(DATA_DIR, "portal.journal")
+JOURNAL_COMPACT_RECORDS, JOURNAL_COMPACT_INTERVAL = 1000, 60  # 追記件数 / 秒数 のどちらかでスナップショットへ畳み込む
+# gunicorn -w N など複数プロセスで動かす場合は PORTAL_MULTIPROCESS=1 (sqlite必須)。変更履歴で他プロセスの更新を取り込む
+MULTIPROCESS = os.environ.get("PORTAL_MULTIPROCESS") == "1"
+CHANGE_LOG_KEEP = 100000  # 保持する変更履歴の件数。これより遅れたプロセスは全件を読み直す
+# PORTAL_ASYNC_WRITES=1 ならリクエストはディスクへの書き込みを待たずに返り、専用スレッドが溜まったバッチをまとめて書く。
+# 応答した後の書き込みはプロセスが落ちると失われうる (正常終了時は書き切ってから終わる)。PORTAL_MULTIPROCESS とは併用できない
+ASYNC_WRITES = os.environ.get("PORTAL_ASYNC_WRITES") == "1"
+STORE_WRITE_RETRY = (0.5, 30)  # 書き込みスレッドが失敗したバッチを再試行する間隔 (初回, 上限) 秒。失敗のたびに倍にする
 SECRET_KEY = "a-super-secure-key-for-the-game-version"
+TEMPLATE_CACHE_DIR = os.environ.get("PORTAL_TEMPLATE_CACHE", os.path.join(DATA_DIR, "template_cache"))  # コンパイル済みテンプレート (空にすると使わない)
+FRAGMENT_CACHE_SIZE = 1024  # 描画済みHTML片を覚えておく件数
+# ライブ更新 (Server-Sent Events): 購読者ごとに溜めるイベント数 (溢れたらページを読み直させる)、無通信時に送るコメントの間隔 (秒)、
+# 複数プロセス運用時に他プロセスの変更を取り込む間隔 (秒)
+EVENT_QUEUE_SIZE, EVENT_KEEPALIVE, EVENT_POLL_INTERVAL = 256, 15, 1.0
+# パスワードハッシュ: "scrypt" (コスト = log2 N) / "pbkdf2_sha256" (コスト = 反復回数)。bench.py hash で各コストのログイン性能を測れる
+PASSWORD_DEFAULT_COSTS = {"scrypt": 14, "pbkdf2_sha256": 600000}
+PASSWORD_HASHER = os.environ.get("PORTAL_PASSWORD_HASHER", "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2_sha256")
+PASSWORD_COST = int(os.environ.get("PORTAL_PASSWORD_COST", PASSWORD_DEFAULT_COSTS.get(PASSWORD_HASHER, 0)))
+# ログインのレート制限 (バケット容量, 毎秒の回復量)。学内 NAT では多くの学生が同じ IP になるので IP 単位は大きめにする
+LOGIN_RATE_PER_IP, LOGIN_RATE_PER_UID = (100, 20.0), (5, 1 / 12)
+RATE_LIMIT_MAX_KEYS = 100000  # これを超えたら満タンまで回復したバケットを捨てる
+AUTH_SESSION_TTL = 30  # login_required が利用停止などの確認を省略する秒数 (利用停止・違反の変更時はすぐ無効にする)
+AUTH_VERIFY_TTL = 300  # 成功したパスワード検証を覚えておく秒数 (ログインが殺到したときの再ログインでハッシュ計算を省く)
+AUTH_METRICS_WINDOW = 2048  # レイテンシの分位点を出すために結果ごとに残す直近の件数
+# PORTAL_METRICS=1 でルートごとの処理時間 (マネージャー / ストアへの書き込み / テンプレート描画) を計測し、/metrics に Prometheus 形式で出す。
+# /metrics は管理者か、PORTAL_METRICS_TOKEN を "Authorization: Bearer" で送ったクライアントだけが読める
+METRICS = os.environ.get("PORTAL_METRICS") == "1"
+METRICS_TOKEN = os.environ.get("PORTAL_METRICS_TOKEN", "")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # リクエスト時間のヒストグラムの境界 (秒)
+# SLOW_REQUEST_MS を超えたリクエストは、処理中に PROFILE_SAMPLE_INTERVAL 秒ごとに採ったスタックを PROFILE_DIR に
+# collapsed 形式 (flamegraph.pl / speedscope で読める) で書き出す。ファイルは新しいものから PROFILE_KEEP 個まで残す
+SLOW_REQUEST_MS = float(os.environ.get("PORTAL_SLOW_REQUEST_MS", 500))
+PROFILE_DIR = os.environ.get("PORTAL_PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+PROFILE_SAMPLE_INTERVAL, PROFILE_KEEP = 0.005, 50
 
 CAMPUSES = { "ariake": {"name": "有明キャンパス", "rooms": 30}, "musashino": {"name": "武蔵野キャンパス", "rooms": 30} }
 OPEN_TIME, CLOSE_TIME = 8, 22
 MAX_HOURS_PER_DAY = 4
 VIOLATION_LIMIT = 3
 POINT_ON_QUESTION, POINT_ON_ANSWER, POINT_ON_BEST_ANSWER = 1, 2, 10
+SEARCH_INDEX_VERSION, SEARCH_TITLE_WEIGHT = 1, 3
+QUESTION_STATUSES = {"unanswered": "未回答", "answered": "回答あり", "solved": "解決済み"}
+QUESTIONS_PER_PAGE, API_MAX_PAGE_SIZE = 20, 100
+UPCOMING_EVENTS = 3  # トップページに出す直近の予定の件数
+ANNOUNCEMENTS_SHOWN = 3  # トップページに出すお知らせの件数
+ANNOUNCEMENTS_MAX, ANNOUNCEMENT_RETENTION_DAYS = 200, 90  # お知らせの保存件数の上限と、公開終了後に残しておく日数
+ICS_IMPORT_MAX_EVENTS = 5000  # 1回の .ics 取り込みで受け付ける予定の上限 (繰り返しの展開後)
+SLOT_SEARCH_MAX_DAYS = 186  # 空き枠検索で一度に探す最大日数 (約1学期)
+RESERVATION_LOCK_STRIPES = 64
+POINT_LOCK_STRIPES = 64  # ポイント残高を守るロックの本数 (uid のハッシュで割り当てる)
 TITLES = { "駆け出し投稿者": {"type": "points", "value": 10, "desc": "累計10ポイント獲得"}, "知恵の共有者": {"type": "points", "value": 50, "desc": "累計50ポイント獲得"}, "コミュニティの賢者": {"type": "points", "value": 200, "desc": "累計200ポイント獲得"}, "質問者": {"type": "questions", "value": 5, "desc": "5回質問する"}, "回答者": {"type": "answers", "value": 10, "desc": "10回回答する"}, "ベストアンサーマスター": {"type": "best_answers", "value": 5, "desc": "ベストアンサーを5回獲得"}, "予約デビュー": {"type": "reservations", "value": 1, "desc": "初めて予約する"}, "計画の達人": {"type": "reservations", "value": 10, "desc": "10回予約する"}, "自習室の主": {"type": "reservations", "value": 50, "desc": "50回予約する"}, }
 SECRET_TITLES = { "自己解決者": "自分の質問に自分で回答し、BAに選ぶ", "深夜のフクロウ": "深夜2時～4時の間に投稿または予約する", "探求者": "存在しないページに3回アクセスしようとする", "朝活": "朝8時に予約を入れる", }
 SHOP_TITLES = { "富豪": {"price": 500, "desc": "500ptで交換できる称号"}, "大富豪": {"price": 1000, "desc": "1000ptで交換できる称号"}, "ポータルマスター": {"price": 2500, "desc": "このサイトを極めた者の証"}, }
+TITLE_COUNTERS = {"points": "ポイント", "questions": "質問数", "answers": "回答数", "best_answers": "ベストアンサー数", "reservations": "予約数"}  # 管理者が称号の条件に使えるカウンタ
+GAMES = {"tetris": "テトリス", "danmaku": "弾幕シューティング"}
+LEADERBOARDS = {"points": "ポイント", "best_answers": "ベストアンサー", "reservations": "予約数", **GAMES}
+LEADERBOARD_SIZE = 20
+ADMIN_PAGE_SIZE = 50  # 管理画面のユーザー一覧の1ページの件数
+ADMIN_SORTS = {"uid": "ユーザID", "points": "ポイント", "vio": "違反"}
+ADMIN_BULK_ACTIONS = {"ban": "利用停止", "unban": "利用停止を解除", "reset_vio": "違反リセット", "adjust_points": "ポイント調整"}
 PROFILE_THEMES = { "theme-default": {"name": "デフォルト", "price": 0}, "theme-night": {"name": "ナイトモード", "price": 100}, "theme-sakura": {"name": "桜", "price": 200}, "theme-ocean": {"name": "オーシャン", "price": 300}, }
 
+# ───────── 0. 永続化ストア (Storage) ─────────
+# 名前空間 → (JSONファイル, ファイル形式→{key: record}, {key: record}→ファイル形式)
+def _ann_from_file(d): return {a["id"]: a for a in d.get("announcements", [])}
+def _ann_to_file(recs): return {"announcements": list(recs.values())}
+def _sched_from_file(d):
+    recs = defaultdict(dict)
+    for uid, days in d.items():
+        for d_str, events in days.items(): recs[f"{uid}|{d_str[:7]}"][d_str] = events
+    return dict(recs)
+def _sched_to_file(recs):
+    users = defaultdict(dict)
+    for key, days in recs.items(): users[key.rsplit("|", 1)[0]].update(days)
+    return dict(users)
+STORE_NAMESPACES = {
+    "users": (USER_FILE, dict, dict), "posts": (POST_FILE, dict, dict), "reservations": (RESV_FILE, dict, dict),
+    "announcements": (ANNOUNCE_FILE, _ann_from_file, _ann_to_file), "schedules": (SCHEDULE_FILE, _sched_from_file, _sched_to_file),
+    "post_index": (POST_INDEX_FILE, dict, dict), "titles": (TITLE_FILE, dict, dict), "ledger": (LEDGER_FILE, dict, dict),
+}
+def read_json_file(ns, path=None):
+    path = path or STORE_NAMESPACES[ns][0]
+    if not os.path.exists(path): return {}
+    with open(path) as f: return STORE_NAMESPACES[ns][1](json.load(f))
+def write_json_file(ns, records, path=None):
+    path = path or STORE_NAMESPACES[ns][0]; tmp = path + ".tmp"
+    with open(tmp, "w") as f: json.dump(STORE_NAMESPACES[ns][2](records), f, indent=2); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)  # 一時ファイル + rename で、クラッシュしても新旧どちらかの完全なファイルが残る
+
+def _dumps(record): return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+class Store:
+    """全マネージャー共通の永続化インターフェース。レコード (ユーザー1人、質問1件、1日分の予約など) 単位で読み書きする。
+    begin()〜commit() の間の put/delete はスレッドごとにダーティとして溜め、commit() でまとめて1回だけ書き込む。"""
+    shared = False  # 他プロセスと共有しているか (MULTIPROCESS の sqlite のみ)
+    record_writes = True  # 1レコードの書き込みが名前空間の大きさによらないか (増え続ける台帳を置けるか)
+    def __init__(self): self._local = threading.local(); self._watchers = {}; self._queue = None; self.write_error = None; self._commit_lock = threading.RLock()
+    def load(self, ns): raise NotImplementedError
+    def _write_batch(self, items): raise NotImplementedError  # items: {(ns, key): record (削除は None)}
+    def put(self, ns, key, record):
+        dirty = getattr(self._local, "dirty", None)
+        if dirty is not None: dirty[(ns, key)] = record  # 参照を保持し、commit時点の最終状態を書く
+        else: self._submit({(ns, key): record})
+    def delete(self, ns, key): self.put(ns, key, None)
+    def begin(self):
+        depth = getattr(self._local, "depth", 0); self._local.depth = depth + 1
+        if not depth: self._local.dirty = {}
+    def commit(self):
+        if not getattr(self._local, "depth", 0): return
+        self._local.depth -= 1
+        if self._local.depth: return
+        dirty, self._local.dirty = self._local.dirty, None
+        if dirty: self._submit(dirty)
+    def _submit(self, items):
+        with self._commit_lock:
+            if self._queue is None: self._write_batch(items); return
+            # 書き込みを待つ間にマネージャーがレコードを書き換えても commit 時点の内容を書くよう、ここで複製しておく
+            self._queue.put({nk: None if rec is None else json.loads(_dumps(rec)) for nk, rec in items.items()})
+    def start_writer(self):
+        """以降の commit() はディスクを待たずに返り、書き込みは専用スレッドが行う (PORTAL_ASYNC_WRITES)。"""
+        if self._queue is not None: return
+        self._queue = queue.Queue(); threading.Thread(target=self._writer, args=(self._queue,), name="store-writer", daemon=True).start()
+        atexit.register(self.flush)
+    def stop_writer(self):
+        """書き込み待ちを書き切ってから同期書き込みに戻す (書き込みが止まっているときに呼ぶ)。"""
+        q, self._queue = self._queue, None
+        if q: q.put(None); q.join()
+    def flush(self):
+        """書き込み待ちのバッチがすべて書き終わるまで待つ。書き込みスレッドが失敗し続けている間は RuntimeError を投げる。"""
+        q = self._queue
+        if q is None: return
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                if self.write_error: raise RuntimeError(f"ストアへの書き込みに失敗しています (再試行中): {self.write_error}") from self.write_error
+                q.all_tasks_done.wait(0.1)
+    def _writer(self, q):
+        items, taken, stop, delay = {}, 0, False, STORE_WRITE_RETRY[0]
+        while True:
+            # 溜まっているバッチは1回の書き込みにまとめる (同じレコードは後のバッチの内容が勝つ)。再試行中は新しいバッチだけを待たずに足す
+            batches = [] if taken else [q.get()]
+            while not q.empty(): batches.append(q.get())
+            for batch in batches:
+                if batch is None: stop = True
+                else: items.update(batch)
+            taken += len(batches)
+            try:
+                if items: self._write_batch(items)
+            except Exception as e:
+                # 応答済みの書き込みなので捨てずに持ち続け、間隔を空けて再試行する (その間 flush() は失敗を知らせる)
+                self.write_error = e; print(f" * {len(items)}件のレコードの書き込みに失敗しました。{delay:g}秒後に再試行します: {e}", file=sys.stderr)
+                time.sleep(delay); delay = min(delay * 2, STORE_WRITE_RETRY[1]); continue
+            self.write_error, delay = None, STORE_WRITE_RETRY[0]
+            for _ in range(taken): q.task_done()
+            items, taken = {}, 0
+            if stop: return
+    @contextmanager
+    def batch(self):
+        self.begin()
+        try: yield self
+        finally: self.commit()
+    @contextmanager
+    def atomic(self):
+        """外側の begin()〜commit() に合流させず、中の put/delete だけで1回の書き込みにする。put はレコードへの参照を持つので、
+        中で書き換えたレコードを他スレッドの commit が先に書き出さないよう、書き込み終わるまで他の commit を待たせる。"""
+        with self._commit_lock:
+            saved = getattr(self._local, "depth", 0), getattr(self._local, "dirty", None); self._local.depth, self._local.dirty = 0, None
+            try:
+                with self.batch(): yield self
+            finally: self._local.depth, self._local.dirty = saved
+    def watch(self, ns, on_change, on_reset=None):
+        """他プロセスが ns を変更したときの通知先を登録する。on_change(key, record or None)、on_reset() は全件読み直しが必要なとき。"""
+        self._watchers[ns] = (on_change, on_reset)
+    def sync(self): pass  # 単一プロセスでは取り込むべき外部の変更はない
+    def acquire_exclusive(self): pass
+    def release_exclusive(self): pass
+    def close(self): self.stop_writer()
+    def iter_records(self, ns):
+        """ns の (key, record) を1件ずつ返す。台帳の照合のように全件を1回なめるだけの処理向け。"""
+        yield from self.load(ns).items()
+    def import_json(self, ns, path=None):
+        with self.batch():
+            for key, record in read_json_file(ns, path).items(): self.put(ns, key, record)
+    def export_json(self, ns, path=None): write_json_file(ns, self.load(ns), path)
+class JSONStore(Store):
+    """従来どおり portal_*.json を丸ごと書き換えるバックエンド。バッチ内で触れた名前空間ごとに1回だけ書き換える。"""
+    record_writes = False
+    def __init__(self):
+        super().__init__(); self._lock = threading.RLock(); self._records = {}
+    def load(self, ns):
+        with self._lock:
+            if ns not in self._records: self._records[ns] = read_json_file(ns)
+            return dict(self._records[ns])
+    def _write_batch(self, items):
+        with self._lock:
+            for ns, key in items:
+                self.load(ns)
+                if items[(ns, key)] is None: self._records[ns].pop(key, None)
+                else: self._records[ns][key] = items[(ns, key)]
+            for ns in {ns for ns, _ in items}: write_json_file(ns, self._records[ns])
+class SQLiteStore(Store):
+    """組み込みSQLiteにレコード単位でupsertするバックエンド。書き込み量は変更したレコードの大きさに比例する。"""
+    def __init__(self, path=DB_FILE, shared=MULTIPROCESS):
+        super().__init__(); self._lock = threading.RLock(); self.shared = shared; self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL"); self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (ns, key))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS imported (ns TEXT PRIMARY KEY)")
+        if shared:
+            # 変更履歴: 各プロセスはリクエストの最初に自分が見た seq 以降の他プロセスの変更を読み込み直す
+            self.db.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, ns TEXT NOT NULL, key TEXT NOT NULL, pid INTEGER NOT NULL)")
+            self._seen = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            self._process_lock, self._lock_file = threading.Lock(), open(path + ".lock", "a")
+            # 変更の取り込みは通知先の呼び出しまで含めて1スレッドずつ行う。取り込み中に別スレッドが sync() しても、
+            # 取り込みが済むまで待たされるので、古いメモリ上のレコードのまま処理を進めることはない
+            self._sync_lock = threading.Lock()
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try: yield self.db
+            except BaseException: self.db.execute("ROLLBACK"); raise
+            else: self.db.execute("COMMIT")
+    def _import_once(self, ns):
+        # 初回起動時は既存の portal_*.json を取り込む
+        if not self.db.execute("SELECT 1 FROM imported WHERE ns = ?", (ns,)).fetchone():
+            self.import_json(ns); self.db.execute("INSERT OR IGNORE INTO imported VALUES (?)", (ns,))  # 複数プロセスの同時初回起動では同じ内容を二重に取り込むだけ
+    def load(self, ns):
+        with self._lock:
+            self._import_once(ns)
+            return {k: json.loads(v) for k, v in self.db.execute("SELECT key, value FROM records WHERE ns = ?", (ns,))}
+    def iter_records(self, ns):
+        with self._lock: self._import_once(ns)
+        db = sqlite3.connect(self.path)  # 別接続の読み取りトランザクションなので、読んでいる間も書き込みを止めない
+        try:
+            for key, value in db.execute("SELECT key, value FROM records WHERE ns = ?", (ns,)): yield key, json.loads(value)
+        finally: db.close()
+    def _write_batch(self, items):
+        rows = [(ns, key, _dumps(rec)) for (ns, key), rec in items.items() if rec is not None]
+        gone = [(ns, key) for (ns, key), rec in items.items() if rec is None]
+        with self._transaction() as db:
+            if rows: db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", rows)
+            if gone: db.executemany("DELETE FROM records WHERE ns = ? AND key = ?", gone)
+            if self.shared:
+                db.executemany("INSERT INTO changes (ns, key, pid) VALUES (?, ?, ?)", [(ns, key, os.getpid()) for ns, key in items])
+                db.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (CHANGE_LOG_KEEP,))
+    def sync(self):
+        if not self.shared: return
+        with self._sync_lock:
+            with self._lock:
+                first = self.db.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+                rows = self.db.execute("SELECT seq, ns, key, pid FROM changes WHERE seq > ? ORDER BY seq", (self._seen,)).fetchall()
+                if not rows: return
+                lagged, self._seen = first > self._seen + 1, rows[-1][0]
+                changed = dict.fromkeys((ns, key) for _, ns, key, pid in rows if pid != os.getpid() and ns in self._watchers)
+                fresh = {(ns, key): self.db.execute("SELECT value FROM records WHERE ns = ? AND key = ?", (ns, key)).fetchone() for ns, key in changed}
+            if lagged:  # 履歴が切り詰められて差分が分からない
+                for on_change, on_reset in self._watchers.values():
+                    if on_reset: on_reset()
+                return
+            for (ns, key), row in fresh.items(): self._watchers[ns][0](key, json.loads(row[0]) if row else None)
+    def acquire_exclusive(self):
+        """更新系リクエストの間、プロセス内 (スレッドロック) とプロセス間 (flock) の両方で書き込みを直列化する。"""
+        if not self.shared: return
+        self._process_lock.acquire(); fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+    def release_exclusive(self):
+        if not self.shared: return
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN); self._process_lock.release()
+class JournalStore(Store):
+    """portal_*.json をスナップショットとし、変更は portal.journal に1バッチ1行で追記するバックエンド。
+    バックグラウンドのコンパクタが追記ログをスナップショットへ畳み込み、起動時はスナップショット + ログ末尾を再生する。"""
+    record_writes = False  # 全レコードをメモリに持ち、コンパクションで名前空間ごと書き直す
+    def __init__(self, path=JOURNAL_FILE):
+        super().__init__(); self._lock = threading.RLock(); self._compact_lock = threading.Lock(); self._wake = threading.Event()
+        self.path, self._old_path, self._pid = path, path + ".old", os.getpid()
+        self._records = {}; self._dirty_ns = set(); self._pending = 0
+        # メモリ上の全レコードをスナップショットへ書き戻すので、同じログを2つのプロセスが開くと片方の書き込みが消える
+        self._lock_file = open(path + ".lock", "a")
+        if fcntl:
+            try: fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError: self._lock_file.close(); raise RuntimeError(f"{path} は別のプロセスが使用中です (PORTAL_STORAGE=journal は1プロセス専用です)") from None
+        self._replay(self._old_path); self._replay(self.path)
+        if os.path.exists(self._old_path):  # 前回のコンパクション中に落ちた: 再生した内容をここで書き切ってから古いログを消す
+            self._write_snapshots({ns: self._records[ns] for ns in self._dirty_ns}); os.remove(self._old_path)
+            with open(self.path, "w"): pass
+            self._dirty_ns.clear(); self._pending = 0
+        self._journal = open(self.path, "a", encoding="utf-8")
+        threading.Thread(target=self._compactor, name="journal-compactor", daemon=True).start()
+    def close(self):
+        """ログを閉じてロックを手放す (debug のリローダーの親プロセスが、実際に動く子プロセスへ譲るときに呼ぶ)。"""
+        super().close()
+        with self._lock: self._journal.close(); self._lock_file.close()
+    def _replay(self, path):
+        if not os.path.exists(path): return
+        valid_end = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"): break  # クラッシュで途中まで書かれた末尾行 (= 未完了のバッチ) は捨てる
+                try: entries = json.loads(line)
+                except ValueError: break
+                valid_end += len(line)
+                for e in entries if isinstance(entries, list) else [entries]:
+                    self._ns(e["ns"])[e["k"]] = None if e.get("d") else _dumps(e["v"])
+                    self._dirty_ns.add(e["ns"]); self._pending += 1
+        with open(path, "r+b") as f: f.truncate(valid_end)
+    def _ns(self, ns):
+        if ns not in self._records: self._records[ns] = {k: _dumps(v) for k, v in read_json_file(ns).items()}
+        return self._records[ns]
+    def load(self, ns):
+        with self._lock: return {k: json.loads(v) for k, v in self._ns(ns).items() if v is not None}
+    def iter_records(self, ns):
+        with self._lock: items = list(self._ns(ns).items())
+        for key, value in items:
+            if value is not None: yield key, json.loads(value)
+    def _write_batch(self, items):
+        values = {nk: None if rec is None else _dumps(rec) for nk, rec in items.items()}
+        line = "[" + ",".join(f'{{"ns":{_dumps(ns)},"k":{_dumps(key)},' + ('"d":1}' if v is None else f'"v":{v}}}')
+                              for (ns, key), v in values.items()) + "]\n"
+        # fork で複製されたストアはロックもメモリ上の内容も親と共有しているので書かせない (gunicorn --preload など)
+        if os.getpid() != self._pid: raise RuntimeError("PORTAL_STORAGE=journal のストアを fork 先のプロセスから書き込むことはできません")
+        with self._lock:
+            self._journal.write(line); self._journal.flush(); os.fsync(self._journal.fileno())
+            for (ns, key), v in values.items(): self._ns(ns)[key] = v; self._dirty_ns.add(ns)
+            self._pending += len(values)
+            if self._pending >= JOURNAL_COMPACT_RECORDS: self._wake.set()
+    def compact(self):
+        """変更のあった名前空間をスナップショットへ書き出し、追記ログを空にする。書き出している間も書き込みは止めない。"""
+        with self._compact_lock:
+            with self._lock:
+                if not self._dirty_ns or self._journal.closed: return
+                # 以降の追記は新しいログへ。書き出しが済む前に落ちても、起動時に古いログと新しいログの両方を再生する
+                self._journal.close(); os.replace(self.path, self._old_path); self._journal = open(self.path, "a", encoding="utf-8")
+                snapshots = {ns: dict(self._records[ns]) for ns in self._dirty_ns}; self._dirty_ns.clear(); self._pending = 0
+            self._write_snapshots(snapshots); os.remove(self._old_path)
+    @staticmethod
+    def _write_snapshots(snapshots):
+        for ns, values in snapshots.items(): write_json_file(ns, {k: json.loads(v) for k, v in values.items() if v is not None})
+    def _compactor(self):
+        while not self._journal.closed:
+            self._wake.wait(JOURNAL_COMPACT_INTERVAL); self._wake.clear()
+            if self._pending: self.compact()
+def open_store(backend=STORAGE_BACKEND):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    if MULTIPROCESS and backend != "sqlite": raise ValueError("PORTAL_MULTIPROCESS=1 には PORTAL_STORAGE=sqlite が必要です")
+    if MULTIPROCESS and fcntl is None: raise ValueError("PORTAL_MULTIPROCESS=1 はこのOSでは利用できません (fcntl がありません)")
+    # 書き込みの完了前にプロセス間の排他を解くことになるので、複数プロセスでは使えない
+    if MULTIPROCESS and ASYNC_WRITES: raise ValueError("PORTAL_ASYNC_WRITES=1 は PORTAL_MULTIPROCESS=1 と併用できません")
+    if backend == "sqlite": store = SQLiteStore()
+    elif backend == "journal": store = JournalStore()
+    elif backend == "json": store = JSONStore()
+    else: raise ValueError(f"不明なストレージバックエンドです: {backend}")
+    if ASYNC_WRITES: store.start_writer()
+    return store
+
 # ───────── 1. ユーザー管理 (UserManager) ─────────
+def _derive(pw, scheme, cost, salt):
+    if scheme == "scrypt": return hashlib.scrypt(pw.encode(), salt=salt, n=2 ** cost, r=8, p=1, maxmem=2048 * 2 ** cost)
+    if scheme == "pbkdf2_sha256": return hashlib.pbkdf2_hmac("sha256", pw.encode(), salt, cost)
+    raise ValueError(f"不明なパスワードハッシュ方式です: {scheme}")
+def hash_password(pw, scheme=None, cost=None):
+    """"方式$コスト$salt$ハッシュ" 形式の文字列を返す (省略時は PASSWORD_HASHER / PASSWORD_COST)。"""
+    scheme = scheme or PASSWORD_HASHER; cost = cost or PASSWORD_COST; salt = os.urandom(16)
+    return f"{scheme}${cost}${base64.b64encode(salt).decode()}${base64.b64encode(_derive(pw, scheme, cost, salt)).decode()}"
+def check_password(pw, stored):
+    """(一致したか, 現在の設定で作り直すべきか) を返す。"$" を含まないものは旧形式 (salt なし sha256 の16進)。"""
+    if "$" not in stored: return hmac.compare_digest(stored, hashlib.sha256(pw.encode()).hexdigest()), True
+    scheme, cost, salt, digest = stored.split("$")
+    ok = hmac.compare_digest(base64.b64decode(digest), _derive(pw, scheme, int(cost), base64.b64decode(salt)))
+    return ok, not password_is_current(stored)
+def password_is_current(stored): return stored.startswith(f"{PASSWORD_HASHER}${PASSWORD_COST}$")
+class Leaderboard:
+    """(-値, uid) を昇順に並べたリスト。上位N件はスライス、順位は二分探索で求める (値が0のユーザーは載せない)。"""
+    def __init__(self): self._lock, self._keys, self._values = threading.Lock(), [], {}
+    def rebuild(self, values):
+        with self._lock:
+            self._values = {uid: v for uid, v in values if v > 0}; self._keys = sorted((-v, uid) for uid, v in self._values.items())
+    def update(self, uid, value):
+        with self._lock:
+            old, value = self._values.get(uid), value or 0  # None (ユーザー削除) は 0 と同じく載せない
+            if old == value or (old is None and value <= 0): return
+            if old is not None: del self._keys[bisect.bisect_left(self._keys, (-old, uid))]; del self._values[uid]
+            if value > 0: self._values[uid] = value; bisect.insort(self._keys, (-value, uid))
+    def rank(self, uid):
+        """同点は同順位とする1始まりの順位 (載っていなければ None)。"""
+        with self._lock:
+            if uid not in self._values: return None
+            return bisect.bisect_left(self._keys, (-self._values[uid], "")) + 1
+    def top(self, n):
+        """[(順位, uid, 値), ...]"""
+        with self._lock: keys = self._keys[:n]
+        ranked, rank = [], 0
+        for i, (neg, uid) in enumerate(keys):
+            if not i or neg != keys[i - 1][0]: rank = i + 1
+            ranked.append((rank, uid, -neg))
+        return ranked
+    def __len__(self): return len(self._keys)
 class UserManager:
-    def __init__(self):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        if not os.path.exists(USER_FILE):
-            with open(USER_FILE, "w") as f: json.dump({}, f)
-        self._load()
+    def __init__(self, store):
+        self.store = store; self.titles = {}; self.on_change = []; self._versions, self._epoch, self.titles_version = Counter(), 0, 0
+        self._admin_lock = threading.Lock()
+        self._load(); self._load_titles()
+        store.watch("users", self._reload, self._load); store.watch("titles", self._reload_title, self._load_titles)
+        self._point_locks = [threading.Lock() for _ in range(POINT_LOCK_STRIPES)]
         if "admin" not in self.users: self.register("admin", "admin", role="admin")
+        # JSON / journal バックエンドでは台帳が portal_ledger.json 全体の書き換え (とメモリ) になり、履歴に比例して重くなるので記帳しない
+        self.ledger_enabled = store.record_writes
+        if self.ledger_enabled and next(store.iter_records("ledger"), None) is None: self._open_ledger()
+        self._backfill_titles()
     def _load(self):
-        with open(USER_FILE, 'r') as f: self.users = json.load(f)
-    def _save(self):
-        with open(USER_FILE, "w") as f: json.dump(self.users, f, indent=2)
+        self._epoch += 1; self.users = self.store.load("users"); self.boards = {board: Leaderboard() for board in LEADERBOARDS}
+        for board, lb in self.boards.items(): lb.rebuild((uid, self.board_value(user, board)) for uid, user in self.users.items())
+        # 管理画面の一覧用: 並べ替えの列ごとの (値, uid) の昇順リストと、状態ごとの uid の集合
+        with self._admin_lock:
+            self._admin_keys = {uid: self._admin_key(uid, user) for uid, user in self.users.items()}
+            self._admin_index = {field: sorted((keys[field], uid) for uid, keys in self._admin_keys.items()) for field in ADMIN_SORTS}
+            self._by_status = defaultdict(set)
+            for uid, user in self.users.items(): self._by_status[user.get("status", "active")].add(uid)
+    def _reload(self, uid, record):
+        if record is None: self.users.pop(uid, None)
+        else: self.users[uid] = record
+        self._changed(uid)
+    def _save(self, uid):
+        if uid in self.users: self.store.put("users", uid, self.users[uid])
+        else: self.store.delete("users", uid)
+        self._changed(uid)
     @staticmethod
-    def _hash(pw): return hashlib.sha256(pw.encode()).hexdigest()
+    def board_value(user, board): return user.get("best_scores", {}).get(board, 0) if board in GAMES else user.get(board, 0)
+    def version(self, uid):
+        """ユーザーごとの版数 (全件を読み直すと epoch が進むので戻らない)。ETag などに使う。"""
+        return self._epoch, self._versions[uid]
+    def _changed(self, uid):
+        # ユーザーを変えた操作は必ず _save (他プロセスの変更は _reload) を通るので、ここで版数を進めてランキングを差分更新し (値が変わらない板は何もしない)、
+        # on_change に登録された関数 (ログイン状態のキャッシュなど) に知らせる
+        self._versions[uid] += 1; user = self.users.get(uid)
+        for board, lb in self.boards.items(): lb.update(uid, self.board_value(user, board) if user else None)
+        self._index_admin(uid, user)
+        for callback in self.on_change: callback(uid, user)
+    def _load_titles(self):
+        # 組み込みの TITLES に管理者が追加した称号を重ねる (テンプレートからも参照するので同じ dict を更新する)
+        self.titles.clear(); self.titles.update(TITLES); self.titles.update(self.store.load("titles")); self._index_titles()
+    def _reload_title(self, name, cond):
+        if cond is None: self.titles.pop(name, None)
+        else: self.titles[name] = cond
+        self._index_titles()
+    def _index_titles(self):
+        """カウンタごとに (しきい値の昇順リスト, 称号リスト) を作り、カウンタが増えたときは越えたしきい値だけを二分探索で調べる。"""
+        self._thresholds = {}; self.titles_version += 1
+        for title, cond in sorted(self.titles.items(), key=lambda t: t[1]["value"]):
+            values, names = self._thresholds.setdefault(cond["type"], ([], [])); values.append(cond["value"]); names.append(title)
+        self._thresholds["404_count"] = ([3], ["探求者"])  # 隠し称号
+    def _backfill_titles(self):
+        """称号はカウンタがしきい値を越えたときにしか付与しないので、起動時に1回だけ、条件を満たしているのに持っていない称号を付与する
+        (しきい値判定より前のデータ、以前の送金で越えた分、後から増えた組み込みの称号など)。"""
+        with self.store.batch():
+            for uid, user in list(self.users.items()):
+                for counter, (values, names) in self._thresholds.items():
+                    for title in names[:bisect.bisect_right(values, user.get(counter, 0))]: self.award_title(uid, title, notify=False)
+    def _advance(self, uid, counter, old, new, notify=True):
+        values, names = self._thresholds.get(counter, ((), ()))
+        for title in names[bisect.bisect_right(values, old):bisect.bisect_right(values, new)]: self.award_title(uid, title, notify)
+    @staticmethod
+    def _admin_key(uid, user): return {"uid": uid, "points": user.get("points", 0), "vio": user.get("vio", 0), "status": user.get("status", "active")}
+    def _index_admin(self, uid, user):
+        keys = self._admin_key(uid, user) if user else {}
+        with self._admin_lock:
+            old = self._admin_keys.pop(uid, {})
+            for field, index in self._admin_index.items():
+                if old.get(field) == keys.get(field): continue
+                if field in old: del index[bisect.bisect_left(index, (old[field], uid))]
+                if field in keys: bisect.insort(index, (keys[field], uid))
+            if old.get("status") != keys.get("status"):
+                if old: self._by_status[old["status"]].discard(uid)
+                if keys: self._by_status[keys["status"]].add(uid)
+            if keys: self._admin_keys[uid] = keys
+    def status_counts(self):
+        with self._admin_lock: return {status: len(uids) for status, uids in self._by_status.items() if uids}
+    def admin_page(self, sort="uid", desc=False, status="", prefix="", points=(None, None), vio=(None, None), offset=0, limit=ADMIN_PAGE_SIZE):
+        """管理画面のユーザー一覧。並べ替えの列の索引を絞り込み範囲だけ二分探索で切り出して順になめ、残りの条件で絞りながら
+        offset 件目から limit 件を返す。(uid, ユーザー) のリストと続きがあるかを返す。"""
+        ranges = {"uid": (prefix or None, prefix + "\U0010ffff" if prefix else None),  # 値の範囲 [lo, hi)
+                  "points": (points[0], None if points[1] is None else points[1] + 1), "vio": (vio[0], None if vio[1] is None else vio[1] + 1)}
+        def matches(keys):
+            return (not status or keys["status"] == status) and all((lo is None or keys[f] >= lo) and (hi is None or keys[f] < hi) for f, (lo, hi) in ranges.items() if f != sort)
+        with self._admin_lock:
+            lo, hi = ranges[sort]; index = self._admin_index[sort]
+            members = self._by_status.get(status, ())  # 未知の状態で defaultdict に空の項目を作らない
+            if status and len(members) * 8 < len(index):  # 利用停止中のユーザーなど少数の状態はその集合だけを並べる
+                index = sorted((self._admin_keys[uid][sort], uid) for uid in members)
+            start = bisect.bisect_left(index, (lo,)) if lo is not None else 0
+            end = bisect.bisect_left(index, (hi,)) if hi is not None else len(index)
+            rows, skipped = [], 0
+            for i in (range(end - 1, start - 1, -1) if desc else range(start, end)):
+                uid = index[i][1]
+                if not matches(self._admin_keys[uid]): continue
+                if skipped < offset: skipped += 1; continue
+                rows.append(uid)
+                if len(rows) > limit: break
+        return [(uid, self.users[uid]) for uid in rows[:limit] if uid in self.users], len(rows) > limit
+    def bulk_action(self, uids, act, points=0):
+        """選んだユーザーにまとめて操作し、1回のバッチで書き込む。操作した人数を返す (管理者アカウントは対象外)。"""
+        targets = [uid for uid in dict.fromkeys(uids) if uid in self.users and uid != "admin"]
+        with self.store.batch():
+            for uid in targets:
+                user = self.users[uid]
+                if act == "ban": user["status"] = "banned"; self._save(uid)
+                elif act == "unban": user["status"] = "active"; self._save(uid)
+                elif act == "reset_vio": user["vio"] = 0; self._save(uid)
+                elif act == "adjust_points": self.add_points(uid, points, kind="admin", notify=False)
+        return len(targets)
     def get_user(self, uid): return self.users.get(uid)
     def get_all_users(self): return self.users.keys()
     def register(self, uid, pw, role="user"):
         if uid in self.users: return False
-        self.users[uid] = {"pw": self._hash(pw), "role": role, "status": "active", "points": 0, "titles": [],
+        self.users[uid] = {"pw": hash_password(pw), "role": role, "status": "active", "points": 0, "titles": [],
                            "questions": 0, "answers": 0, "best_answers": 0, "vio": 0, "reservations": 0, "404_count": 0,
                            "unlocked_themes": ["theme-default"], "current_theme": "theme-default"}
-        self._save(); return True
+        self._save(uid); return True
     def verify(self, uid, pw):
-        user = self.get_user(uid); return user and user["pw"] == self._hash(pw)
+        user = self.get_user(uid)
+        if not user: return False
+        ok, stale = check_password(pw, user["pw"])
+        if ok and stale: user["pw"] = hash_password(pw); self._save(uid)  # 旧形式や旧コストのハッシュはログイン成功時に作り直す
+        return ok
     def is_admin(self, uid):
         user = self.get_user(uid); return user and user.get("role") == "admin"
-    def add_points(self, uid, points):
-        if uid in self.users:
-            self.users[uid]["points"] += points; self._save(); self.check_and_award_titles(uid)
+    # ポイントの増減はすべて台帳 (ledger) への追記を伴い、users[uid]["points"] はその合計のキャッシュとして扱う
+    def _open_ledger(self):
+        """台帳を導入する前からある残高を期首残高として記帳する (キーが uid ごとに決まっているので、二重に記帳されることはない)。"""
+        with self.store.batch():
+            for uid, user in self.users.items():
+                if user.get("points"): self.store.put("ledger", f"opening|{uid}", {"ts": datetime.now().isoformat(), "kind": "opening", "from": None, "to": uid, "amount": user["points"]})
+    @contextmanager
+    def _balances(self, *uids):
+        # 複数人の残高を触るときはロックを添字順に取る (逆向きの送金が同時に来てもデッドロックしない)
+        locks = [self._point_locks[i] for i in sorted({hash(uid) % len(self._point_locks) for uid in uids})]
+        for lock in locks: lock.acquire()
+        try: yield
+        finally:
+            for lock in reversed(locks): lock.release()
+    def _post(self, kind, from_uid, to_uid, amount, memo=""):
+        """台帳に1件追記し、キャッシュしている残高と一緒にその場で書き込む。呼び出し側で _balances を取っておくこと。
+        リクエストのバッチに合流させると、同じユーザーを触った別リクエストの commit が新しい残高だけを先に書いてしまう。"""
+        entry = {"ts": datetime.now().isoformat(), "kind": kind, "from": from_uid, "to": to_uid, "amount": amount}
+        if memo: entry["memo"] = memo
+        with self.store.atomic():
+            if self.ledger_enabled: self.store.put("ledger", f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}", entry)
+            if from_uid: self.users[from_uid]["points"] -= amount; self._save(from_uid)
+            if to_uid: self.users[to_uid]["points"] += amount; self._save(to_uid)
+    def reconcile(self, fix=False):
+        """台帳を1回なめて残高を計算し直し、キャッシュと合わない [(uid, キャッシュ, 台帳)] を返す。fix なら台帳の値に揃える。
+        照合中に確定したポイント操作は一時的な不一致として出ることがあるので、利用の少ない時間に実行する。"""
+        if not self.ledger_enabled: return []  # 台帳がないので照合できない (fix で全員の残高を 0 にしない)
+        balances = Counter(); self.store.flush()  # 書き込み待ちの台帳エントリも照合に含める
+        for _, entry in self.store.iter_records("ledger"):
+            if entry["from"]: balances[entry["from"]] -= entry["amount"]
+            if entry["to"]: balances[entry["to"]] += entry["amount"]
+        mismatched = [(uid, user.get("points", 0), balances[uid]) for uid, user in list(self.users.items()) if user.get("points", 0) != balances[uid]]
+        if fix:
+            with self.store.batch():
+                for uid, cached, balance in mismatched:
+                    with self._balances(uid): self.users[uid]["points"] = balance; self._save(uid)
+                    self._advance(uid, "points", cached, balance, notify=False)
+        return mismatched
+    def add_points(self, uid, points, kind="earn", notify=True):
+        if uid in self.users and points:
+            with self._balances(uid): old = self.users[uid]["points"]; self._post(kind, None, uid, points)
+            self._advance(uid, "points", old, old + points, notify)
     def increment_counter(self, uid, counter_type):
         if uid in self.users and counter_type in self.users[uid]:
-            self.users[uid][counter_type] += 1; self._save(); self.check_and_award_titles(uid)
+            self.users[uid][counter_type] += 1; self._save(uid); self._advance(uid, counter_type, self.users[uid][counter_type] - 1, self.users[uid][counter_type])
     def adjust_violation(self, uid, amount):
         if uid in self.users:
             self.users[uid]["vio"] = max(0, self.users[uid]["vio"] + amount) 
@@ -75,170 +629,643 @@ class UserManager:
                 if self.users[uid]["vio"] >= VIOLATION_LIMIT:
                     self.users[uid]["status"] = "banned"; flash("違反回数が上限に達したためアカウントが利用停止になりました", "danger")
             else: flash(f"違反カウントが1減少しました (現在: {self.users[uid]['vio']})", "info")
-            self._save()
+            self._save(uid)
     def toggle_ban(self, uid):
         if uid in self.users and uid != 'admin':
-            self.users[uid]["status"] = "active" if self.users[uid]["status"] == "banned" else "banned"; self._save()
-    def award_title(self, uid, title):
+            self.users[uid]["status"] = "active" if self.users[uid]["status"] == "banned" else "banned"; self._save(uid)
+    def award_title(self, uid, title, notify=True):
         if uid in self.users and title not in self.users[uid].get("titles", []):
             if "titles" not in self.users[uid]: self.users[uid]["titles"] = []
-            self.users[uid]["titles"].append(title); flash(f"称号「{title}」を獲得しました！", "success"); self._save()
+            self.users[uid]["titles"].append(title); self._save(uid)
+            if notify: flash(f"称号「{title}」を獲得しました！", "success")
     def check_and_award_titles(self, uid, **kwargs):
-        user = self.get_user(uid)
-        if not user: return
-        for title, cond in TITLES.items():
-            if user.get(cond["type"], 0) >= cond["value"]: self.award_title(uid, title)
+        # カウンタ系の称号は add_points / increment_counter で付与済みなので、ここでは行動に応じた隠し称号だけを見る
+        if uid not in self.users: return
         if kwargs.get("self_answered"): self.award_title(uid, "自己解決者")
         if kwargs.get("night_activity"): self.award_title(uid, "深夜のフクロウ")
-        if user.get("404_count", 0) >= 3: self.award_title(uid, "探求者")
         if kwargs.get("early_bird"): self.award_title(uid, "朝活")
+    def add_title(self, name, counter, value, desc):
+        if not name or name in self.titles or name in SECRET_TITLES or name in SHOP_TITLES: return False, "その称号名は使えません。"
+        if counter not in TITLE_COUNTERS or value <= 0: return False, "条件が正しくありません。"
+        cond = {"type": counter, "value": value, "desc": desc or f"{TITLE_COUNTERS[counter]}が{value}以上"}
+        with self.store.batch():  # 既に条件を満たしているユーザーへの付与も同じ書き込みにまとめる
+            self.titles[name] = cond; self._index_titles(); self.store.put("titles", name, cond)
+            awarded = [uid for uid, user in self.users.items() if user.get(counter, 0) >= value]
+            for uid in awarded: self.award_title(uid, name, notify=False)
+        return True, f"称号「{name}」を追加しました ({len(awarded)}人に付与)。"
+    def delete_title(self, name):
+        if name in TITLES or name not in self.titles: return False
+        del self.titles[name]; self._index_titles(); self.store.delete("titles", name); return True
     def purchase_item(self, uid, item_id, item_type):
         user = self.get_user(uid)
         if not user: return False, "ユーザーが存在しません。"
         item_list = SHOP_TITLES if item_type == "title" else PROFILE_THEMES
         if item_id not in item_list: return False, "存在しないアイテムです。"
         item = item_list[item_id]
-        if user["points"] < item["price"]: return False, "ポイントが不足しています。"
-        if item_type == "title":
-            if item_id in user.get("titles", []): return False, "その称号は既に所有しています。"
-            user["points"] -= item["price"]; self.award_title(uid, item_id)
-        elif item_type == "theme":
-            if item_id in user.get("unlocked_themes", []): return False, "そのテーマは既に解放済みです。"
-            user["points"] -= item["price"]
-            if "unlocked_themes" not in user: user["unlocked_themes"] = []
-            user["unlocked_themes"].append(item_id)
-        self._save(); return True, f"「{item_id if item_type == 'title' else item['name']}」を解放しました！"
+        with self._balances(uid):
+            if user["points"] < item["price"]: return False, "ポイントが不足しています。"
+            if item_type == "title":
+                if item_id in user.get("titles", []): return False, "その称号は既に所有しています。"
+                self._post("purchase", uid, None, item["price"], item_id); self.award_title(uid, item_id)
+            elif item_type == "theme":
+                if item_id in user.get("unlocked_themes", []): return False, "そのテーマは既に解放済みです。"
+                self._post("purchase", uid, None, item["price"], item_id)
+                if "unlocked_themes" not in user: user["unlocked_themes"] = []
+                user["unlocked_themes"].append(item_id)
+            self._save(uid)
+        return True, f"「{item_id if item_type == 'title' else item['name']}」を解放しました！"
+    def submit_score(self, uid, game, score):
+        """ゲームの自己ベストを更新したら True。"""
+        user = self.get_user(uid)
+        if not user or game not in GAMES or score <= user.get("best_scores", {}).get(game, 0): return False
+        user.setdefault("best_scores", {})[game] = score; self._save(uid); return True
     def set_profile_theme(self, uid, theme_id):
         user = self.get_user(uid)
         if not user or theme_id not in user.get("unlocked_themes", []): return False
-        user["current_theme"] = theme_id; self._save(); return True
+        user["current_theme"] = theme_id; self._save(uid); return True
     def transfer_points(self, from_uid, to_uid, amount):
         sender = self.get_user(from_uid)
         receiver = self.get_user(to_uid)
         if not sender or not receiver: return False, "ユーザーが存在しません。"
         if from_uid == to_uid: return False, "自分自身にポイントを送ることはできません。"
         if amount <= 0: return False, "正のポイント数を入力してください。"
-        if sender["points"] < amount: return False, "所持ポイントが不足しています。"
-        sender["points"] -= amount; receiver["points"] += amount; self._save()
+        with self._balances(from_uid, to_uid):  # 残高の確認から記帳までを2人分のロックの中で行い、同時送金での取りこぼしを防ぐ
+            if sender["points"] < amount: return False, "所持ポイントが不足しています。"
+            old = receiver["points"]; self._post("transfer", from_uid, to_uid, amount)
+        self._advance(to_uid, "points", old, old + amount, notify=False)  # 受け取ったポイントでも称号の閾値を越えうる (flash は送り主に出るので出さない)
         return True, f"{to_uid}さんに{amount}ポイントを送りました。"
 
-# ───────── 2. マネージャークラス (変更なし) ─────────
+def percentile(sorted_values, p): return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))] if sorted_values else 0.0
+class RateLimiter:
+    """キーごとのトークンバケット。capacity 回までは続けて通し、その後は毎秒 rate 回分ずつ回復する。"""
+    def __init__(self, capacity, rate):
+        self.capacity, self.rate, self._buckets, self._lock, self._pruned = capacity, rate, {}, threading.Lock(), 0
+    def allow(self, key, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            self._buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+            if len(self._buckets) > RATE_LIMIT_MAX_KEYS and now - self._pruned > 1: self._prune(now)
+            return tokens >= 1
+    def _prune(self, now):
+        self._pruned = now; self._buckets = {k: (t, last) for k, (t, last) in self._buckets.items() if t + (now - last) * self.rate < self.capacity}
+class AuthPipeline:
+    """ログイン: レート制限 (IP, uid) → 検証済みキャッシュ → パスワード検証。login_required 用の確認済みセッションのキャッシュとレイテンシの計測も持つ。"""
+    OUTCOMES = ("ok", "fail", "limited", "banned")
+    def __init__(self, users):
+        self.users = users; users.on_change.append(self._user_changed)
+        self.ip_limiter, self.uid_limiter = RateLimiter(*LOGIN_RATE_PER_IP), RateLimiter(*LOGIN_RATE_PER_UID)
+        self._key = os.urandom(32)  # 検証済みキャッシュの鍵 (プロセスごとに作るので、再起動すればキャッシュはすべて無効になる)
+        self._lock, self._verified, self._sessions = threading.Lock(), {}, {}
+        self._latency, self._counts = {o: deque(maxlen=AUTH_METRICS_WINDOW) for o in self.OUTCOMES}, Counter()
+    def _token(self, uid, user, pw):
+        # 保存済みハッシュも鍵に含めるので、パスワードが変われば古い検証結果には当たらない
+        return hmac.new(self._key, f"{uid}\0{user['pw']}\0{pw}".encode(), "sha256").digest()
+    def login(self, uid, pw, ip):
+        """"ok" / "fail" / "limited" / "banned" のいずれかを返す。"""
+        t0 = time.perf_counter(); now = time.monotonic(); user = self.users.get_user(uid)
+        if not self.ip_limiter.allow(ip, now) or not self.uid_limiter.allow(uid, now): outcome = "limited"
+        elif not user: outcome = "fail"
+        else:
+            with self._lock: hit = self._verified.get(self._token(uid, user, pw), 0) > now
+            if hit or self.users.verify(uid, pw):
+                with self._lock:
+                    if len(self._verified) > RATE_LIMIT_MAX_KEYS: self._verified = {t: exp for t, exp in self._verified.items() if exp > now}
+                    self._verified[self._token(uid, user, pw)] = now + AUTH_VERIFY_TTL
+                outcome = "banned" if user["status"] == "banned" else "ok"
+            else: outcome = "fail"
+        with self._lock: self._latency[outcome].append(time.perf_counter() - t0); self._counts[outcome] += 1
+        return outcome
+    def session_ok(self, uid):
+        """login_required から呼ぶ。一度確認したユーザーは AUTH_SESSION_TTL の間ユーザー状態を見に行かない。"""
+        now = time.monotonic()
+        with self._lock:
+            if self._sessions.get(uid, 0) > now: return True
+        user = self.users.get_user(uid)
+        if not user or user["status"] == "banned": return False
+        with self._lock:
+            if len(self._sessions) > RATE_LIMIT_MAX_KEYS: self._sessions = {u: exp for u, exp in self._sessions.items() if exp > now}
+            self._sessions[uid] = now + AUTH_SESSION_TTL
+        return True
+    def _user_changed(self, uid, user):
+        if not user or user["status"] == "banned":
+            with self._lock: self._sessions.pop(uid, None)
+    def metrics(self):
+        """結果ごとの件数と、直近 AUTH_METRICS_WINDOW 件のレイテンシの分位点 (ミリ秒)。"""
+        with self._lock: samples, counts = {o: sorted(d) for o, d in self._latency.items()}, dict(self._counts)
+        return {o: {"count": counts.get(o, 0), **{f"p{p}_ms": round(percentile(s, p) * 1000, 2) for p in (50, 95, 99)}} for o, s in samples.items()}
+
+# ───────── 2. マネージャークラス ─────────
 class AnnouncementManager:
-    def __init__(self):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        if not os.path.exists(ANNOUNCE_FILE):
-            with open(ANNOUNCE_FILE, "w") as f: json.dump({"announcements": []}, f, indent=2)
-        with open(ANNOUNCE_FILE) as f: self.data = json.load(f)
-    def _save(self):
-        with open(ANNOUNCE_FILE, "w") as f: json.dump(self.data, f, indent=2)
-    def get_all(self): return sorted(self.data["announcements"], key=lambda x: x['timestamp'], reverse=True)
-    def add(self, title, content):
-        new_ann = {"id": str(uuid.uuid4()), "title": title, "content": content, "timestamp": datetime.now().isoformat()}
-        self.data["announcements"].append(new_ann); self._save()
+    # 公開日時 (publish_at、なければ投稿日時) の昇順リストを持ち、トップページ用の「いま公開中の上位K件」をキャッシュする。
+    # キャッシュは追加・削除と、次に公開開始・公開終了を迎える時刻で無効になる
+    def __init__(self, store):
+        self.store = store; self.version = 0; self._cache_lock = threading.Lock(); self._load(); store.watch("announcements", self._reload, self._load)
+    @staticmethod
+    def _key(ann): return (ann.get("publish_at") or ann["timestamp"], ann["id"])
+    def _load(self):
+        self.announcements = self.store.load("announcements"); self._order = sorted(self._key(a) for a in self.announcements.values()); self._changed()
+    def _reload(self, ann_id, record):
+        old = self.announcements.pop(ann_id, None)
+        if old: del self._order[bisect.bisect_left(self._order, self._key(old))]
+        if record is not None: self.announcements[ann_id] = record; bisect.insort(self._order, self._key(record))
+        self._changed()
+    def _changed(self):
+        with self._cache_lock: self.version += 1; self._top = None
+    def _save(self, ann_id):
+        if ann_id in self.announcements: self.store.put("announcements", ann_id, self.announcements[ann_id])
+        else: self.store.delete("announcements", ann_id)
+    @staticmethod
+    def state(ann, now):
+        """"scheduled" (公開前) / "live" / "expired" (公開終了)"""
+        if (ann.get("publish_at") or "") > now: return "scheduled"
+        return "expired" if ann.get("expires_at") and ann["expires_at"] <= now else "live"
+    def get_all(self): return [self.announcements[ann_id] for _, ann_id in reversed(self._order)]
+    def current(self, n=ANNOUNCEMENTS_SHOWN, now=None):
+        """いま公開中のお知らせを新しい順に n 件。公開開始・終了の時刻をまたいだら作り直し、version を進めて描画済みの断片も捨てさせる。"""
+        now = now or datetime.now().isoformat()
+        with self._cache_lock:
+            if self._top is None or self._top[0] != n or now >= self._top[2] or now < self._top[3]:
+                if self._top is not None: self.version += 1
+                top, valid_until, valid_from = [], "\uffff", ""
+                for _, ann_id in reversed(self._order):
+                    ann = self.announcements[ann_id]; st = self.state(ann, now)
+                    if st == "live" and len(top) < n: top.append(ann)
+                    # 結果が変わりうる次の時刻 (公開開始・公開終了) までキャッシュを使う
+                    valid_until = min([valid_until] + [t for t in (ann.get("publish_at"), ann.get("expires_at")) if t and t > now])
+                    valid_from = max([valid_from] + [t for t in (ann.get("publish_at"), ann.get("expires_at")) if t and t <= now])
+                self._top = (n, top, valid_until, valid_from)
+            return self._top[1]
+    def add(self, title, content, publish_at=None, expires_at=None):
+        now = datetime.now().isoformat()
+        new_ann = {"id": str(uuid.uuid4()), "title": title, "content": content, "timestamp": now}
+        if publish_at: new_ann["publish_at"] = publish_at
+        if expires_at: new_ann["expires_at"] = expires_at
+        self.announcements[new_ann["id"]] = new_ann; bisect.insort(self._order, self._key(new_ann)); self._changed(); self._save(new_ann["id"])
+        self.purge(now)
     def delete(self, ann_id):
-        self.data["announcements"] = [ann for ann in self.data["announcements"] if ann["id"] != ann_id]
-        self._save()
+        ann = self.announcements.pop(ann_id, None)
+        if ann: del self._order[bisect.bisect_left(self._order, self._key(ann))]
+        self._changed(); self._save(ann_id)
+    def purge(self, now=None):
+        """公開終了から ANNOUNCEMENT_RETENTION_DAYS 日を過ぎたものと、ANNOUNCEMENTS_MAX 件を超えた古いものを消す。消した件数を返す。"""
+        cutoff = (datetime.fromisoformat(now) if now else datetime.now()) - timedelta(days=ANNOUNCEMENT_RETENTION_DAYS)
+        stale = [ann_id for ann_id, ann in self.announcements.items() if ann.get("expires_at") and ann["expires_at"] <= cutoff.isoformat()]
+        with self.store.batch():
+            for ann_id in stale: self.delete(ann_id)
+            excess = [ann_id for _, ann_id in self._order[:max(len(self._order) - ANNOUNCEMENTS_MAX, 0)]]
+            for ann_id in excess: self.delete(ann_id)
+        return len(stale) + len(excess)
 class ScheduleManager:
-    def __init__(self):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        if not os.path.exists(SCHEDULE_FILE):
-            with open(SCHEDULE_FILE, "w") as f: json.dump({}, f, indent=2)
-        with open(SCHEDULE_FILE) as f: self.schedules = defaultdict(lambda: defaultdict(list), json.load(f))
-    def _save(self):
-        with open(SCHEDULE_FILE, "w") as f: json.dump(self.schedules, f, indent=2)
+    # 予定は (ユーザー, 年月) 単位のレコード "uid|YYYY-MM" で保存し、メモリ上ではユーザーごとに予定のある日付の昇順リストを持って二分探索する
+    def __init__(self, store):
+        self.store = store; self._versions, self._epoch = Counter(), 0; self._load(); store.watch("schedules", self._reload, self._load)
+    def _load(self):
+        self._epoch += 1; self.schedules, legacy = {}, []
+        for key, days in self.store.load("schedules").items():
+            if "|" not in key: legacy.append(key); key += "|"  # 旧形式 (ユーザー単位のレコード)
+            self.schedules.setdefault(key.rsplit("|", 1)[0], {}).update(days)
+        self._dates = {uid: sorted(days) for uid, days in self.schedules.items()}
+        if legacy:
+            with self.store.batch():
+                for uid in legacy:
+                    self.store.delete("schedules", uid)
+                    for d_str in self._dates.get(uid, []): self._save(uid, d_str)
+    def _reload(self, key, record):
+        uid, ym = key.rsplit("|", 1); days = self.schedules.setdefault(uid, {}); self._versions[(uid, ym)] += 1
+        for d_str in self._range(uid, ym + "-01", ym + "-31"): del days[d_str]
+        days.update(record or {}); self._dates[uid] = sorted(days)
+        if not days: del self.schedules[uid], self._dates[uid]
+    def version(self, uid, ym): return self._epoch, self._versions[(uid, ym)]
+    def _save(self, uid, d_str):
+        ym = d_str[:7]; days = self.schedules.get(uid, {}); self._versions[(uid, ym)] += 1
+        month = {d: days[d] for d in self._range(uid, ym + "-01", ym + "-31")}
+        if month: self.store.put("schedules", f"{uid}|{ym}", month)
+        else: self.store.delete("schedules", f"{uid}|{ym}")
+    def _range(self, uid, start, end):
+        """予定のある日付のうち start <= d_str <= end のもの (昇順)。"""
+        dates = self._dates.get(uid, [])
+        return dates[bisect.bisect_left(dates, start):bisect.bisect_right(dates, end)]
     def get_user_schedule_for_month(self, uid, year, month):
-        user_sched = self.schedules.get(uid, {})
-        month_sched = {}
-        for d_str, events in user_sched.items():
-            if d_str.startswith(f"{year:04d}-{month:02d}"):
-                day = int(d_str.split('-')[2]); month_sched[day] = True
-        return month_sched
+        ym = f"{year:04d}-{month:02d}"
+        return {int(d_str[8:]): True for d_str in self._range(uid, ym + "-01", ym + "-31")}
     def get_user_schedule_for_day(self, uid, d_str):
         return sorted(self.schedules.get(uid, {}).get(d_str, []), key=lambda x: x.get('time', '00:00'))
+    def get_user_schedule_range(self, uid, start, end):
+        """start〜end (YYYY-MM-DD、両端を含む) の予定を [(日付, 時刻順の予定リスト), ...] で返す。"""
+        return [(d_str, self.get_user_schedule_for_day(uid, d_str)) for d_str in self._range(uid, start, end)]
+    def get_user_schedule_for_week(self, uid, day):
+        start = day - timedelta(days=(day.weekday() + 1) % 7)  # カレンダー表示と同じ日曜始まり
+        return self.get_user_schedule_range(uid, start.isoformat(), (start + timedelta(days=6)).isoformat())
+    def upcoming(self, uid, n, now=None):
+        """現在時刻以降の予定を近い順に n 件 [(日付, 予定), ...] で返す。過去の予定は二分探索で読み飛ばす。"""
+        now = now or datetime.now(); today, hhmm = now.strftime("%Y-%m-%d"), now.strftime("%H:%M")
+        dates, events = self._dates.get(uid, []), []
+        for i in range(bisect.bisect_left(dates, today), len(dates)):
+            events += [(dates[i], e) for e in self.get_user_schedule_for_day(uid, dates[i]) if dates[i] > today or e.get("time", "00:00") >= hhmm]
+            if len(events) >= n: break
+        return events[:n]
     def add(self, uid, d_str, time, title):
         new_event = {"id": str(uuid.uuid4()), "time": time, "title": title}
-        if uid not in self.schedules or not isinstance(self.schedules[uid], dict):
-            self.schedules[uid] = {}
-        if d_str not in self.schedules[uid] or not isinstance(self.schedules[uid][d_str], list):
-            self.schedules[uid][d_str] = []
-        self.schedules[uid][d_str].append(new_event)
-        self._save()
+        days = self.schedules.setdefault(uid, {})
+        if d_str not in days: days[d_str] = []; bisect.insort(self._dates.setdefault(uid, []), d_str)
+        days[d_str].append(new_event)
+        self._save(uid, d_str)
+    def add_many(self, uid, events):
+        """(日付, 予定) の列をまとめて追加し、変更のあった月ごとに1回だけ保存する。同じ id の予定が既にあれば飛ばす (同じ .ics の再取り込み対策)。"""
+        days, months, added = self.schedules.setdefault(uid, {}), {}, 0
+        for d_str, event in events:
+            if d_str not in days: days[d_str] = []; bisect.insort(self._dates.setdefault(uid, []), d_str)
+            if any(e["id"] == event["id"] for e in days[d_str]): continue
+            days[d_str].append(event); months[d_str[:7]] = d_str; added += 1
+        if not days: del self.schedules[uid]
+        with self.store.batch():
+            for d_str in months.values(): self._save(uid, d_str)
+        return added
+    def iter_events(self, uid):
+        for d_str in list(self._dates.get(uid, [])):
+            for event in self.get_user_schedule_for_day(uid, d_str): yield d_str, event
 
     def delete(self, uid, d_str, event_id):
-        user_day_sched = self.schedules.get(uid, {}).get(d_str)
-        if user_day_sched:
-            self.schedules[uid][d_str] = [e for e in user_day_sched if e["id"] != event_id]
-            if not self.schedules[uid][d_str]: del self.schedules[uid][d_str]
-            if not self.schedules[uid]: del self.schedules[uid]
-            self._save()
+        days = self.schedules.get(uid, {})
+        if days.get(d_str):
+            days[d_str] = [e for e in days[d_str] if e["id"] != event_id]
+            if not days[d_str]: del days[d_str]; self._dates[uid].remove(d_str)
+            if not days: del self.schedules[uid], self._dates[uid]
+            self._save(uid, d_str)
+# ───────── iCalendar (.ics) の読み書き ─────────
+ICS_WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+def ics_unfold(lines):
+    """折り返された行 (次の行が空白で始まる) をつなぎ直し、(開始行番号, 論理行) を順に返す。"""
+    buf, start = None, 0
+    for no, raw in enumerate(lines, 1):
+        line = raw.rstrip("\r\n")
+        if buf is not None and line[:1] in (" ", "\t"): buf += line[1:]; continue
+        if buf: yield start, buf
+        buf, start = line, no
+    if buf: yield start, buf
+def _ics_text(value):
+    out, chars = [], iter(value)  # \\ \; \, \n のエスケープを1文字ずつ戻す
+    for ch in chars: out.append({"n": "\n", "N": "\n"}.get(nxt := next(chars, ""), nxt) if ch == "\\" else ch)
+    return "".join(out)
+def _ics_escape(text): return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+def _ics_datetime(value, params):
+    """DTSTART などの値を (date, "HH:MM") にする。UTC (末尾 Z) はローカル時刻に直し、TZID 付きはその時刻をそのまま使う。"""
+    if params.get("VALUE") == "DATE" or len(value) == 8: return datetime.strptime(value, "%Y%m%d").date(), "00:00"
+    dt = datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    if value.endswith("Z"): dt = dt.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    return dt.date(), dt.strftime("%H:%M")
+def _ics_occurrences(start, rrule, exdates):
+    """RRULE のうち時間割でよく使う DAILY / WEEKLY (INTERVAL, COUNT, UNTIL, BYDAY) だけを展開する。"""
+    if not rrule: yield start; return
+    rule = dict(part.split("=", 1) for part in rrule.upper().split(";") if "=" in part)
+    if rule.get("FREQ") not in ("DAILY", "WEEKLY") or set(rule) - {"FREQ", "INTERVAL", "COUNT", "UNTIL", "BYDAY", "WKST"} or (rule["FREQ"] == "DAILY" and "BYDAY" in rule):
+        raise ValueError(f"対応していない繰り返し規則です ({rrule})")
+    if "COUNT" not in rule and "UNTIL" not in rule: raise ValueError("終わりのない繰り返し予定は取り込めません")
+    interval, count = int(rule.get("INTERVAL", 1)), int(rule.get("COUNT", 0)) or None
+    if interval < 1: raise ValueError(f"INTERVAL は1以上にしてください ({rrule})")  # 0 だと同じ日を繰り返して終わらない
+    until = _ics_datetime(rule["UNTIL"], {})[0] if "UNTIL" in rule else None
+    if rule["FREQ"] == "DAILY": base, step, offsets = start, timedelta(days=interval), [0]
+    else: base, step, offsets = start - timedelta(days=start.weekday()), timedelta(weeks=interval), sorted(ICS_WEEKDAYS.index(wd[-2:]) for wd in rule.get("BYDAY", ICS_WEEKDAYS[start.weekday()]).split(","))
+    n = 0
+    while True:
+        for off in offsets:
+            d = base + timedelta(days=off)
+            if d < start: continue
+            if (count and n >= count) or (until and d > until): return
+            n += 1
+            if d not in exdates: yield d
+        base += step
+def parse_ics(lines):
+    """.ics を1行ずつ読みながら VEVENT を (日付文字列, 予定) に展開して返す。不正な予定があれば行番号付きの ValueError。"""
+    event, nested = None, 0
+    for no, line in ics_unfold(lines):
+        head, _, value = line.partition(":"); name, *params = head.split(";"); name = name.upper()
+        if name == "BEGIN":
+            if value.upper() == "VEVENT": event, begin = {"EXDATE": []}, no
+            elif event is not None: nested += 1  # VALARM など VEVENT の中の部品は読み飛ばす
+        elif name == "END":
+            if nested: nested -= 1
+            elif value.upper() == "VEVENT" and event is not None:
+                try: yield from _ics_event(event)
+                except (ValueError, KeyError) as e: raise ValueError(f"{begin}行目の予定: {e}") from None
+                event = None
+        elif event is not None and not nested:
+            params = dict(p.split("=", 1) for p in params if "=" in p)
+            if name == "EXDATE": event["EXDATE"] += [_ics_datetime(v, params)[0] for v in value.split(",")]
+            elif name in ("UID", "SUMMARY", "DTSTART", "RRULE"): event[name] = (value, params)
+def _ics_event(event):
+    if "DTSTART" not in event: raise ValueError("DTSTART がありません")
+    title = _ics_text(event.get("SUMMARY", ("",))[0]).strip()
+    if not title: raise ValueError("件名 (SUMMARY) が空です")
+    start, hhmm = _ics_datetime(*event["DTSTART"]); rrule = event.get("RRULE", ("",))[0]
+    uid = _ics_text(event["UID"][0]) if "UID" in event else str(uuid.uuid4())
+    for d in _ics_occurrences(start, rrule, set(event["EXDATE"])):
+        # 繰り返し予定は回ごとに別の予定として持つ (1回分だけ削除できるように)
+        yield d.isoformat(), {"id": f"{uid}/{d.isoformat()}" if rrule else uid, "time": hhmm, "title": title}
+def ics_fold(line):
+    """75オクテットごとに折り返す (UTF-8 の文字の途中では切らない)。"""
+    out, cur, size = [], "", 0
+    for ch in line:
+        n = len(ch.encode())
+        if size + n > 75: out.append(cur); cur, size = " ", 1
+        cur += ch; size += n
+    out.append(cur); return "\r\n".join(out) + "\r\n"
+def ics_export(events):
+    """(日付, 予定) の列から .ics を少しずつ生成する (Response にそのまま渡してストリーミングする)。"""
+    yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//miniMUSCUT//Portal//JA\r\nCALSCALE:GREGORIAN\r\n"
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    for d_str, event in events:
+        start = d_str.replace("-", "") + "T" + (event.get("time") or "00:00").replace(":", "")[:4] + "00"
+        yield f"BEGIN:VEVENT\r\n{ics_fold('UID:' + _ics_escape(event['id']))}DTSTAMP:{stamp}\r\nDTSTART:{start}\r\n{ics_fold('SUMMARY:' + _ics_escape(event['title']))}END:VEVENT\r\n"
+    yield "END:VCALENDAR\r\n"
+# 日本語は分かち書きしないため、空白で区切った各語を1文字 + 2文字のn-gramで索引する
+def normalize_text(text): return unicodedata.normalize("NFKC", text).lower()
+def text_ngrams(text):
+    grams = Counter()
+    for word in normalize_text(text).split():
+        grams.update(word); grams.update(word[i:i + 2] for i in range(len(word) - 1))
+    return grams
+def query_ngrams(text):
+    grams = set()
+    for word in normalize_text(text).split():
+        grams.update([word] if len(word) == 1 else (word[i:i + 2] for i in range(len(word) - 1)))
+    return grams
 class PostManager:
-    def __init__(self):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        if not os.path.exists(POST_FILE):
-            with open(POST_FILE, "w") as f: json.dump({}, f)
-        with open(POST_FILE) as f: self.posts = json.load(f)
-    def _save(self):
-        with open(POST_FILE, "w") as f: json.dump(self.posts, f, indent=2)
+    def __init__(self, store):
+        self.store = store; self._versions, self._epoch = Counter(), 0; self.on_answer = []; self._load()
+        store.watch("posts", self._reload, self._load); store.watch("post_index", self._reload_terms)
+    def _load(self): self._epoch += 1; self.posts = self.store.load("posts"); self._load_index(); self._load_order()
+    def _save(self, qid): self._versions[qid] += 1; self.store.put("posts", qid, self.posts[qid])
+    def version(self, qid): return self._epoch, self._versions[qid]
+    def _reload(self, qid, record):
+        old = self.posts.pop(qid, None)
+        if old: self._unlink_order(old)
+        if record is not None: self.posts[qid] = record; self._link_order(record)
+        self._versions[qid] += 1
+        # 他プロセスで増えた回答も on_answer に知らせる
+        for aid in (record or {}).get("answers", {}).keys() - (old or {}).get("answers", {}).keys(): self._notify_answer(qid, record["answers"][aid])
+    def _notify_answer(self, qid, answer):
+        version = self.version(qid)
+        for callback in self.on_answer: callback(qid, answer, version)
+    def _reload_terms(self, qid, record):
+        self._link(qid, record["tf"] if record else {})
+        if record is None: self.doc_terms.pop(qid, None)
+    # 投稿順インデックス: 全体・タグ別・投稿者別・状態別に (timestamp, qid) の昇順リストを保持する
+    @staticmethod
+    def _status(q): return "solved" if q.get("best_answer_id") else "answered" if q["answers"] else "unanswered"
+    def _load_order(self):
+        self._order, self._by_tag, self._by_author = [], defaultdict(list), defaultdict(list)
+        self._by_status = {st: [] for st in QUESTION_STATUSES}
+        for q in sorted(self.posts.values(), key=lambda x: x["timestamp"]): self._link_order(q, append=True)
+    def _link_order(self, q, append=False):
+        key = (q["timestamp"], q["id"])
+        lists = [self._order, self._by_author[q["author"]], self._by_status[self._status(q)]] + [self._by_tag[t] for t in set(q.get("tags", []))]
+        for lst in lists: lst.append(key) if append else bisect.insort(lst, key)
+    def _unlink_order(self, q):
+        key = (q["timestamp"], q["id"])
+        for lst in [self._order, self._by_author[q["author"]], self._by_status[self._status(q)]] + [self._by_tag[t] for t in set(q.get("tags", []))]:
+            i = bisect.bisect_left(lst, key)
+            if i < len(lst) and lst[i] == key: del lst[i]
+    def _move_status(self, q, old):
+        new = self._status(q); key = (q["timestamp"], q["id"])
+        if new == old: return
+        lst = self._by_status[old]; del lst[bisect.bisect_left(lst, key)]
+        bisect.insort(self._by_status[new], key)
+    def _newest(self, keys, limit=None):
+        keys = keys if limit is None else keys[-limit:]
+        return [self.posts[qid] for _, qid in reversed(keys)]
+    def latest(self, n): return self._newest(self._order, n)
+    # 転置インデックス: n-gram → {qid: 出現数}。質問ごとの出現数ベクトルを "post_index" に保存し、起動時はそこから組み立てる
+    def _load_index(self):
+        self.doc_terms, self.inverted = {}, defaultdict(dict)
+        stored = self.store.load("post_index")
+        with self.store.batch():
+            for qid in self.posts:
+                rec = stored.pop(qid, None)
+                if rec and rec.get("v") == SEARCH_INDEX_VERSION: self._link(qid, rec["tf"])
+                else: self._index(qid)  # 未索引・旧形式の質問だけトークナイズし直す
+            for qid in stored: self.store.delete("post_index", qid)
+    def _link(self, qid, tf):
+        for g in self.doc_terms.get(qid, {}).keys() - tf.keys():
+            del self.inverted[g][qid]
+            if not self.inverted[g]: del self.inverted[g]
+        self.doc_terms[qid] = tf
+        for g, n in tf.items(): self.inverted[g][qid] = n
+    def _save_index(self, qid): self.store.put("post_index", qid, {"v": SEARCH_INDEX_VERSION, "tf": self.doc_terms[qid]})
+    def _index(self, qid):
+        q = self.posts[qid]; tf = Counter()
+        for g, n in text_ngrams(q["title"]).items(): tf[g] += n * SEARCH_TITLE_WEIGHT
+        tf.update(text_ngrams(q["content"]))
+        for a in q["answers"].values(): tf.update(text_ngrams(a["content"]))
+        self._link(qid, dict(tf)); self._save_index(qid)
+    def _index_answer(self, qid, content):
+        tf = self.doc_terms[qid]
+        for g, n in text_ngrams(content).items(): tf[g] = tf.get(g, 0) + n; self.inverted[g][qid] = tf[g]
+        self._save_index(qid)
+    def _keyword_hits(self, keyword):
+        kw, grams = normalize_text(keyword), query_ngrams(keyword)
+        if not grams: return []
+        # 最短のポスティングリストから候補を絞るので、走査量はコーパス全体ではなく候補数に比例する
+        postings = sorted((self.inverted.get(g, {}) for g in grams), key=len)
+        n_docs, scored = len(self.doc_terms) or 1, []
+        for qid in postings[0]:
+            if not all(qid in p for p in postings[1:]): continue
+            q = self.posts[qid]; texts = [q["title"], q["content"]] + [a["content"] for a in q["answers"].values()]
+            if not any(kw in normalize_text(t) for t in texts): continue  # n-gramは全て含むが連続していない誤ヒットを除く
+            score = sum(math.log(1 + p[qid]) * math.log(1 + n_docs / len(p)) for p in postings)
+            scored.append((score, q["timestamp"], qid))
+        return sorted(scored, reverse=True)  # (score, timestamp, qid) の降順
     def get_question(self, qid): return self.posts.get(qid)
-    def get_user_posts(self, uid): return [p for p in self.posts.values() if p['author'] == uid]
-    def search_questions(self, keyword="", tag=""):
-        results = sorted(self.posts.values(), key=lambda x: x["timestamp"], reverse=True)
-        if keyword:
-            kw = keyword.lower(); results = [p for p in results if kw in p['title'].lower() or kw in p['content'].lower()]
-        if tag: results = [p for p in results if tag in p.get('tags', [])]
-        return results
+    def get_user_posts(self, uid): return [self.posts[qid] for _, qid in self._by_author.get(uid, [])]
+    def _filtered(self, tag, status):
+        """キーワードなしの一覧の元になる (timestamp, qid) 昇順リストと、追加で必要な絞り込み条件。タグ・状態の両方がある場合は短い方を選ぶ。"""
+        if tag and status:
+            by_tag, by_status = self._by_tag.get(tag, []), self._by_status.get(status, [])
+            if len(by_tag) <= len(by_status): return by_tag, lambda q: self._status(q) == status
+            return by_status, lambda q: tag in q.get('tags', [])
+        if tag: return self._by_tag.get(tag, []), None
+        if status: return self._by_status.get(status, []), None
+        return self._order, None
+    def _ranked(self, keyword, tag, status):
+        return [k for k in self._keyword_hits(keyword)
+                if (not tag or tag in self.posts[k[2]].get('tags', [])) and (not status or self._status(self.posts[k[2]]) == status)]
+    def search_questions(self, keyword="", tag="", status=""):
+        if keyword.strip(): return [self.posts[k[2]] for k in self._ranked(keyword, tag, status)]  # 関連度順
+        keys, pred = self._filtered(tag, status)
+        return [q for q in self._newest(keys) if not pred or pred(q)]
+    def list_page(self, keyword="", tag="", status="", cursor=None, limit=QUESTIONS_PER_PAGE):
+        """キーセット方式のページ送り。cursor は前ページ最後の質問のキー (キーワードなしは (timestamp, qid)、
+        キーワードありは (score, timestamp, qid))。返り値は (質問リスト, 次ページのcursor or None)。"""
+        if keyword.strip():
+            ranked = self._ranked(keyword, tag, status)
+            start = 0 if cursor is None else next((i for i, k in enumerate(ranked) if k < tuple(cursor)), len(ranked))
+            page = ranked[start:start + limit + 1]
+            return [self.posts[k[2]] for k in page[:limit]], (list(page[limit - 1]) if len(page) > limit else None)
+        keys, pred = self._filtered(tag, status)
+        pos = len(keys) if cursor is None else bisect.bisect_left(keys, tuple(cursor)); page = []
+        while pos > 0 and len(page) <= limit:
+            pos -= 1; q = self.posts[keys[pos][1]]
+            if not pred or pred(q): page.append(q)
+        return page[:limit], ([page[limit - 1]["timestamp"], page[limit - 1]["id"]] if len(page) > limit else None)
+    def summary(self, q):
+        return {"id": q["id"], "title": q["title"], "author": q["author"], "timestamp": q["timestamp"], "tags": q.get("tags", []),
+                "answers": len(q["answers"]), "status": self._status(q)}
     def add_question(self, author, title, content, tags_str):
         qid = "q-" + str(uuid.uuid4()); tags = [t.strip() for t in tags_str.split(',') if t.strip()]
         self.posts[qid] = {"id": qid, "title": title, "content": content, "author": author, "timestamp": datetime.now().isoformat(),
                            "best_answer_id": None, "answers": {}, "tags": tags}
-        self._save(); return qid
+        self._save(qid); self._index(qid); self._link_order(self.posts[qid]); return qid
     def add_answer(self, qid, author, content):
         if qid not in self.posts: return None
-        aid = "a-" + str(uuid.uuid4())
+        aid = "a-" + str(uuid.uuid4()); old = self._status(self.posts[qid])
         self.posts[qid]["answers"][aid] = {"id": aid, "content": content, "author": author, "timestamp": datetime.now().isoformat()}
-        self._save(); return aid
+        self._save(qid); self._index_answer(qid, content); self._move_status(self.posts[qid], old)
+        self._notify_answer(qid, self.posts[qid]["answers"][aid]); return aid
     def set_best_answer(self, qid, aid):
         q = self.get_question(qid)
         if not q or aid not in q["answers"]: return None, None
-        q["best_answer_id"] = aid; self._save()
+        old = self._status(q); q["best_answer_id"] = aid; self._save(qid); self._move_status(q, old)
         return q["answers"][aid]["author"], q["author"] == q["answers"][aid]["author"]
 class ReservationSystem:
-    def __init__(self):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        if not os.path.exists(RESV_FILE):
-            with open(RESV_FILE, "w") as f: json.dump({}, f)
-        with open(RESV_FILE) as f: self.res = defaultdict(lambda: defaultdict(dict), json.load(f))
-    def _save(self):
-        with open(RESV_FILE, "w") as f: json.dump(self.res, f, indent=2)
+    def __init__(self, store):
+        self.store = store
+        # 排他はストライプ化したロックで (日付, ユーザー) → (日付, キャンパス, 教室) → 日付 の順に取る。
+        # 別の教室への予約は日付ロック (辞書の更新とスナップショット作成だけの短い区間) 以外で並行に進む
+        self._user_locks, self._room_locks, self._day_locks = ([threading.Lock() for _ in range(RESERVATION_LOCK_STRIPES)] for _ in range(3))
+        # (日付, キャンパス) ごとの版数。全件を読み直したときは epoch を進めるので、(epoch, 版数) は戻らない
+        self._versions, self._epoch = Counter(), 0
+        # on_change(campus, d_str, [(教室, 時, 予約済みか), ...], 版数): 枠が埋まった・空いたときに呼ぶ (ライブ更新用)
+        self.on_change = []
+        self._load(); store.watch("reservations", self._reload, self._load)
+    def version(self, campus, d_str): return self._epoch, self._versions[(d_str, campus)]
+    def _load(self):
+        self._epoch += 1
+        self.res = defaultdict(lambda: defaultdict(dict), self.store.load("reservations"))
+        # (日付, ユーザー) → 予約時間数 と ユーザー → {(日付, キャンパス, 教室, 時)} を reserve/cancel で同時に更新する
+        self._user_hours, self._by_user = Counter(), defaultdict(set)
+        # (日付, キャンパス) → 教室ごとの空き状況ビットマップ (教室番号を添字とするintのリスト、bit i = OPEN_TIME+i 時が予約済み)
+        self._busy = {}
+        for d_str, day_data in self.res.items(): self._link_day(d_str, day_data)
+    def _link_day(self, d_str, day_data, link=True):
+        for campus, campus_data in day_data.items():
+            for room, room_data in campus_data.items():
+                for h_str, res_user in room_data.items():
+                    (self._link_slot if link else self._unlink_slot)(res_user, d_str, campus, room, int(h_str))
+    def _reload(self, d_str, record):
+        with self._lock(self._day_locks, d_str):
+            old = self.res.pop(d_str, {})
+            if old: self._link_day(d_str, old, link=False)
+            if record is not None: self.res[d_str] = record; self._link_day(d_str, record)
+            for campus in CAMPUSES: self._versions[(d_str, campus)] += 1
+            # 他プロセスの予約・キャンセルを、前後の1日分の差分として知らせる
+            changed = []
+            for campus in CAMPUSES:
+                before, after = self._slots(old.get(campus, {})), self._slots((record or {}).get(campus, {}))
+                if before != after: changed.append((campus, [(r, h, True) for r, h in after - before] + [(r, h, False) for r, h in before - after], self.version(campus, d_str)))
+        for campus, slots, version in changed: self._notify(campus, d_str, slots, version)
+    @staticmethod
+    def _slots(campus_data): return {(int(room), int(h_str)) for room, room_data in campus_data.items() if room.isdigit() for h_str in room_data}
+    def _notify(self, campus, d_str, slots, version):
+        for callback in self.on_change: callback(campus, d_str, slots, version)
+    def _save(self, d_str):
+        # 他の教室への並行書き込みと競合しないよう、日付ロック内で1日分のコピーを渡す
+        if d_str in self.res: self.store.put("reservations", d_str, {c: {r: dict(hs) for r, hs in cd.items()} for c, cd in self.res[d_str].items()})
+        else: self.store.delete("reservations", d_str)
+    @staticmethod
+    def _lock(stripes, *key): return stripes[hash(key) % len(stripes)]
+    def _link_slot(self, user, d_str, campus, room, hour):
+        self._user_hours[(d_str, user)] += 1; self._by_user[user].add((d_str, campus, str(room), hour))
+        if campus in CAMPUSES and OPEN_TIME <= hour < CLOSE_TIME and str(room).isdigit() and 1 <= int(room) <= CAMPUSES[campus]["rooms"]:
+            self._day_bits(campus, d_str)[int(room)] |= 1 << (hour - OPEN_TIME)
+    def _unlink_slot(self, user, d_str, campus, room, hour):
+        self._user_hours[(d_str, user)] -= 1; self._by_user[user].discard((d_str, campus, str(room), hour))
+        if not self._user_hours[(d_str, user)]: del self._user_hours[(d_str, user)]
+        if not self._by_user[user]: del self._by_user[user]
+        bits = self._busy.get((d_str, campus))
+        # 営業時間外の枠 (時間を確かめていなかった頃の予約) はビットマップに載せていない
+        if bits and OPEN_TIME <= hour < CLOSE_TIME and str(room).isdigit() and 1 <= int(room) < len(bits):
+            bits[int(room)] &= ~(1 << (hour - OPEN_TIME))
+    def _day_bits(self, campus, d_str): return self._busy.setdefault((d_str, campus), [0] * (CAMPUSES[campus]["rooms"] + 1))
+    @staticmethod
+    def slot_mask(start, dur): return ((1 << dur) - 1) << (start - OPEN_TIME)
+    def room_bits(self, campus, d_str, room):
+        bits = self._busy.get((d_str, campus)); return bits[int(room)] if bits else 0
+    def is_free(self, campus, d_str, room, start, dur=1): return not self.room_bits(campus, d_str, room) & self.slot_mask(start, dur)
+    def find_free_room(self, campus, d_str, start, dur):
+        """start 時から dur 時間連続で空いている最初の教室番号 (なければ None)。"""
+        mask, bits = self.slot_mask(start, dur), self._busy.get((d_str, campus))
+        return next((room for room in range(1, CAMPUSES[campus]["rooms"] + 1) if not bits or not bits[room] & mask), None)
+    def find_slots(self, user, campuses, date_from, date_to, dur, hour_from=OPEN_TIME, hour_to=CLOSE_TIME, limit=10):
+        """date_from〜date_to (date) の中で dur 時間連続して空いている枠を、日付・開始時刻・キャンパス順に最大 limit 件返す。
+        同じ (日付, キャンパス, 開始時刻) には最も番号の小さい空き教室を1つだけ割り当てる。1日の上限時間を超える日は除外する。"""
+        hour_from, hour_to = max(hour_from, OPEN_TIME), min(hour_to, CLOSE_TIME)
+        if dur < 1 or hour_to - hour_from < dur: return []
+        full = (1 << (CLOSE_TIME - OPEN_TIME)) - 1
+        window = ((1 << (hour_to - hour_from - dur + 1)) - 1) << (hour_from - OPEN_TIME)  # 開始可能な時刻のビット
+        slots, d = [], date_from
+        while d <= date_to and len(slots) < limit:
+            d_str = d.strftime("%Y-%m-%d"); d += timedelta(days=1)
+            if self.get_user_reservations_for_day(d_str, user) + dur > MAX_HOURS_PER_DAY: continue
+            found = []
+            for campus in campuses:
+                bits, todo = self._busy.get((d_str, campus)), window
+                for room in range(1, CAMPUSES[campus]["rooms"] + 1):
+                    free = full & ~(bits[room] if bits else 0); starts = free
+                    for i in range(1, dur): starts &= free >> i  # bit i = i時から dur 時間空いている
+                    hit, todo = starts & todo, todo & ~starts
+                    while hit:
+                        low = hit & -hit; hit ^= low
+                        found.append((low.bit_length() - 1 + OPEN_TIME, campuses.index(campus), room, campus))
+                    if not todo: break
+            for start, _, room, campus in sorted(found)[:limit - len(slots)]:
+                slots.append({"date": d_str, "campus": campus, "room": room, "start": start, "dur": dur})
+        return slots
+    def day_matrix(self, campus, d_str):
+        """日表示用の [(教室番号, [(時, 予約者 or None), ...]), ...]。空き教室はビットマップだけで埋め、予約者は予約済みの枠だけ引く。"""
+        bits, day = self._busy.get((d_str, campus)), self.get_day_reservations(campus, d_str)
+        hours = range(OPEN_TIME, CLOSE_TIME); empty = [(h, None) for h in hours]
+        return [(room, [(h, day.get(str(room), {}).get(str(h)) if bits[room] >> (h - OPEN_TIME) & 1 else None) for h in hours] if bits and bits[room] else empty)
+                for room in range(1, CAMPUSES[campus]["rooms"] + 1)]
     def get_day_reservations(self, campus, d_str): return self.res.get(d_str, {}).get(campus, {})
-    def get_user_reservations_for_day(self, d_str, user):
-        count = 0; day_data = self.res.get(d_str, {})
-        for campus_data in day_data.values():
-            for room_data in campus_data.values():
-                for res_user in room_data.values():
-                    if res_user == user: count += 1
-        return count
+    def get_user_reservations_for_day(self, d_str, user): return self._user_hours.get((d_str, user), 0)
+    def get_user_reservations(self, user, from_date=""):
+        """ユーザーの全予約を日付・時刻順で返す。from_date 以降 (YYYY-MM-DD) に絞り込める。"""
+        slots = sorted((s for s in self._by_user.get(user, ()) if s[0] >= from_date), key=lambda s: (s[0], s[3], s[1], int(s[2])))
+        return [{"date": d_str, "campus": campus, "room": room, "hour": hour} for d_str, campus, room, hour in slots]
     def reserve(self, user, campus, room, d_str, start, dur):
-        if self.get_user_reservations_for_day(d_str, user) + dur > MAX_HOURS_PER_DAY: return False, f"1日の最大予約時間({MAX_HOURS_PER_DAY}h)を超えます"
-        day_res = self.res.setdefault(d_str, {}).setdefault(campus, {}); room_res = day_res.setdefault(str(room), {})
-        for h in range(start, start + dur):
-            if str(h) in room_res: return False, f"{h}:00は既に予約されています"
-        for h in range(start, start + dur): room_res[str(h)] = user
-        self._save(); return True, "予約が完了しました"
+        if campus not in CAMPUSES or not str(room).isdigit() or not 1 <= int(room) <= CAMPUSES[campus]["rooms"]: return False, "存在しない教室です"
+        if dur < 1 or start < OPEN_TIME or start + dur > CLOSE_TIME: return False, f"予約できるのは{OPEN_TIME}:00〜{CLOSE_TIME}:00です"
+        with self._lock(self._user_locks, d_str, user), self._lock(self._room_locks, d_str, campus, str(room)):
+            if self.get_user_reservations_for_day(d_str, user) + dur > MAX_HOURS_PER_DAY: return False, f"1日の最大予約時間({MAX_HOURS_PER_DAY}h)を超えます"
+            conflict = self.room_bits(campus, d_str, room) & self.slot_mask(start, dur)
+            if conflict: return False, f"{OPEN_TIME + (conflict & -conflict).bit_length() - 1}:00は既に予約されています"
+            with self._lock(self._day_locks, d_str):
+                room_res = self.res.setdefault(d_str, {}).setdefault(campus, {}).setdefault(str(room), {})
+                for h in range(start, start + dur): room_res[str(h)] = user; self._link_slot(user, d_str, campus, room, h)
+                self._versions[(d_str, campus)] += 1; self._save(d_str); version = self.version(campus, d_str)
+        self._notify(campus, d_str, [(int(room), h, True) for h in range(start, start + dur)], version)
+        return True, "予約が完了しました"
     def cancel(self, user, campus, room, d_str, hour):
         h_str = str(hour)
-        if self.res.get(d_str, {}).get(campus, {}).get(str(room), {}).get(h_str) == user:
-            del self.res[d_str][campus][str(room)][h_str]
-            if not self.res[d_str][campus][str(room)]: del self.res[d_str][campus][str(room)]
-            if not self.res[d_str][campus]: del self.res[d_str][campus]
-            if not self.res[d_str]: del self.res[d_str]
-            self._save(); return True
-        return False
+        with self._lock(self._user_locks, d_str, user), self._lock(self._room_locks, d_str, campus, str(room)):
+            if self.res.get(d_str, {}).get(campus, {}).get(str(room), {}).get(h_str) != user: return False
+            with self._lock(self._day_locks, d_str):
+                del self.res[d_str][campus][str(room)][h_str]
+                if not self.res[d_str][campus][str(room)]: del self.res[d_str][campus][str(room)]
+                if not self.res[d_str][campus]: del self.res[d_str][campus]
+                if not self.res[d_str]: del self.res[d_str]
+                self._unlink_slot(user, d_str, campus, room, hour)  # 予約を消してから索引を減らす (途中で失敗しても予約が残ったまま数が減らない)
+                self._versions[(d_str, campus)] += 1; self._save(d_str); version = self.version(campus, d_str)
+        self._notify(campus, d_str, [(int(room), int(hour), False)], version)
+        return True
 
 # ───────── 4. Flask App & HTML Templates ─────────
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
-from jinja2 import DictLoader, ChoiceLoader
+from jinja2 import DictLoader, ChoiceLoader, FileSystemBytecodeCache
+from markupsafe import Markup
 
 BASE_HTML = """
 <!doctype html><html lang="ja"><meta charset="utf-8">
@@ -269,6 +1296,7 @@ BASE_HTML = """
         <li class="nav-item"><a class="nav-link" href="{{ url_for('schedule_month') }}"><i class="bi bi-calendar-event"></i> 個人スケジュール</a></li>
         <li class="nav-item"><a class="nav-link" href="{{ url_for('shop') }}"><i class="bi bi-shop"></i> ポイント交換所</a></li>
         <li class="nav-item"><a class="nav-link" href="{{ url_for('game_center') }}"><i class="bi bi-controller"></i> ゲーム</a></li>
+        <li class="nav-item"><a class="nav-link" href="{{ url_for('leaderboard') }}"><i class="bi bi-trophy"></i> ランキング</a></li>
         {% endif %}
       </ul>
       {% if session.user %}
@@ -445,9 +1473,9 @@ document.addEventListener('DOMContentLoaded', () => {
     function endGame() {
         gameOver = true; gameOverMessage.style.display = 'block';
         fetch("{{ url_for('game_submit_score') }}", {
-            method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ score: score })
+            method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ game: 'tetris', score: score })
         }).then(r => r.json()).then(d => {
-            gameOverMessage.innerHTML = d.status === 'success' ? `<h4>ゲームオーバー！</h4><p>獲得ポイント: <strong>${d.points_earned} pt</strong></p>` : `<h4>ゲームオーバー！</h4><p>スコア送信失敗</p>`;
+            gameOverMessage.innerHTML = d.status === 'success' ? `<h4>ゲームオーバー！</h4><p>獲得ポイント: <strong>${d.points_earned} pt</strong></p>${d.best ? '<p>自己ベスト更新！</p>' : ''}` : `<h4>ゲームオーバー！</h4><p>スコア送信失敗</p>`;
         });
     }
     function reset() {
@@ -474,34 +1502,245 @@ document.addEventListener('DOMContentLoaded', () => {
 ALL_HTMLS = {
     "base.html": BASE_HTML, "profile.html": PROFILE_HTML, "game_center.html": GAME_CENTER_HTML, "game.html": GAME_HTML,
     "login_register.html": "{% extends 'base.html' %}{% block body %}<div class='row justify-content-center'><div class='col-lg-5 col-md-8'><div class='card'><div class='card-body p-4'><h3 class='card-title text-center mb-4'>{{ title }}</h3><form method=post><div class='mb-3'><label class='form-label'><i class='bi bi-person'></i> ユーザID</label><input name=uid class='form-control' required></div><div class='mb-3'><label class='form-label'><i class='bi bi-key'></i> パスワード</label><input type=password name=pw class='form-control' required></div><div class='d-grid'><button class='btn btn-primary btn-lg'>{{ title }}</button></div></form><hr><div class='text-center'>{% if title == 'ログイン' %}<a href='{{url_for('register')}}'>新規登録はこちら</a>{% else %}<a href='{{url_for('login')}}'>ログインはこちら</a>{% endif %}</div></div></div></div></div>{% endblock %}",
-    "index.html": """{% extends 'base.html' %}{% block body %}{% if announcements %}<div class="mb-4"><h4 class="h5"><i class="bi bi-info-circle-fill text-primary"></i> お知らせ</h4>{% for ann in announcements %}<div class="alert alert-light border"><strong class="alert-heading">{{ ann.title }}</strong><p class="mb-0 mt-2" style="white-space: pre-wrap;">{{ ann.content }}</p><hr><p class="mb-0 text-end text-muted small">{{ ann.timestamp.split('T')[0] }}</p></div>{% endfor %}</div>{% endif %}<div class="d-flex justify-content-between align-items-center mb-4"><h2 class="h4 mb-0"><i class="bi bi-chat-left-text"></i> Q&A - 質問一覧</h2><a href="{{ url_for('ask') }}" class="btn btn-primary"><i class="bi bi-plus-circle"></i> 新しい質問</a></div><div class="card mb-4"><div class="card-body"><form method="get" class="row g-3 align-items-center"><div class="col"><input type="text" name="keyword" class="form-control" placeholder="キーワードで検索..." value="{{ request.args.get('keyword', '') }}"></div><div class="col"><input type="text" name="tag" class="form-control" placeholder="タグで検索..." value="{{ request.args.get('tag', '') }}"></div><div class="col-auto"><button type="submit" class="btn btn-outline-primary"><i class="bi bi-search"></i> 検索</button></div></form></div></div>{% for q in questions %}<div class="card mb-3"><div class="card-body"><div class="d-flex w-100 justify-content-between"><h5 class="mb-1"><a href="{{ url_for('question_detail', qid=q.id) }}" class="text-decoration-none">{{ q.title }}</a></h5><small class="text-muted">{{ q.timestamp.split('T')[0] }}</small></div><p class="mb-1 text-muted small">投稿者: <a href="{{ url_for('profile', uid=q.author) }}">{{ q.author }}</a> | 回答: {{ q.answers|length }}{% if q.best_answer_id %}<span class="badge bg-success ms-2">解決済み</span>{% endif %}</p>{% if q.tags %}{% for tag in q.tags %}<a href="{{ url_for('index', tag=tag) }}" class="badge bg-secondary text-decoration-none tag">{{ tag }}</a>{% endfor %}{% endif %}</div></div>{% else %}<div class="alert alert-info">該当する質問はありません。</div>{% endfor %}{% endblock %}""",
-    "admin.html": """{% extends 'base.html' %}{% block body %}<div class="row"><div class="col-lg-8"><h3><i class='bi bi-people-fill'></i> ユーザー管理</h3><div class='table-responsive'><table class='table table-bordered table-striped table-hover'><thead><tr><th>ユーザ</th><th>状態</th><th>Pt</th><th>違反</th><th>操作</th></tr></thead><tbody>{% for uid, u in users.items() %}<tr class='{{'table-warning' if u.status == 'banned' else ''}}'><td>{{uid}} <small class="text-muted">({{u.role}})</small></td><td>{{u.status}}</td><td>{{u.points}}</td><td>{{u.vio}}</td><td>{% if uid != 'admin' %}<form method=post action='{{url_for('admin_user_action')}}' class='d-inline-flex flex-wrap align-items-center gap-1'><input type=hidden name=uid value='{{uid}}'><button name=act value='vio_add' class='btn btn-sm btn-outline-danger' title="違反+1"><i class="bi bi-plus-circle"></i></button><button name=act value='vio_sub' class='btn btn-sm btn-outline-success' title="違反-1"><i class="bi bi-dash-circle"></i></button><button name=act value='ban' class='btn btn-sm btn-warning' onclick="return confirm('本当にこのユーザーを「{{'利用可能に' if u.status == 'banned' else '利用停止に'}}」しますか？')">{{'解除' if u.status == 'banned' else '停止'}}</button><div class='input-group input-group-sm' style='width: 120px;'><input type=number name=points class='form-control' value=10><button name=act value='adjust_points' class='btn btn-sm btn-info'>Pt</button></div></form>{% endif %}</td></tr>{% endfor %}</tbody></table></div></div><div class="col-lg-4"><div class="card"><div class="card-header fw-bold"><i class="bi bi-megaphone-fill"></i> お知らせ管理</div><div class="card-body"><form action="{{ url_for('admin_announcement_action') }}" method="post"><input type="hidden" name="act" value="add"><div class="mb-2"><input type="text" name="title" class="form-control" placeholder="タイトル" required></div><div class="mb-2"><textarea name="content" class="form-control" rows="3" placeholder="内容" required></textarea></div><div class="d-grid"><button type="submit" class="btn btn-primary">お知らせを投稿</button></div></form></div><ul class="list-group list-group-flush"><li class="list-group-item active">投稿済みのお知らせ</li>{% for ann in announcements %}<li class="list-group-item d-flex justify-content-between align-items-center"><span class="text-truncate" title="{{ ann.title }}">{{ ann.title }}</span><form action="{{ url_for('admin_announcement_action') }}" method="post" onsubmit="return confirm('このお知らせを削除しますか？');"><input type="hidden" name="act" value="delete"><input type="hidden" name="ann_id" value="{{ ann.id }}"><button type="submit" class="btn btn-sm btn-danger"><i class="bi bi-trash"></i></button></form></li>{% else %}<li class="list-group-item">まだお知らせはありません。</li>{% endfor %}</ul></div></div></div>{% endblock %}""",
+    "index.html": """{% extends 'base.html' %}{% block body %}{% if upcoming %}<div class="card mb-4"><div class="card-header fw-bold"><i class="bi bi-calendar-event"></i> 今後の予定</div><ul class="list-group list-group-flush">{% for d_str, event in upcoming %}<li class="list-group-item"><a href="{{ url_for('schedule_day', day_str=d_str) }}" class="text-decoration-none">{{ d_str }} {{ event.time }}</a> - {{ event.title }}</li>{% endfor %}</ul></div>{% endif %}{{ announcements_html }}<div class="d-flex justify-content-between align-items-center mb-4"><h2 class="h4 mb-0"><i class="bi bi-chat-left-text"></i> Q&A - 質問一覧</h2><a href="{{ url_for('ask') }}" class="btn btn-primary"><i class="bi bi-plus-circle"></i> 新しい質問</a></div><div class="card mb-4"><div class="card-body"><form method="get" class="row g-3 align-items-center"><div class="col"><input type="text" name="keyword" class="form-control" placeholder="キーワードで検索..." value="{{ request.args.get('keyword', '') }}"></div><div class="col"><input type="text" name="tag" class="form-control" placeholder="タグで検索..." value="{{ request.args.get('tag', '') }}"></div><div class="col-auto"><select name="status" class="form-select"><option value="">すべて</option>{% for st, label in question_statuses.items() %}<option value="{{ st }}" {% if request.args.get('status') == st %}selected{% endif %}>{{ label }}</option>{% endfor %}</select></div><div class="col-auto"><button type="submit" class="btn btn-outline-primary"><i class="bi bi-search"></i> 検索</button></div></form></div></div>{% for q in questions %}<div class="card mb-3"><div class="card-body"><div class="d-flex w-100 justify-content-between"><h5 class="mb-1"><a href="{{ url_for('question_detail', qid=q.id) }}" class="text-decoration-none">{{ q.title }}</a></h5><small class="text-muted">{{ q.timestamp.split('T')[0] }}</small></div><p class="mb-1 text-muted small">投稿者: <a href="{{ url_for('profile', uid=q.author) }}">{{ q.author }}</a> | 回答: {{ q.answers|length }}{% if q.best_answer_id %}<span class="badge bg-success ms-2">解決済み</span>{% endif %}</p>{% if q.tags %}{% for tag in q.tags %}<a href="{{ url_for('index', tag=tag) }}" class="badge bg-secondary text-decoration-none tag">{{ tag }}</a>{% endfor %}{% endif %}</div></div>{% else %}<div class="alert alert-info">該当する質問はありません。</div>{% endfor %}<nav class="d-flex justify-content-between">{% if request.args.get('cursor') %}<a href="{{ url_for('index', keyword=request.args.get('keyword', ''), tag=request.args.get('tag', ''), status=request.args.get('status', '')) }}" class="btn btn-outline-secondary"><i class="bi bi-chevron-double-left"></i> 最新に戻る</a>{% else %}<span></span>{% endif %}{% if next_cursor %}<a href="{{ url_for('index', keyword=request.args.get('keyword', ''), tag=request.args.get('tag', ''), status=request.args.get('status', ''), cursor=next_cursor) }}" class="btn btn-outline-primary">次のページ <i class="bi bi-chevron-right"></i></a>{% endif %}</nav>{% endblock %}""",
+    "admin.html": """{% extends 'base.html' %}{% block body %}<div class="row"><div class="col-lg-8"><h3><i class='bi bi-people-fill'></i> ユーザー管理 <small class="text-muted fs-6">{% for st, n in status_counts.items() %}{{ st }}: {{ n }}人 {% endfor %}</small></h3><form method=get class='row g-2 align-items-end mb-3'><div class='col-md-3'><input type=text name=q class='form-control form-control-sm' placeholder='ユーザID (前方一致)' value='{{ request.args.get('q', '') }}'></div><div class='col-md-2'><select name=status class='form-select form-select-sm'><option value=''>すべての状態</option>{% for st in ['active', 'banned'] %}<option value='{{ st }}' {% if request.args.get('status') == st %}selected{% endif %}>{{ st }}</option>{% endfor %}</select></div><div class='col-md-2'><div class='input-group input-group-sm'><input type=number name=pmin class='form-control' placeholder='Pt下限' value='{{ request.args.get('pmin', '') }}'><input type=number name=pmax class='form-control' placeholder='上限' value='{{ request.args.get('pmax', '') }}'></div></div><div class='col-md-2'><div class='input-group input-group-sm'><input type=number name=vmin class='form-control' placeholder='違反下限' value='{{ request.args.get('vmin', '') }}'><input type=number name=vmax class='form-control' placeholder='上限' value='{{ request.args.get('vmax', '') }}'></div></div><div class='col-md-2'><div class='input-group input-group-sm'><select name=sort class='form-select'>{% for key, label in admin_sorts.items() %}<option value='{{ key }}' {% if request.args.get('sort') == key %}selected{% endif %}>{{ label }}</option>{% endfor %}</select><select name=order class='form-select'><option value='asc'>昇順</option><option value='desc' {% if request.args.get('order') == 'desc' %}selected{% endif %}>降順</option></select></div></div><div class='col-md-1'><button class='btn btn-sm btn-outline-primary w-100'><i class='bi bi-funnel'></i></button></div></form><form id='bulk-form' method=post action='{{ url_for('admin_bulk_action') }}' class='d-flex gap-2 align-items-center mb-2'><input type=hidden name=next value='{{ request.full_path }}'><span class='small text-muted'>選択したユーザーに:</span><select name=act class='form-select form-select-sm' style='width: auto;'>{% for act, label in bulk_actions.items() %}<option value='{{ act }}'>{{ label }}</option>{% endfor %}</select><input type=number name=points class='form-control form-control-sm' style='width: 100px;' value=10 title='ポイント調整の量'><button class='btn btn-sm btn-danger' onclick="return confirm('選択したユーザーにまとめて適用しますか？');">一括適用</button></form><div class='table-responsive'><table class='table table-bordered table-striped table-hover'><thead><tr><th><input type=checkbox onclick="document.querySelectorAll('input[name=uids]').forEach(c => c.checked = this.checked)"></th><th>ユーザ</th><th>状態</th><th>Pt</th><th>違反</th><th>操作</th></tr></thead><tbody>{% for uid, u in users %}<tr class='{{'table-warning' if u.status == 'banned' else ''}}'><td>{% if uid != 'admin' %}<input type=checkbox name=uids value='{{ uid }}' form='bulk-form'>{% endif %}</td><td>{{uid}} <small class="text-muted">({{u.role}})</small></td><td>{{u.status}}</td><td>{{u.points}}</td><td>{{u.vio}}</td><td>{% if uid != 'admin' %}<form method=post action='{{url_for('admin_user_action')}}' class='d-inline-flex flex-wrap align-items-center gap-1'><input type=hidden name=uid value='{{uid}}'><input type=hidden name=next value='{{ request.full_path }}'><button name=act value='vio_add' class='btn btn-sm btn-outline-danger' title="違反+1"><i class="bi bi-plus-circle"></i></button><button name=act value='vio_sub' class='btn btn-sm btn-outline-success' title="違反-1"><i class="bi bi-dash-circle"></i></button><button name=act value='ban' class='btn btn-sm btn-warning' onclick="return confirm('本当にこのユーザーを「{{'利用可能に' if u.status == 'banned' else '利用停止に'}}」しますか？')">{{'解除' if u.status == 'banned' else '停止'}}</button><div class='input-group input-group-sm' style='width: 120px;'><input type=number name=points class='form-control' value=10><button name=act value='adjust_points' class='btn btn-sm btn-info'>Pt</button></div></form>{% endif %}</td></tr>{% else %}<tr><td colspan=6 class='text-center text-muted'>条件に合うユーザーはいません</td></tr>{% endfor %}</tbody></table></div><nav class='d-flex justify-content-between'>{% if prev_url %}<a href='{{ prev_url }}' class='btn btn-sm btn-outline-secondary'><i class='bi bi-chevron-left'></i> 前へ</a>{% else %}<span></span>{% endif %}{% if next_url %}<a href='{{ next_url }}' class='btn btn-sm btn-outline-secondary'>次へ <i class='bi bi-chevron-right'></i></a>{% endif %}</nav></div><div class="col-lg-4"><div class="card"><div class="card-header fw-bold"><i class="bi bi-megaphone-fill"></i> お知らせ管理</div><div class="card-body"><form action="{{ url_for('admin_announcement_action') }}" method="post"><input type="hidden" name="act" value="add"><div class="mb-2"><input type="text" name="title" class="form-control" placeholder="タイトル" required></div><div class="mb-2"><textarea name="content" class="form-control" rows="3" placeholder="内容" required></textarea></div><div class="row g-2 mb-2"><div class="col-6"><label class="form-label small mb-0">公開開始 (省略時はすぐ)</label><input type="datetime-local" name="publish_at" class="form-control form-control-sm"></div><div class="col-6"><label class="form-label small mb-0">公開終了 (省略時はなし)</label><input type="datetime-local" name="expires_at" class="form-control form-control-sm"></div></div><div class="d-grid"><button type="submit" class="btn btn-primary">お知らせを投稿</button></div></form></div><ul class="list-group list-group-flush"><li class="list-group-item active">投稿済みのお知らせ</li>{% for ann in announcements %}{% set st = announcement_state(ann, now) %}<li class="list-group-item d-flex justify-content-between align-items-center"><span class="text-truncate" title="{{ ann.title }}">{{ ann.title }}{% if st == 'scheduled' %} <span class="badge bg-info">{{ ann.publish_at[:16]|replace('T', ' ') }}から</span>{% elif st == 'expired' %} <span class="badge bg-secondary">公開終了</span>{% elif ann.expires_at %} <span class="badge bg-light text-dark">{{ ann.expires_at[:16]|replace('T', ' ') }}まで</span>{% endif %}</span><form action="{{ url_for('admin_announcement_action') }}" method="post" onsubmit="return confirm('このお知らせを削除しますか？');"><input type="hidden" name="act" value="delete"><input type="hidden" name="ann_id" value="{{ ann.id }}"><button type="submit" class="btn btn-sm btn-danger"><i class="bi bi-trash"></i></button></form></li>{% else %}<li class="list-group-item">まだお知らせはありません。</li>{% endfor %}</ul></div><div class="card mt-4"><div class="card-header fw-bold"><i class="bi bi-award-fill"></i> 称号管理</div><div class="card-body"><form action="{{ url_for('admin_title_action') }}" method="post"><input type="hidden" name="act" value="add"><div class="mb-2"><input type="text" name="name" class="form-control" placeholder="称号名" required></div><div class="input-group mb-2"><select name="counter" class="form-select">{% for c, label in title_counters.items() %}<option value="{{ c }}">{{ label }}</option>{% endfor %}</select><input type="number" name="value" class="form-control" min="1" value="10" required></div><div class="mb-2"><input type="text" name="desc" class="form-control" placeholder="説明 (省略可)"></div><div class="d-grid"><button type="submit" class="btn btn-primary">称号を追加</button></div></form></div><ul class="list-group list-group-flush"><li class="list-group-item active">追加した称号</li>{% for t, c in custom_titles.items() %}<li class="list-group-item d-flex justify-content-between align-items-center"><span class="text-truncate" title="{{ c.desc }}">{{ t }} <small class="text-muted">({{ title_counters.get(c.type, c.type) }} {{ c.value }})</small></span><form action="{{ url_for('admin_title_action') }}" method="post" onsubmit="return confirm('この称号を削除しますか？ (獲得済みのユーザーからは消えません)');"><input type="hidden" name="act" value="delete"><input type="hidden" name="name" value="{{ t }}"><button type="submit" class="btn btn-sm btn-danger"><i class="bi bi-trash"></i></button></form></li>{% else %}<li class="list-group-item">まだ追加した称号はありません。</li>{% endfor %}</ul></div><div class="card mt-4"><div class="card-header fw-bold"><i class="bi bi-journal-check"></i> ポイント台帳</div><div class="card-body"><p class="small text-muted">台帳から全ユーザーの残高を計算し直し、現在の残高と照合します。</p><form action="{{ url_for('admin_ledger_action') }}" method="post" class="d-flex gap-2"><button name="act" value="check" class="btn btn-outline-primary">照合</button><button name="act" value="fix" class="btn btn-outline-danger" onclick="return confirm('台帳の値で残高を上書きしますか？');">照合して修正</button></form></div></div></div></div>{% endblock %}""",
     "shop.html": """{% extends 'base.html' %}{% block body %}<h2 class="mb-4"><i class="bi bi-shop"></i> ポイント交換所</h2><div class="alert alert-info">あなたのポイント: <strong>{{ current_user.points }} pt</strong></div><div class="row"><div class="col-md-6"><h4><i class="bi bi-award-fill"></i> 交換限定称号</h4>{% for title_id, title_info in shop_titles.items() %}<div class="card mb-3"><div class="card-body d-flex justify-content-between align-items-center"><div><h5 class="card-title">{{ title_id }}</h5><p class="card-text mb-0">{{ title_info.desc }} - <strong class="text-primary">{{ title_info.price }} pt</strong></p></div>{% if title_id in current_user.get('titles', []) %}<button class="btn btn-success" disabled>交換済み</button>{% elif current_user.points >= title_info.price %}<form method="post" action="{{ url_for('purchase') }}"><input type="hidden" name="item_id" value="{{ title_id }}"><input type="hidden" name="item_type" value="title"><button type="submit" class="btn btn-primary">交換する</button></form>{% else %}<button class="btn btn-secondary" disabled>ポイント不足</button>{% endif %}</div></div>{% endfor %}</div><div class="col-md-6"><h4><i class="bi bi-palette-fill"></i> プロフィールテーマ</h4>{% for theme_id, theme_info in themes.items() %}{% if theme_info.price > 0 %}<div class="card mb-3"><div class="card-body d-flex justify-content-between align-items-center"><div><h5 class="card-title">{{ theme_info.name }}</h5><p class="card-text mb-0">プロフィールページの背景を変更します - <strong class="text-primary">{{ theme_info.price }} pt</strong></p></div>{% if theme_id in current_user.get('unlocked_themes', []) %}<button class="btn btn-success" disabled>解放済み</button>{% elif current_user.points >= theme_info.price %}<form method="post" action="{{ url_for('purchase') }}"><input type="hidden" name="item_id" value="{{ theme_id }}"><input type="hidden" name="item_type" value="theme"><button type="submit" class="btn btn-primary">解放する</button></form>{% else %}<button class="btn btn-secondary" disabled>ポイント不足</button>{% endif %}</div></div>{% endif %}{% endfor %}</div></div>{% endblock %}""",
-    "schedule_month.html": """{% extends 'base.html' %}{% block body %}<h2 class="mb-4"><i class="bi bi-calendar-event"></i> 個人スケジュール ({{ year }}年 {{ month }}月)</h2><div class="d-flex justify-content-between mb-3"><a href="{{ url_for('schedule_month', ym=prev_ym) }}" class="btn btn-outline-secondary"><i class="bi bi-chevron-left"></i> 前月</a><a href="{{ url_for('schedule_month', ym=today.strftime('%Y-%m')) }}" class="btn btn-secondary">今月</a><a href="{{ url_for('schedule_month', ym=next_ym) }}" class="btn btn-outline-secondary">翌月 <i class="bi bi-chevron-right"></i></a></div><table class="table table-bordered text-center bg-white">  <thead class="table-light"><tr><th>日</th><th>月</th><th>火</th><th>水</th><th>木</th><th>金</th><th>土</th></tr></thead>  <tbody>  {% for week in weeks %}  <tr>    {% for d in week %}      {% if d == 0 %}<td></td>      {% else %}        {% set ds = '%04d-%02d-%02d' % (year, month, d) %}        <td class="{% if today.year == year and today.month == month and today.day == d %}table-info{% endif %}">          <a href="{{ url_for('schedule_day', day_str=ds) }}" class="d-block text-decoration-none text-dark" style="min-height: 5em;">            <div class="text-end">{{ d }}</div>            {% if month_events.get(d) %}<div class="cal-day-event mx-auto">●</div>{% endif %}          </a>        </td>      {% endif %}    {% endfor %}  </tr>  {% endfor %}  </tbody></table>{% endblock %}""",
+    "schedule_month.html": """{% extends 'base.html' %}{% block body %}<h2 class="mb-4"><i class="bi bi-calendar-event"></i> 個人スケジュール ({{ year }}年 {{ month }}月)</h2><div class="d-flex justify-content-between mb-3"><a href="{{ url_for('schedule_month', ym=prev_ym) }}" class="btn btn-outline-secondary"><i class="bi bi-chevron-left"></i> 前月</a><a href="{{ url_for('schedule_month', ym=today.strftime('%Y-%m')) }}" class="btn btn-secondary">今月</a><a href="{{ url_for('schedule_month', ym=next_ym) }}" class="btn btn-outline-secondary">翌月 <i class="bi bi-chevron-right"></i></a></div><table class="table table-bordered text-center bg-white">  <thead class="table-light"><tr><th>日</th><th>月</th><th>火</th><th>水</th><th>木</th><th>金</th><th>土</th></tr></thead>  <tbody>  {% for week in weeks %}  <tr>    {% for d in week %}      {% if d == 0 %}<td></td>      {% else %}        {% set ds = '%04d-%02d-%02d' % (year, month, d) %}        <td class="{% if today.year == year and today.month == month and today.day == d %}table-info{% endif %}">          <a href="{{ url_for('schedule_day', day_str=ds) }}" class="d-block text-decoration-none text-dark" style="min-height: 5em;">            <div class="text-end">{{ d }}</div>            {% if month_events.get(d) %}<div class="cal-day-event mx-auto">●</div>{% endif %}          </a>        </td>      {% endif %}    {% endfor %}  </tr>  {% endfor %}  </tbody></table><div class="card"><div class="card-body"><h5 class="card-title">iCalendar (.ics)</h5><form action="{{ url_for('schedule_import') }}" method="post" enctype="multipart/form-data" class="d-flex gap-2 mb-2"><input type="file" name="ics" accept=".ics,text/calendar" class="form-control" required><button type="submit" class="btn btn-primary text-nowrap"><i class="bi bi-upload"></i> 取り込む</button></form><a href="{{ url_for('schedule_export') }}" class="btn btn-outline-secondary btn-sm"><i class="bi bi-download"></i> すべての予定を書き出す</a></div></div>{% endblock %}""",
     "schedule_day.html": """{% extends 'base.html' %}{% block body %}<h2 class="mb-4"><i class="bi bi-calendar-date"></i> {{ day_dt.strftime('%Y年%m月%d日 (%a)') }} の予定</h2><div class="card mb-4"><div class="card-body"><h5 class="card-title">予定を追加</h5><form action="{{ url_for('schedule_add') }}" method="post" class="d-flex gap-2"><input type="hidden" name="date" value="{{ day_str }}"><input type="time" name="time" class="form-control" style="max-width: 120px;" value="09:00"><input type="text" name="title" class="form-control" placeholder="予定を入力" required><button type="submit" class="btn btn-primary">追加</button></form></div></div><ul class="list-group">{% for event in events %}<li class="list-group-item d-flex justify-content-between align-items-center"><span><strong>{{ event.time }}</strong> - {{ event.title }}</span><form action="{{ url_for('schedule_delete') }}" method="post" onsubmit="return confirm('この予定を削除しますか？');"><input type="hidden" name="date" value="{{ day_str }}"><input type="hidden" name="event_id" value="{{ event.id }}"><button type="submit" class="btn btn-sm btn-outline-danger" title="削除"><i class="bi bi-trash"></i></button></form></li>{% else %}<li class="list-group-item">この日の予定はありません。</li>{% endfor %}</ul><a href="{{ url_for('schedule_month', ym=day_dt.strftime('%Y-%m')) }}" class="btn btn-link mt-3"><i class="bi bi-arrow-left"></i> 月表示に戻る</a>{% endblock %}""",
     "ask.html": "{% extends 'base.html' %}{% block body %}<div class='card'><div class='card-body'><h3 class='card-title'><i class='bi bi-pencil-square'></i> 新しい質問</h3><form method=post><div class='mb-3'><label class='form-label'>タイトル</label><input name=title class='form-control' required></div><div class='mb-3'><label class='form-label'>内容</label><textarea name=content class='form-control' rows=5 required></textarea></div><div class='mb-3'><label class='form-label'>タグ (カンマ区切り)</label><input name=tags class='form-control' placeholder='例: python, flask, 課題'></div><button class='btn btn-primary'><i class='bi bi-send'></i> 投稿する</button></form></div></div>{% endblock %}",
-    "question_detail.html": "{% extends 'base.html' %}{% block body %}<div class='card mb-4'><div class='card-header fw-bold'>質問</div><div class='card-body'><h3 class='card-title'>{{ q.title }}</h3><p style='white-space: pre-wrap;'>{{ q.content }}</p><p class='text-muted small'>投稿者: <a href='{{ url_for('profile', uid=q.author) }}'>{{ q.author }}</a></p>{% if q.tags %}{% for tag in q.tags %}<span class='badge bg-secondary tag'>{{ tag }}</span>{% endfor %}{% endif %}</div></div><h4><i class='bi bi-chat-dots'></i> 回答 ({{ q.answers|length }})</h4>{% for a in q.answers.values()|sort(attribute='timestamp') %}<div class='card mb-3 {% if a.id == q.best_answer_id %}border-success border-2{% endif %}'><div class='card-body'>{% if a.id == q.best_answer_id %}<span class='badge bg-success float-end'>ベストアンサー</span>{% endif %}<p style='white-space: pre-wrap;'>{{ a.content }}</p><p class='text-muted small'>回答者: <a href='{{ url_for('profile', uid=a.author) }}'>{{ a.author }}</a>{% if session.user == q.author and not q.best_answer_id %}<a href='{{ url_for('best_answer', qid=q.id, aid=a.id) }}' class='btn btn-sm btn-outline-success ms-2'><i class='bi bi-check-circle'></i> BAに選ぶ</a>{% endif %}</p></div></div>{% else %}<p>まだ回答はありません。</p>{% endfor %}{% if session.user and session.user != q.author and not q.best_answer_id %}<div class='card'><div class='card-body'><h4>回答する</h4><form method=post action='{{ url_for('answer', qid=q.id) }}'><textarea name=content class='form-control' rows=4 required></textarea><button class='btn btn-primary mt-2'><i class='bi bi-reply'></i> 回答を投稿</button></form></div></div>{% elif q.best_answer_id %}<div class='alert alert-success'>この質問は解決済みです。</div>{% endif %}<a href='{{ url_for('index') }}' class='btn btn-link mt-3'><i class='bi bi-arrow-left'></i> 質問一覧に戻る</a>{% endblock %}",
-    "reservation_home.html": "{% extends 'base.html' %}{% block body %}<h2 class='mb-4'><i class='bi bi-calendar-check'></i> 自習室予約</h2><p>予約するキャンパスを選択してください。</p><div class='row'>{% for campus_id, campus_info in campuses.items() %}<div class='col-md-6 mb-3'><div class='card h-100'><div class='card-body text-center'><h5 class='card-title'>{{ campus_info.name }}</h5><p class='card-text'>{{ campus_info.rooms }}教室 利用可能</p><a href='{{ url_for('reservation_campus_day', campus=campus_id, day_str=today) }}' class='btn btn-primary'><i class='bi bi-arrow-right-circle'></i> 今日の予約状況を見る</a></div></div></div>{% endfor %}</div>{% endblock %}",
-    "reservation_day.html": "{% extends 'base.html' %}{% block body %}<h2 class='mb-4'><i class='bi bi-calendar3'></i> {{ campus_info.name }} - {{ day_dt.strftime('%Y年%m月%d日 (%a)') }} の予約状況</h2><div class='d-flex justify-content-between mb-3'><a href='{{ url_for('reservation_campus_day', campus=campus, day_str=prev_day) }}' class='btn btn-outline-secondary'><i class='bi bi-chevron-left'></i> 前日</a><a href='{{ url_for('reservation_campus_day', campus=campus, day_str=next_day) }}' class='btn btn-outline-secondary'>翌日 <i class='bi bi-chevron-right'></i></a></div><div class='card mb-4'><div class='card-body'><h5 class='mb-3'>新規予約</h5><p>あなたの本日の総予約時間: {{ my_total_hours }} / {{ max_day_hours }} 時間</p><form method='post' action='{{ url_for('reserve') }}'><input type='hidden' name='campus' value='{{ campus }}'><input type='hidden' name='date' value='{{ day_str }}'><div class='row g-2'><div class='col-md'><select name='room' class='form-select' required><option value='' disabled selected>教室を選択</option>{% for i in range(1, campus_info.rooms + 1) %}<option value='{{ i }}'>教室 {{ i }}</option>{% endfor %}</select></div><div class='col-md'><select name='start' class='form-select' required><option value='' disabled selected>開始時間</option>{% for h in range(open_time, close_time) %}<option value='{{ h }}'>{{ h }}:00</option>{% endfor %}</select></div><div class='col-md'><select name='dur' class='form-select'><option value='1'>1時間</option><option value='2'>2時間</option></select></div><div class='col-md-auto'><button class='btn btn-primary w-100'><i class='bi bi-check2-circle'></i> 予約する</button></div></div></form></div></div><div class='table-responsive'><table class='table table-bordered text-center bg-white'><thead class='table-light'><tr><th>教室</th>{% for h in range(open_time, close_time) %}<th>{{h}}:00</th>{% endfor %}</tr></thead><tbody>{% for room_num in range(1, campus_info.rooms + 1) %}<tr><td class='fw-bold'>Room {{ room_num }}</td>{% for h in range(open_time, close_time) %}{% set res_user = day_reservations.get(room_num|string, {}).get(h|string) %}{% if res_user %}<td class='table-{{ 'success' if res_user == session.user else 'danger' }}'>{{ res_user if res_user == session.user else '予約済' }}{% if res_user == session.user %}<form method='post' action='{{ url_for('cancel') }}' class='d-inline'><input type='hidden' name='campus' value='{{ campus }}'><input type='hidden' name='room' value='{{ room_num }}'><input type='hidden' name='date' value='{{ day_str }}'><input type='hidden' name='hour' value='{{ h }}'><button type='submit' class='btn btn-xs btn-link text-danger p-0 ms-1' title='キャンセル'><i class='bi bi-x-circle-fill'></i></button></form>{% endif %}</td>{% else %}<td></td>{% endif %}{% endfor %}</tr>{% endfor %}</tbody></table></div><a href='{{ url_for('reservation_home') }}' class='btn btn-link mt-3'><i class='bi bi-arrow-left'></i> キャンパス選択に戻る</a>{% endblock %}"
+    "question_detail.html": "{% extends 'base.html' %}{% block body %}<div class='card mb-4'><div class='card-header fw-bold'>質問</div><div class='card-body'><h3 class='card-title'>{{ q.title }}</h3><p style='white-space: pre-wrap;'>{{ q.content }}</p><p class='text-muted small'>投稿者: <a href='{{ url_for('profile', uid=q.author) }}'>{{ q.author }}</a></p>{% if q.tags %}{% for tag in q.tags %}<span class='badge bg-secondary tag'>{{ tag }}</span>{% endfor %}{% endif %}</div></div><h4><i class='bi bi-chat-dots'></i> 回答 (<span id='answer-count'>{{ q.answers|length }}</span>)</h4><div id='answers' data-profile-url='{{ url_for('profile', uid='UID') }}' {% if session.user == q.author and not q.best_answer_id %}data-best-url='{{ url_for('best_answer', qid=q.id, aid='AID') }}'{% endif %}>{% for a in q.answers.values()|sort(attribute='timestamp') %}<div id='answer-{{ a.id }}' class='card mb-3 {% if a.id == q.best_answer_id %}border-success border-2{% endif %}'><div class='card-body'>{% if a.id == q.best_answer_id %}<span class='badge bg-success float-end'>ベストアンサー</span>{% endif %}<p style='white-space: pre-wrap;'>{{ a.content }}</p><p class='text-muted small'>回答者: <a href='{{ url_for('profile', uid=a.author) }}'>{{ a.author }}</a>{% if session.user == q.author and not q.best_answer_id %}<a href='{{ url_for('best_answer', qid=q.id, aid=a.id) }}' class='btn btn-sm btn-outline-success ms-2'><i class='bi bi-check-circle'></i> BAに選ぶ</a>{% endif %}</p></div></div>{% else %}<p id='no-answers'>まだ回答はありません。</p>{% endfor %}</div>{% if session.user and session.user != q.author and not q.best_answer_id %}<div class='card'><div class='card-body'><h4>回答する</h4><form method=post action='{{ url_for('answer', qid=q.id) }}'><textarea name=content class='form-control' rows=4 required></textarea><button class='btn btn-primary mt-2'><i class='bi bi-reply'></i> 回答を投稿</button></form></div></div>{% elif q.best_answer_id %}<div class='alert alert-success'>この質問は解決済みです。</div>{% endif %}<a href='{{ url_for('index') }}' class='btn btn-link mt-3'><i class='bi bi-arrow-left'></i> 質問一覧に戻る</a><script>(() => { const es = new EventSource('{{ events_url }}'), box = document.getElementById('answers'); es.addEventListener('reset', () => { es.close(); location.reload(); }); es.addEventListener('answer', e => { const a = JSON.parse(e.data); if (document.getElementById('answer-' + a.id)) return; document.getElementById('no-answers')?.remove(); const card = document.createElement('div'); card.id = 'answer-' + a.id; card.className = 'card mb-3 border-info'; const body = card.appendChild(document.createElement('div')); body.className = 'card-body'; const p = body.appendChild(document.createElement('p')); p.style.whiteSpace = 'pre-wrap'; p.textContent = a.content; const meta = body.appendChild(document.createElement('p')); meta.className = 'text-muted small'; meta.append('回答者: '); const link = meta.appendChild(document.createElement('a')); link.href = box.dataset.profileUrl.replace('UID', encodeURIComponent(a.author)); link.textContent = a.author; if (box.dataset.bestUrl) { const ba = meta.appendChild(document.createElement('a')); ba.href = box.dataset.bestUrl.replace('AID', a.id); ba.className = 'btn btn-sm btn-outline-success ms-2'; ba.textContent = 'BAに選ぶ'; } box.appendChild(card); document.getElementById('answer-count').textContent = box.querySelectorAll('[id^=answer-]').length; }); })();</script>{% endblock %}",
+    "reservation_home.html": "{% extends 'base.html' %}{% block body %}<h2 class='mb-4'><i class='bi bi-calendar-check'></i> 自習室予約</h2><p>予約するキャンパスを選択してください。</p><div class='row'>{% for campus_id, campus_info in campuses.items() %}<div class='col-md-6 mb-3'><div class='card h-100'><div class='card-body text-center'><h5 class='card-title'>{{ campus_info.name }}</h5><p class='card-text'>{{ campus_info.rooms }}教室 利用可能</p><a href='{{ url_for('reservation_campus_day', campus=campus_id, day_str=today) }}' class='btn btn-primary'><i class='bi bi-arrow-right-circle'></i> 今日の予約状況を見る</a></div></div></div>{% endfor %}</div><a href='{{ url_for('reservation_search') }}' class='btn btn-outline-primary'><i class='bi bi-search'></i> 空き枠を探す</a><div class='card mt-3'><div class='card-header fw-bold'><i class='bi bi-list-check'></i> あなたの今後の予約</div><ul class='list-group list-group-flush'>{% for r in my_reservations %}<li class='list-group-item'><a href='{{ url_for('reservation_campus_day', campus=r.campus, day_str=r.date) }}' class='text-decoration-none'>{{ r.date }} {{ r.hour }}:00 - {{ campuses[r.campus].name }} 教室 {{ r.room }}</a></li>{% else %}<li class='list-group-item text-muted'>予約はありません。</li>{% endfor %}</ul></div>{% endblock %}",
+    "leaderboard.html": "{% extends 'base.html' %}{% block body %}<h2 class='mb-4'><i class='bi bi-trophy'></i> ランキング</h2><ul class='nav nav-tabs mb-3'>{% for b, label in boards.items() %}<li class='nav-item'><a class='nav-link {% if b == board %}active{% endif %}' href='{{ url_for('leaderboard', board=b) }}'>{{ label }}</a></li>{% endfor %}</ul><div class='alert alert-light border'>あなたの順位: {% if my_rank %}<strong>{{ my_rank }}位</strong> / {{ total }}人 ({{ my_value }}){% else %}ランク外{% endif %}</div><table class='table table-striped bg-white'><thead><tr><th style='width: 5em;'>順位</th><th>ユーザー</th><th class='text-end'>{{ boards[board] }}</th></tr></thead><tbody>{% for rank, uid, value in ranking %}<tr class='{{ 'table-info' if uid == session.user else '' }}'><td>{% if rank <= 3 %}<i class='bi bi-award-fill text-warning'></i> {% endif %}{{ rank }}</td><td><a href='{{ url_for('profile', uid=uid) }}'>{{ uid }}</a></td><td class='text-end'>{{ value }}</td></tr>{% else %}<tr><td colspan='3'>まだ記録がありません。</td></tr>{% endfor %}</tbody></table>{% endblock %}",
+    "reservation_search.html": "{% extends 'base.html' %}{% block body %}<h2 class='mb-4'><i class='bi bi-search'></i> 空き枠を探す</h2><div class='card mb-4'><div class='card-body'><form method='get' class='row g-2 align-items-end'><div class='col-md-3'><label class='form-label'>キャンパス</label>{% for campus_id, campus_info in campuses.items() %}<div class='form-check'><input class='form-check-input' type='checkbox' name='campus' value='{{ campus_id }}' id='c-{{ campus_id }}' {% if campus_id in args.campuses %}checked{% endif %}><label class='form-check-label' for='c-{{ campus_id }}'>{{ campus_info.name }}</label></div>{% endfor %}</div><div class='col-md'><label class='form-label'>期間</label><div class='input-group'><input type='date' name='from' class='form-control' value='{{ args.date_from }}'><input type='date' name='to' class='form-control' value='{{ args.date_to }}'></div></div><div class='col-md-2'><label class='form-label'>時間帯</label><div class='input-group'><select name='hour_from' class='form-select'>{% for h in range(open_time, close_time) %}<option value='{{ h }}' {% if h == args.hour_from %}selected{% endif %}>{{ h }}時</option>{% endfor %}</select><select name='hour_to' class='form-select'>{% for h in range(open_time + 1, close_time + 1) %}<option value='{{ h }}' {% if h == args.hour_to %}selected{% endif %}>{{ h }}時</option>{% endfor %}</select></div></div><div class='col-md-auto'><label class='form-label'>利用時間</label><select name='dur' class='form-select'>{% for n in range(1, max_day_hours + 1) %}<option value='{{ n }}' {% if n == args.dur %}selected{% endif %}>{{ n }}時間</option>{% endfor %}</select></div><div class='col-md-auto'><button class='btn btn-primary'><i class='bi bi-search'></i> 検索</button></div></form></div></div>{% if request.args %}<ul class='list-group'>{% for slot in slots %}<li class='list-group-item d-flex justify-content-between align-items-center'><a href='{{ url_for('reservation_campus_day', campus=slot.campus, day_str=slot.date) }}' class='text-decoration-none'>{{ slot.date }} {{ slot.start }}:00〜{{ slot.start + slot.dur }}:00 - {{ campuses[slot.campus].name }} 教室 {{ slot.room }}</a><form method='post' action='{{ url_for('reserve') }}'><input type='hidden' name='campus' value='{{ slot.campus }}'><input type='hidden' name='room' value='{{ slot.room }}'><input type='hidden' name='date' value='{{ slot.date }}'><input type='hidden' name='start' value='{{ slot.start }}'><input type='hidden' name='dur' value='{{ slot.dur }}'><button class='btn btn-sm btn-primary'>予約する</button></form></li>{% else %}<li class='list-group-item'>条件に合う空き枠はありません。</li>{% endfor %}</ul>{% endif %}<a href='{{ url_for('reservation_home') }}' class='btn btn-link mt-3'><i class='bi bi-arrow-left'></i> キャンパス選択に戻る</a>{% endblock %}",
+    # 部分テンプレート (fragments でキャッシュしてからページに埋め込む)
+    "announcements.html": """{% if announcements %}<div class="mb-4"><h4 class="h5"><i class="bi bi-info-circle-fill text-primary"></i> お知らせ</h4>{% for ann in announcements %}<div class="alert alert-light border"><strong class="alert-heading">{{ ann.title }}</strong><p class="mb-0 mt-2" style="white-space: pre-wrap;">{{ ann.content }}</p><hr><p class="mb-0 text-end text-muted small">{{ (ann.publish_at or ann.timestamp).split('T')[0] }}</p></div>{% endfor %}</div>{% endif %}""",
+    "reservation_grid.html": "<div class='table-responsive'><table class='table table-bordered text-center bg-white'><thead class='table-light'><tr><th>教室</th>{% for h in range(open_time, close_time) %}<th>{{h}}:00</th>{% endfor %}</tr></thead><tbody>{% for room_num, cells in day_grid %}<tr><td class='fw-bold'>Room {{ room_num }}</td>{% for h, res_user in cells %}{% if res_user %}<td data-room='{{ room_num }}' data-hour='{{ h }}' class='table-danger'>予約済</td>{% else %}<td data-room='{{ room_num }}' data-hour='{{ h }}'></td>{% endif %}{% endfor %}</tr>{% endfor %}</tbody></table></div>",
+    "reservation_day.html": "{% extends 'base.html' %}{% block body %}<h2 class='mb-4'><i class='bi bi-calendar3'></i> {{ campus_info.name }} - {{ day_dt.strftime('%Y年%m月%d日 (%a)') }} の予約状況</h2><div class='d-flex justify-content-between mb-3'><a href='{{ url_for('reservation_campus_day', campus=campus, day_str=prev_day) }}' class='btn btn-outline-secondary'><i class='bi bi-chevron-left'></i> 前日</a><a href='{{ url_for('reservation_campus_day', campus=campus, day_str=next_day) }}' class='btn btn-outline-secondary'>翌日 <i class='bi bi-chevron-right'></i></a></div><div class='card mb-4'><div class='card-body'><h5 class='mb-3'>新規予約</h5><p>あなたの本日の総予約時間: {{ my_total_hours }} / {{ max_day_hours }} 時間</p><form method='post' action='{{ url_for('reserve') }}'><input type='hidden' name='campus' value='{{ campus }}'><input type='hidden' name='date' value='{{ day_str }}'><div class='row g-2'><div class='col-md'><select name='room' class='form-select' required><option value='' disabled selected>教室を選択</option>{% for i in range(1, campus_info.rooms + 1) %}<option value='{{ i }}'>教室 {{ i }}</option>{% endfor %}</select></div><div class='col-md'><select name='start' class='form-select' required><option value='' disabled selected>開始時間</option>{% for h in range(open_time, close_time) %}<option value='{{ h }}'>{{ h }}:00</option>{% endfor %}</select></div><div class='col-md'><select name='dur' class='form-select'><option value='1'>1時間</option><option value='2'>2時間</option></select></div><div class='col-md-auto'><button class='btn btn-primary w-100'><i class='bi bi-check2-circle'></i> 予約する</button></div></div></form></div></div><div id='grid'>{{ grid_html }}</div><div class='card'><div class='card-header fw-bold'><i class='bi bi-list-check'></i> この日のあなたの予約</div><ul class='list-group list-group-flush'>{% for room, h in my_slots %}<li class='list-group-item d-flex justify-content-between align-items-center'>{{ h }}:00 - 教室 {{ room }}<form method='post' action='{{ url_for('cancel') }}'><input type='hidden' name='campus' value='{{ campus }}'><input type='hidden' name='room' value='{{ room }}'><input type='hidden' name='date' value='{{ day_str }}'><input type='hidden' name='hour' value='{{ h }}'><button type='submit' class='btn btn-sm btn-outline-danger'><i class='bi bi-x-circle'></i> キャンセル</button></form></li>{% else %}<li class='list-group-item text-muted'>予約はありません。</li>{% endfor %}</ul></div><a href='{{ url_for('reservation_home') }}' class='btn btn-link mt-3'><i class='bi bi-arrow-left'></i> キャンパス選択に戻る</a><script>(() => { for (const [room, hour] of {{ my_slots|tojson }}) { const td = document.querySelector(`#grid td[data-room='${room}'][data-hour='${hour}']`); if (td) { td.className = 'table-success'; td.textContent = {{ session.user|tojson }}; } } const es = new EventSource('{{ events_url }}'); es.addEventListener('reset', () => { es.close(); location.reload(); }); es.addEventListener('slots', e => { for (const [room, hour, taken] of JSON.parse(e.data).slots) { const td = document.querySelector(`#grid td[data-room='${room}'][data-hour='${hour}']`); if (!td || (taken && td.classList.contains('table-success'))) continue; td.className = taken ? 'table-danger' : ''; td.textContent = taken ? '予約済' : ''; } }); })();</script>{% endblock %}"
 }
 app.jinja_loader = ChoiceLoader([app.jinja_loader, DictLoader(ALL_HTMLS)])
 
 # ───────── 5. Manager Instances & Jinja Globals ─────────
-um = UserManager()
-pm = PostManager()
-rs = ReservationSystem()
-anm = AnnouncementManager()
-schm = ScheduleManager()
-app.jinja_env.globals.update(um=um, titles=TITLES, violation_limit=VIOLATION_LIMIT, campuses=CAMPUSES,
-                             shop_titles=SHOP_TITLES, themes=PROFILE_THEMES)
+store = open_store()
+um = UserManager(store); auth = AuthPipeline(um)
+pm = PostManager(store)
+rs = ReservationSystem(store)
+anm = AnnouncementManager(store)
+schm = ScheduleManager(store)
+app.jinja_env.globals.update(um=um, titles=um.titles, violation_limit=VIOLATION_LIMIT, campuses=CAMPUSES,
+                             shop_titles=SHOP_TITLES, themes=PROFILE_THEMES, question_statuses=QUESTION_STATUSES)
+# テンプレートは起動時にすべてコンパイルし、バイトコードをディスクに残して次回以降の起動 (や他のワーカープロセス) で使い回す
+if TEMPLATE_CACHE_DIR:
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True); app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+for name in ALL_HTMLS: app.jinja_env.get_template(name)
+class FragmentCache:
+    """描画済みのHTML片を、データの版数を含むキーで覚える LRU。版数が変われば別のキーになるので明示的な無効化は要らない。"""
+    def __init__(self, size): self.size, self._items, self._lock = size, OrderedDict(), threading.Lock()
+    def get(self, key, render):
+        with self._lock:
+            if key in self._items: self._items.move_to_end(key); return self._items[key]
+        html = Markup(render())
+        with self._lock:
+            self._items[key] = html
+            if len(self._items) > self.size: self._items.popitem(last=False)
+        return html
+fragments = FragmentCache(FRAGMENT_CACHE_SIZE)
+class Subscription:
+    def __init__(self, topic): self.topic, self._events, self._cond, self._waker = topic, deque(), threading.Condition(), None
+    def push(self, event):
+        with self._cond:
+            if len(self._events) >= EVENT_QUEUE_SIZE: self._events.clear(); event = ("reset", None, {})  # 読み切れない購読者には差分を諦めて読み直させる
+            self._events.append(event); self._cond.notify()
+            if self._waker: self._waker()
+    def get(self, timeout):
+        """(イベント名, 版数, データ) か、timeout 秒何も来なければ None"""
+        with self._cond:
+            if not self._events: self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+    async def aget(self, timeout):
+        """get() のイベントループ版。待っている間スレッドを占有しない (ASGI のライブ更新用)。"""
+        loop, ready = asyncio.get_running_loop(), asyncio.Event()
+        with self._cond:
+            if self._events: return self._events.popleft()
+            self._waker = lambda: loop.call_soon_threadsafe(ready.set)
+        try: await asyncio.wait_for(ready.wait(), timeout)
+        except asyncio.TimeoutError: pass
+        finally:
+            with self._cond: self._waker = None
+        with self._cond: return self._events.popleft() if self._events else None
+class EventBus:
+    """トピック ("reservations/<campus>/<日付>" や "question/<qid>") ごとの購読者に、ページ全体ではなく変更の差分を配る。
+    複数プロセス運用時は、購読者がいる間だけ他プロセスの変更を定期的に取り込み (store.sync)、その通知も配る。"""
+    def __init__(self, store):
+        self.store, self._subs, self._lock, self._poller = store, defaultdict(set), threading.Lock(), None
+    def subscribe(self, topic):
+        sub = Subscription(topic)
+        with self._lock:
+            self._subs[topic].add(sub)
+            if self.store.shared and not self._poller:
+                self._poller = threading.Thread(target=self._poll, daemon=True, name="event-poller"); self._poller.start()
+        return sub
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs[sub.topic].discard(sub)
+            if not self._subs[sub.topic]: del self._subs[sub.topic]
+    def publish(self, topic, name, version, data):
+        with self._lock: subs = list(self._subs.get(topic, ()))
+        for sub in subs: sub.push((name, version, data))
+    def subscribers(self):
+        with self._lock: return sum(map(len, self._subs.values()))
+    def _poll(self):
+        while True:
+            time.sleep(EVENT_POLL_INTERVAL)
+            if self.subscribers():
+                try: self.store.sync()
+                except Exception as e: print(f" * 他プロセスの変更の取り込みに失敗しました: {e}", file=sys.stderr)
+def event_version(version): return ".".join(map(str, version))
+bus = EventBus(store)
+rs.on_change.append(lambda campus, d_str, slots, version: bus.publish(f"reservations/{campus}/{d_str}", "slots", version, {"slots": slots}))
+pm.on_answer.append(lambda qid, a, version: bus.publish(f"question/{qid}", "answer", version, {k: a[k] for k in ("id", "author", "content", "timestamp")}))
+def prom_labels(**labels):
+    escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+class Metrics:
+    """ルートごとの処理時間の内訳を集計する (PORTAL_METRICS=1 のときだけ使う)。
+    計測区間は入れ子になりうる (テンプレートからマネージャーを呼ぶなど) ので、各区間には内側の区間を除いた時間だけを足す。"""
+    PHASES = ("manager", "io", "render")
+    def __init__(self):
+        self._lock, self._local = threading.Lock(), threading.local()
+        self._requests = defaultdict(lambda: [0] * (len(METRICS_BUCKETS) + 1) + [0.0])  # (route, method) → バケットごとの件数..., +Inf, 合計秒
+        self._phases, self._io, self._calls, self._slow = Counter(), Counter(), Counter(), Counter()
+        self._active, self._wake = {}, threading.Event()  # 処理中のリクエストのスレッド → 採ったスタックの Counter
+        threading.Thread(target=self._sampler, name="metrics-sampler", daemon=True).start()
+    @contextmanager
+    def section(self, phase, name=None):
+        stack = self._local.__dict__.setdefault("stack", [])
+        t0 = time.perf_counter(); stack.append(0.0)
+        try: yield
+        finally:
+            elapsed = time.perf_counter() - t0; own = elapsed - stack.pop()
+            if stack: stack[-1] += elapsed
+            rec = getattr(self._local, "rec", None)
+            if rec is not None: rec[phase] += own
+            if name:
+                with self._lock: self._calls[(name, "seconds")] += own; self._calls[(name, "calls")] += 1
+    def timed(self, phase, func, name=None):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.section(phase, name): return func(*args, **kwargs)
+        return wrapper
+    def instrument(self, obj, prefix):
+        """公開メソッドをインスタンス属性で包み、呼び出しを "manager" の時間として数える。"""
+        for name in dir(type(obj)):
+            if not name.startswith("_") and callable(getattr(obj, name)): setattr(obj, name, self.timed("manager", getattr(obj, name), f"{prefix}.{name}"))
+    def instrument_store(self, store):
+        write_batch = store._write_batch
+        def timed_write_batch(items):
+            size = sum(len(_dumps(rec)) for rec in items.values() if rec is not None)
+            with self.section("io"): write_batch(items)
+            rec = getattr(self._local, "rec", None)
+            if rec is not None: rec["bytes"] += size; rec["writes"] += 1
+            else:  # PORTAL_ASYNC_WRITES の書き込みスレッドなど、リクエストの外での書き込み
+                with self._lock: self._io[("(background)", "bytes")] += size; self._io[("(background)", "writes")] += 1
+        store._write_batch = timed_write_batch
+    def middleware(self, wsgi_app):
+        def instrumented(environ, start_response):
+            rec = self._local.rec = environ["portal.metrics"] = Counter(); stacks = Counter(); ident = threading.get_ident()
+            with self._lock: self._active[ident] = stacks; self._wake.set()
+            t0 = time.perf_counter()
+            try: return wsgi_app(environ, start_response)  # Flask はここで teardown (= ストアへの書き込み) まで済ませて返る
+            finally:
+                elapsed = time.perf_counter() - t0; self._local.rec = None
+                with self._lock: self._active.pop(ident, None)
+                route = environ.get("portal.route", "(unmatched)")
+                self.observe(route, environ.get("REQUEST_METHOD", ""), elapsed, rec)
+                if elapsed * 1000 >= SLOW_REQUEST_MS: self.dump_profile(route, elapsed, stacks)
+        return instrumented
+    def observe(self, route, method, elapsed, rec):
+        with self._lock:
+            counts = self._requests[(route, method)]
+            counts[bisect.bisect_left(METRICS_BUCKETS, elapsed)] += 1; counts[-1] += elapsed
+            for phase in self.PHASES: self._phases[(route, method, phase)] += rec[phase]
+            self._phases[(route, method, "other")] += max(elapsed - sum(rec[phase] for phase in self.PHASES), 0.0)
+            self._io[(route, "bytes")] += rec["bytes"]; self._io[(route, "writes")] += rec["writes"]
+            if elapsed * 1000 >= SLOW_REQUEST_MS: self._slow[route] += 1
+    def _sampler(self):
+        while True:
+            with self._lock:
+                active = list(self._active.items())
+                if not active: self._wake.clear()
+            if not active: self._wake.wait(); continue  # 処理中のリクエストがなければ眠っておく
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+            frames = sys._current_frames()
+            for ident, stacks in active:
+                frame, names = frames.get(ident), []
+                while frame: names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"); frame = frame.f_back
+                if names: stacks[";".join(reversed(names))] += 1
+    def dump_profile(self, route, elapsed, stacks):
+        if not stacks: return  # サンプル間隔より短かった
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{int(elapsed * 1000)}ms-{re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'}.txt"
+        with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as f:
+            for stack, n in stacks.most_common(): f.write(f"{stack} {n}\n")
+        for old in sorted(os.listdir(PROFILE_DIR))[:-PROFILE_KEEP]: os.remove(os.path.join(PROFILE_DIR, old))
+    def prometheus(self):
+        with self._lock: requests, phases, io, calls, slow = {k: list(v) for k, v in self._requests.items()}, dict(self._phases), dict(self._io), dict(self._calls), dict(self._slow)
+        lines = ["# HELP portal_request_duration_seconds リクエストの処理時間", "# TYPE portal_request_duration_seconds histogram"]
+        for (route, method), counts in sorted(requests.items()):
+            total = 0
+            for le, n in zip([*METRICS_BUCKETS, "+Inf"], counts):
+                total += n; lines.append(f"portal_request_duration_seconds_bucket{prom_labels(route=route, method=method, le=le)} {total}")
+            lines += [f"portal_request_duration_seconds_sum{prom_labels(route=route, method=method)} {counts[-1]:.6f}", f"portal_request_duration_seconds_count{prom_labels(route=route, method=method)} {total}"]
+        lines += ["# HELP portal_request_phase_seconds_total リクエスト時間の内訳 (manager / io / render / other)", "# TYPE portal_request_phase_seconds_total counter"]
+        lines += [f"portal_request_phase_seconds_total{prom_labels(route=route, method=method, phase=phase)} {v:.6f}" for (route, method, phase), v in sorted(phases.items())]
+        lines += ["# HELP portal_store_write_bytes_total ストアに書き込んだレコードのバイト数", "# TYPE portal_store_write_bytes_total counter"]
+        lines += [f"portal_store_write_bytes_total{prom_labels(route=route)} {v}" for (route, kind), v in sorted(io.items()) if kind == "bytes"]
+        lines += ["# HELP portal_store_writes_total ストアへの書き込み (バッチ) の回数", "# TYPE portal_store_writes_total counter"]
+        lines += [f"portal_store_writes_total{prom_labels(route=route)} {v}" for (route, kind), v in sorted(io.items()) if kind == "writes"]
+        lines += ["# HELP portal_manager_call_seconds_total マネージャーのメソッドごとの時間 (内側の計測区間を除く)", "# TYPE portal_manager_call_seconds_total counter"]
+        lines += [f"portal_manager_call_seconds_total{prom_labels(method=name)} {v:.6f}" for (name, kind), v in sorted(calls.items()) if kind == "seconds"]
+        lines += ["# HELP portal_manager_calls_total マネージャーのメソッドの呼び出し回数", "# TYPE portal_manager_calls_total counter"]
+        lines += [f"portal_manager_calls_total{prom_labels(method=name)} {v}" for (name, kind), v in sorted(calls.items()) if kind == "calls"]
+        lines += [f"# HELP portal_slow_requests_total {SLOW_REQUEST_MS:g}ms を超えたリクエストの数", "# TYPE portal_slow_requests_total counter"]
+        lines += [f"portal_slow_requests_total{prom_labels(route=route)} {v}" for route, v in sorted(slow.items())]
+        return "\n".join(lines) + "\n"
+metrics = Metrics() if METRICS else None
+if metrics:
+    for manager, prefix in ((um, "um"), (auth, "auth"), (pm, "pm"), (rs, "rs"), (anm, "anm"), (schm, "schm")): metrics.instrument(manager, prefix)
+    metrics.instrument_store(store); render_template = metrics.timed("render", render_template)
+    app.wsgi_app = metrics.middleware(app.wsgi_app)
+    @app.before_request
+    def name_route(): request.environ["portal.route"] = request.url_rule.rule if request.url_rule else "(unmatched)"
+
+# リクエスト単位のユニットオブワーク: ハンドラ内の複数回の _save() はリクエスト終了時の1回の書き込みにまとまる
+# 複数プロセス運用時は、先に他プロセスの変更を取り込み、更新系リクエストはプロセス間で直列化する
+MUTATING_GET_ENDPOINTS = {"best_answer"}
+def needs_exclusive():
+    if request.endpoint == "login" and request.method == "POST":
+        # ログインが書き込むのはハッシュの作り直しだけなので、それが要らなければ他プロセスを止めずにパスワードを検証する
+        user = um.get_user(request.form.get("uid", "")); return bool(user) and not password_is_current(user["pw"])
+    return request.method not in ("GET", "HEAD") or request.endpoint in MUTATING_GET_ENDPOINTS
+@app.before_request
+def begin_unit_of_work():
+    if store.shared and needs_exclusive():
+        store.acquire_exclusive(); g.portal_exclusive = True
+    store.sync(); store.begin()
+def ensure_exclusive():
+    """排他を取らずに始まったリクエスト (GET) が途中で書き込むことになったとき、書き込む前に呼ぶ。
+    排他を取ってから他プロセスの変更を取り込み直すので、その後に読んだ値で書けば他プロセスの更新を上書きしない。"""
+    if store.shared and not g.get("portal_exclusive"):
+        store.acquire_exclusive(); g.portal_exclusive = True; store.sync()
+@app.teardown_request
+def commit_unit_of_work(exc):
+    try: store.commit()
+    finally:
+        if g.pop("portal_exclusive", False): store.release_exclusive()
 
 # (Decorators and Routes are defined below)
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "user" not in session: flash("ログインが必要です", "warning"); return redirect(url_for("login"))
-        user = um.get_user(session["user"])
-        if not user or user["status"] == "banned":
+        if not auth.session_ok(session["user"]):
             flash("アカウントが利用停止中です", "danger"); session.pop("user", None); return redirect(url_for("login"))
         return f(*args, **kwargs)
     return decorated_function
@@ -513,13 +1752,21 @@ def admin_required(f):
     return decorated_function
 
 # ───────── Routes ─────────
+@app.route("/metrics")
+def metrics_endpoint():
+    if not metrics: abort(404)
+    token_ok = METRICS_TOKEN and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+    if not token_ok and ("user" not in session or not um.is_admin(session["user"])): abort(403)
+    return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         uid, pw = request.form["uid"], request.form["pw"]
-        if um.verify(uid, pw):
-            if um.get_user(uid)["status"] == "banned": flash("このアカウントは利用停止中です", "danger"); return redirect(url_for("login"))
-            session["user"] = uid; return redirect(url_for("index"))
+        outcome = auth.login(uid, pw, request.remote_addr or "")
+        if outcome == "limited":
+            flash("ログインの試行が多すぎます。しばらく待ってからもう一度お試しください", "danger"); return render_template("login_register.html", title="ログイン"), 429
+        if outcome == "banned": flash("このアカウントは利用停止中です", "danger"); return redirect(url_for("login"))
+        if outcome == "ok": session["user"] = uid; return redirect(url_for("index"))
         flash("ユーザIDまたはパスワードが違います", "danger")
     return render_template("login_register.html", title="ログイン")
 @app.route("/register", methods=["GET", "POST"])
@@ -531,12 +1778,46 @@ def register():
     return render_template("login_register.html", title="新規登録")
 @app.route("/logout")
 def logout(): session.pop("user", None); return redirect(url_for("login"))
+ETAG_SALT = uuid.uuid4().hex  # 版数はプロセスごとに数えるので、別プロセス (や再起動前) の同じ版数の ETag とは一致させない
+def not_modified(*parts):
+    """ページが依存するデータの版数 parts と閲覧者から強い ETag を作る。If-None-Match と一致すればテンプレートを使わずに 304 を返す。"""
+    if session.get("_flashes"): return None  # flash は一度しか表示しないので、この応答はキャッシュさせない
+    viewer = session.get("user")  # ナビバーのポイント・テーマなど、どのページも閲覧者のユーザー情報に依存する
+    g.etag = hashlib.sha1(repr((ETAG_SALT, request.endpoint, request.view_args, viewer, um.version(viewer)) + parts).encode()).hexdigest()
+    if request.if_none_match.contains(g.etag):
+        resp = app.response_class(status=304); resp.set_etag(g.etag); resp.headers["Cache-Control"] = "private, no-cache"; return resp
+@app.after_request
+def add_etag(response):
+    if g.get("etag") and response.status_code == 200:
+        response.set_etag(g.etag); response.headers["Cache-Control"] = "private, no-cache"  # 毎回 If-None-Match で確認させる
+    return response
+def encode_cursor(key): return None if key is None else base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+def decode_cursor(s, ranked=False):
+    """ranked (キーワード検索) なら [score, timestamp, qid]、それ以外は [timestamp, qid] の形でなければ 400。"""
+    if not s: return None
+    try: key = json.loads(base64.urlsafe_b64decode(s.encode()))
+    except ValueError: abort(400)
+    head = [(int, float)] if ranked else []
+    if not isinstance(key, list) or len(key) != len(head) + 2 or not all(isinstance(x, str) for x in key[-2:]): abort(400)
+    if ranked and (isinstance(key[0], bool) or not isinstance(key[0], (int, float))): abort(400)
+    return key
+def question_page_args():
+    a = request.args; keyword = a.get('keyword', '')
+    return dict(keyword=keyword, tag=a.get('tag', ''), status=a.get('status', ''), cursor=decode_cursor(a.get('cursor'), ranked=bool(keyword.strip())))
 @app.route("/")
 @login_required
 def index():
-    announcements = anm.get_all()[:3]
-    questions = pm.search_questions(request.args.get('keyword', ''), request.args.get('tag', ''))
-    return render_template("index.html", questions=questions, announcements=announcements)
+    announcements = anm.current()  # 公開開始・終了の時刻をまたいだときは先に version が進む
+    announcements_html = fragments.get(("announcements", anm.version), lambda: render_template("announcements.html", announcements=announcements))
+    questions, next_cursor = pm.list_page(**question_page_args())
+    return render_template("index.html", questions=questions, announcements_html=announcements_html, next_cursor=encode_cursor(next_cursor),
+                           upcoming=schm.upcoming(session["user"], UPCOMING_EVENTS))
+@app.route("/api/questions")
+@login_required
+def api_questions():
+    limit = min(max(request.args.get('limit', QUESTIONS_PER_PAGE, type=int), 1), API_MAX_PAGE_SIZE)
+    questions, next_cursor = pm.list_page(**question_page_args(), limit=limit)
+    return jsonify({"questions": [pm.summary(q) for q in questions], "next_cursor": encode_cursor(next_cursor)})
 @app.route("/ask", methods=["GET", "POST"])
 @login_required
 def ask():
@@ -551,7 +1832,7 @@ def ask():
 def question_detail(qid):
     question = pm.get_question(qid)
     if not question: abort(404)
-    return render_template("question_detail.html", q=question)
+    return not_modified(pm.version(qid)) or render_template("question_detail.html", q=question, events_url=url_for("question_events", qid=qid, since=event_version(pm.version(qid))))
 @app.route("/answer/<qid>", methods=["POST"])
 @login_required
 def answer(qid):
@@ -575,20 +1856,79 @@ def best_answer(qid, aid):
 @app.route("/reservations")
 @login_required
 def reservation_home():
-    return render_template("reservation_home.html", today=date.today().strftime("%Y-%m-%d"))
+    today = date.today().strftime("%Y-%m-%d")
+    return render_template("reservation_home.html", today=today, my_reservations=rs.get_user_reservations(session["user"], from_date=today))
+def slot_search_args():
+    a = request.args; today = date.today()
+    campuses = [c for c in a.getlist("campus") if c in CAMPUSES] or list(CAMPUSES)
+    try:
+        date_from = datetime.strptime(a["from"], "%Y-%m-%d").date() if a.get("from") else today
+        date_to = datetime.strptime(a["to"], "%Y-%m-%d").date() if a.get("to") else date_from + timedelta(days=6)
+    except ValueError: abort(400)
+    date_to = min(date_to, date_from + timedelta(days=SLOT_SEARCH_MAX_DAYS - 1))
+    return dict(campuses=campuses, date_from=date_from, date_to=date_to, dur=min(max(a.get("dur", 1, type=int), 1), MAX_HOURS_PER_DAY),
+                hour_from=a.get("hour_from", OPEN_TIME, type=int), hour_to=a.get("hour_to", CLOSE_TIME, type=int),
+                limit=min(max(a.get("limit", 10, type=int), 1), API_MAX_PAGE_SIZE))
+@app.route("/reservations/search")
+@login_required
+def reservation_search():
+    args = slot_search_args()
+    slots = rs.find_slots(session["user"], **args) if request.args else []
+    return render_template("reservation_search.html", slots=slots, args=args, open_time=OPEN_TIME, close_time=CLOSE_TIME, max_day_hours=MAX_HOURS_PER_DAY)
+@app.route("/api/reservations/search")
+@login_required
+def api_reservation_search():
+    return jsonify({"slots": rs.find_slots(session["user"], **slot_search_args())})
 @app.route("/reservations/<campus>/<day_str>")
 @login_required
 def reservation_campus_day(campus, day_str):
     if campus not in CAMPUSES: abort(404)
     try: day_dt = datetime.strptime(day_str, "%Y-%m-%d").date()
     except ValueError: abort(400)
-    day_reservations = rs.get_day_reservations(campus, day_str)
-    my_total_hours = rs.get_user_reservations_for_day(day_str, session['user'])
+    my_total_hours = rs.get_user_reservations_for_day(day_str, session['user'])  # 他キャンパスの予約でも変わるので ETag に含める
+    resp = not_modified(rs.version(campus, day_str), my_total_hours)
+    if resp: return resp
+    # 予約表は全員で同じもの (予約者を出さない) を (日付, キャンパス) の版数ごとに1回だけ描画し、自分の予約はページ側で重ねる
+    my_slots = [(int(r["room"]), r["hour"]) for r in rs.get_user_reservations(session['user'], from_date=day_str) if r["date"] == day_str and r["campus"] == campus]
+    grid_html = fragments.get(("reservation_grid", campus, day_str, rs.version(campus, day_str)),
+                              lambda: render_template("reservation_grid.html", campus=campus, day_str=day_str, day_grid=rs.day_matrix(campus, day_str),
+                                                      open_time=OPEN_TIME, close_time=CLOSE_TIME))
     return render_template("reservation_day.html", campus=campus, campus_info=CAMPUSES[campus], day_str=day_str, day_dt=day_dt,
-                           day_reservations=day_reservations, my_total_hours=my_total_hours, max_day_hours=MAX_HOURS_PER_DAY,
+                           grid_html=grid_html, my_slots=my_slots, events_url=url_for("reservation_events", campus=campus, day_str=day_str, since=event_version(rs.version(campus, day_str))), my_total_hours=my_total_hours, max_day_hours=MAX_HOURS_PER_DAY,
                            open_time=OPEN_TIME, close_time=CLOSE_TIME,
                            prev_day=(day_dt - timedelta(days=1)).strftime("%Y-%m-%d"),
                            next_day=(day_dt + timedelta(days=1)).strftime("%Y-%m-%d"))
+def event_stream(topic, current_version):
+    """Server-Sent Events の応答。接続時に ?since= (ページを描画したときの版数) か再接続時の Last-Event-ID が現在の版数と違えば、
+    取りこぼしがあるので reset を送ってページを読み直させる。以降は差分を送り、EVENT_KEEPALIVE 秒ごとにコメントで接続を確かめる。"""
+    since = request.headers.get("Last-Event-ID") or request.args.get("since")
+    sub = bus.subscribe(topic)  # 版数を比べる前に購読しておき、その間の変更を取りこぼさない
+    stale = since != event_version(current_version())
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    native = request.environ.get("portal.event_stream")
+    if native is not None:  # ASGI: 配信はスレッドを使わずイベントループで行う (asgi_app)
+        native.update(sub=sub, stale=stale); return Response(mimetype="text/event-stream", headers=headers)
+    def stream():
+        try:
+            if stale: yield sse_message(("reset", None, {}))
+            while True: yield sse_message(sub.get(EVENT_KEEPALIVE))
+        finally: bus.unsubscribe(sub)  # クライアントが切断すると書き込みに失敗してここに来る
+    return Response(stream(), mimetype="text/event-stream", headers=headers)
+def sse_message(event):
+    """(イベント名, 版数, データ) を Server-Sent Events の1件にする (None は接続確認のコメント)。"""
+    if event is None: return ": keepalive\n\n"
+    name, version, data = event
+    return (f"id: {event_version(version)}\n" if version else "") + f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+@app.route("/events/reservations/<campus>/<day_str>")
+@login_required
+def reservation_events(campus, day_str):
+    if campus not in CAMPUSES: abort(404)
+    return event_stream(f"reservations/{campus}/{day_str}", lambda: rs.version(campus, day_str))
+@app.route("/events/question/<qid>")
+@login_required
+def question_events(qid):
+    if not pm.get_question(qid): abort(404)
+    return event_stream(f"question/{qid}", lambda: pm.version(qid))
 @app.route("/reservations/reserve", methods=["POST"])
 @login_required
 def reserve():
@@ -612,35 +1952,85 @@ def cancel():
 def profile(uid):
     user_data = um.get_user(uid)
     if not user_data: abort(404)
-    return render_template("profile.html", p_user={"uid": uid, "data": user_data})
+    return not_modified(um.version(uid), um.titles_version) or render_template("profile.html", p_user={"uid": uid, "data": user_data})
 @app.route("/admin")
 @admin_required
-def admin(): return render_template("admin.html", users=um.users, announcements=anm.get_all())
+def admin():
+    a, offset = request.args, max(request.args.get("offset", 0, type=int), 0)
+    filters = dict(sort=a.get("sort") if a.get("sort") in ADMIN_SORTS else "uid", desc=a.get("order") == "desc", status=a.get("status", ""), prefix=a.get("q", "").strip(),
+                   points=(a.get("pmin", type=int), a.get("pmax", type=int)), vio=(a.get("vmin", type=int), a.get("vmax", type=int)))
+    users, has_next = um.admin_page(**filters, offset=offset)
+    page_url = lambda off: url_for("admin", **{**a.to_dict(), "offset": off})
+    return render_template("admin.html", users=users, status_counts=um.status_counts(), admin_sorts=ADMIN_SORTS, bulk_actions=ADMIN_BULK_ACTIONS,
+                           prev_url=page_url(max(offset - ADMIN_PAGE_SIZE, 0)) if offset else None, next_url=page_url(offset + ADMIN_PAGE_SIZE) if has_next else None,
+                           announcements=anm.get_all(), announcement_state=anm.state, now=datetime.now().isoformat(),
+                           custom_titles={t: c for t, c in um.titles.items() if t not in TITLES}, title_counters=TITLE_COUNTERS)
+def admin_return():
+    # 操作後は絞り込み・ページ位置を保ったまま一覧に戻る (管理画面以外へは戻さない)
+    back = request.form.get("next", "")
+    return redirect(back if back.startswith("/admin") else url_for("admin"))
 @app.route("/admin/user_action", methods=["POST"])
 @admin_required
 def admin_user_action():
     uid, act = request.form["uid"], request.form["act"]
-    if uid == 'admin': flash("管理者アカウントは操作できません", "danger"); return redirect(url_for("admin"))
+    if uid == 'admin': flash("管理者アカウントは操作できません", "danger"); return admin_return()
     if act == "ban": um.toggle_ban(uid); flash(f"{uid}の状態を変更しました", "info")
     elif act == "vio_add": um.adjust_violation(uid, 1)
     elif act == "vio_sub": um.adjust_violation(uid, -1)
-    elif act == "adjust_points": um.add_points(uid, int(request.form.get("points", 0))); flash(f"{uid}のポイントを調整しました", "info")
+    elif act == "adjust_points": um.add_points(uid, int(request.form.get("points", 0)), kind="admin"); flash(f"{uid}のポイントを調整しました", "info")
+    return admin_return()
+@app.route("/admin/bulk_action", methods=["POST"])
+@admin_required
+def admin_bulk_action():
+    uids, act = request.form.getlist("uids"), request.form.get("act")
+    if act not in ADMIN_BULK_ACTIONS or not uids: flash("対象のユーザーと操作を選んでください", "warning")
+    else:
+        n = um.bulk_action(uids, act, request.form.get("points", 0, type=int)); flash(f"{n}人に「{ADMIN_BULK_ACTIONS[act]}」を適用しました", "info")
+    return admin_return()
+@app.route("/admin/auth_metrics")
+@admin_required
+def admin_auth_metrics(): return jsonify(auth.metrics())
+@app.route("/admin/ledger_action", methods=["POST"])
+@admin_required
+def admin_ledger_action():
+    if not um.ledger_enabled: flash("PORTAL_STORAGE=sqlite 以外ではポイント台帳を記録していません", "warning"); return redirect(url_for("admin"))
+    fix = request.form.get("act") == "fix"; mismatched = um.reconcile(fix=fix)
+    if not mismatched: flash("ポイント台帳と残高はすべて一致しています", "success")
+    else:
+        detail = ", ".join(f"{uid}: {cached}→{balance}" for uid, cached, balance in mismatched[:10]) + (" ほか" if len(mismatched) > 10 else "")
+        flash(f"{len(mismatched)}人の残高が台帳と一致{'していなかったため修正しました' if fix else 'しません'} ({detail})", "warning")
     return redirect(url_for("admin"))
 @app.route("/admin/announcement_action", methods=["POST"])
 @admin_required
 def admin_announcement_action():
     act = request.form.get("act")
     if act == "add":
-        anm.add(request.form["title"], request.form["content"]); flash("お知らせを追加しました", "success")
+        try: publish_at, expires_at = (datetime.fromisoformat(v).isoformat() if v else None for v in (request.form.get("publish_at"), request.form.get("expires_at")))
+        except ValueError: flash("公開日時の形式が正しくありません", "danger"); return redirect(url_for("admin"))
+        if publish_at and expires_at and expires_at <= publish_at: flash("公開終了は公開開始より後にしてください", "danger"); return redirect(url_for("admin"))
+        anm.add(request.form["title"], request.form["content"], publish_at, expires_at); flash("お知らせを追加しました", "success")
     elif act == "delete":
         anm.delete(request.form["ann_id"]); flash("お知らせを削除しました", "info")
     return redirect(url_for("admin"))
+@app.route("/admin/title_action", methods=["POST"])
+@admin_required
+def admin_title_action():
+    act, name = request.form.get("act"), request.form.get("name", "").strip()
+    if act == "add":
+        try: value = int(request.form["value"])
+        except ValueError: flash("条件の値は整数で入力してください", "danger"); return redirect(url_for("admin"))
+        ok, msg = um.add_title(name, request.form["counter"], value, request.form.get("desc", "").strip()); flash(msg, "success" if ok else "danger")
+    elif act == "delete":
+        if um.delete_title(name): flash(f"称号「{name}」を削除しました", "info")
+    return redirect(url_for("admin"))
 @app.route("/schedule")
 @app.route("/schedule/<ym>")
 @login_required
 def schedule_month(ym=None):
     if ym is None: ym = date.today().strftime("%Y-%m")
     year, month = map(int, ym.split('-'))
+    resp = not_modified(schm.version(session['user'], f"{year:04d}-{month:02d}"), date.today())  # 今日の強調表示も日付が変われば変わる
+    if resp: return resp
     cal = calendar.Calendar(firstweekday=6); weeks = cal.monthdayscalendar(year, month)
     month_events = schm.get_user_schedule_for_month(session['user'], year, month)
     today = date.today(); prev_dt = (date(year, month, 1) - timedelta(days=1)); next_dt = (date(year, month, 1) + timedelta(days=32)).replace(day=1)
@@ -665,6 +2055,26 @@ def schedule_delete():
     d_str, event_id = request.form["date"], request.form["event_id"]
     schm.delete(session['user'], d_str, event_id)
     return redirect(url_for("schedule_day", day_str=d_str))
+@app.route("/schedule/import", methods=["POST"])
+@login_required
+def schedule_import():
+    f = request.files.get("ics")
+    if not f or not f.filename: flash("ファイルを選択してください", "warning"); return redirect(url_for("schedule_month"))
+    events = []
+    try:  # 全件を検証してから1回のバッチで書き込む (途中で不正な予定があれば1件も取り込まない)
+        for event in parse_ics(io.TextIOWrapper(f.stream, encoding="utf-8-sig")):
+            events.append(event)
+            if len(events) > ICS_IMPORT_MAX_EVENTS: raise ValueError(f"予定が多すぎます (上限 {ICS_IMPORT_MAX_EVENTS} 件)")
+    except (ValueError, UnicodeDecodeError, OverflowError) as e:  # OverflowError: 日付が datetime の範囲 (1〜9999年) を出た
+        flash(f"取り込めませんでした: {e}", "danger"); return redirect(url_for("schedule_month"))
+    added = schm.add_many(session["user"], events)
+    flash(f"{added}件の予定を取り込みました" + (f" (登録済みの{len(events) - added}件は飛ばしました)" if len(events) > added else ""), "success")
+    return redirect(url_for("schedule_month", ym=events[0][0][:7]) if events else url_for("schedule_month"))
+@app.route("/schedule/export.ics")
+@login_required
+def schedule_export():
+    return Response(ics_export(schm.iter_events(session["user"])), mimetype="text/calendar",
+                    headers={"Content-Disposition": 'attachment; filename="schedule.ics"'})
 @app.route("/shop")
 @login_required
 def shop():
@@ -713,15 +2123,75 @@ def game_submit_score():
     points_earned = min(500, score // 10)
     if points_earned > 0:
         um.add_points(session['user'], points_earned)
-    return jsonify({"status": "success", "points_earned": points_earned})
+    best = um.submit_score(session['user'], data.get("game", "tetris"), score)
+    return jsonify({"status": "success", "points_earned": points_earned, "best": best})
+@app.route("/leaderboard")
+@app.route("/leaderboard/<board>")
+@login_required
+def leaderboard(board="points"):
+    if board not in LEADERBOARDS: abort(404)
+    lb = um.boards[board]
+    return render_template("leaderboard.html", board=board, ranking=lb.top(LEADERBOARD_SIZE), my_rank=lb.rank(session["user"]),
+                           my_value=um.board_value(um.get_user(session["user"]), board), total=len(lb), boards=LEADERBOARDS)
+@app.route("/api/leaderboard/<board>")
+@login_required
+def api_leaderboard(board):
+    if board not in LEADERBOARDS: abort(404)
+    lb, uid = um.boards[board], request.args.get("uid", session["user"])
+    limit = min(max(request.args.get('limit', LEADERBOARD_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+    return jsonify({"board": board, "total": len(lb), "top": [{"rank": r, "uid": u, "value": v} for r, u, v in lb.top(limit)],
+                    "me": {"uid": uid, "rank": lb.rank(uid), "value": um.board_value(um.get_user(uid) or {}, board)}})
 @app.errorhandler(404)
 def page_not_found(e):
-    if "user" in session: um.increment_counter(session["user"], "404_count")
+    if "user" in session: ensure_exclusive(); um.increment_counter(session["user"], "404_count")
     return "<h1>404 - Page Not Found</h1><p>お探しのページは見つかりませんでした。</p><a href='/'>トップに戻る</a>", 404
 
 # ───────── 8. Run App ─────────
+# ASGI サーバーで動かす場合: pip install asgiref uvicorn && uvicorn app:asgi_app (PORTAL_ASYNC_WRITES=1 でディスクへの書き込みも待たない)
+# ふつうのリクエストはスレッドプールで1件ずつ別のスレッドに載せ (パスワードのハッシュなど重い処理が他のリクエストを待たせない)、
+# ライブ更新 (/events/...) は認証と購読だけをスレッドで行い、接続している間の配信はイベントループで行う
+if WsgiToAsgiInstance:
+    class _PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+        # asgiref の既定 (thread_sensitive=True) では、すべてのリクエストが1本のスレッドに並んで順に実行される
+        run_wsgi_app = sync_to_async(vars(WsgiToAsgiInstance)["run_wsgi_app"].func, thread_sensitive=False)
+    async def asgi_app(scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/events/"): return await _PooledWsgiToAsgiInstance(app)(scope, receive, send)
+        while (await receive()).get("more_body"): pass  # 本文のない GET
+        adapter = _PooledWsgiToAsgiInstance(app); adapter.scope = scope
+        environ = adapter.build_environ(scope, io.BytesIO()); native = environ["portal.event_stream"] = {}
+        status, body = await sync_to_async(_call_wsgi, thread_sensitive=False)(environ)
+        headers = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in status[1] if k.lower() != "content-length"]
+        await send({"type": "http.response.start", "status": status[0], "headers": headers})
+        if "sub" not in native: await send({"type": "http.response.body", "body": body}); return  # 未ログインのリダイレクトや 404
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            if native["stale"]: await send({"type": "http.response.body", "body": sse_message(("reset", None, {})).encode(), "more_body": True})
+            while True:
+                getter = asyncio.ensure_future(native["sub"].aget(EVENT_KEEPALIVE))
+                await asyncio.wait({getter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done(): getter.cancel(); break
+                await send({"type": "http.response.body", "body": sse_message(getter.result()).encode(), "more_body": True})
+        finally: disconnected.cancel(); bus.unsubscribe(native["sub"])
+    def _call_wsgi(environ):
+        """((ステータス, ヘッダー), 本文) を返す。本文はエラーやリダイレクトのような短いものだけを想定している。"""
+        status = []
+        result = app(environ, lambda s, headers, exc_info=None: status.append((int(s.split(" ", 1)[0]), headers)))
+        try: body = b"".join(result)
+        finally: getattr(result, "close", lambda: None)()
+        return status[-1], body
+    async def _wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect": pass
+else: asgi_app = None
 if __name__ == "__main__":
+    # python app.py export|import : ストアと portal_*.json の相互変換
+    if len(sys.argv) > 1 and sys.argv[1] in ("export", "import"):
+        for ns in STORE_NAMESPACES:
+            store.export_json(ns) if sys.argv[1] == "export" else store.import_json(ns)
+        store.flush()
+        print(f" * {sys.argv[1]} 完了: {', '.join(STORE_NAMESPACES)}"); sys.exit(0)
     port = 5001
     print(f" * 統合ポータルサーバーv6.1起動: http://127.0.0.1:{port}")
     print(f" * 管理者アカウント: admin / admin")
+    # debug のリローダーではこの親プロセスは子プロセスを起動し直すだけなので、ストア (journal のロック) を子へ譲る
+    if os.environ.get("WERKZEUG_RUN_MAIN") != "true": store.close()
     app.run(debug=True, host="0.0.0.0", port=port)
\ No newline at end of file
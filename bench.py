@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+統合大学ポータル 負荷試験・ベンチマーク
+ - python bench.py reserve : 多数のスレッドから /reservations/reserve を叩き、二重予約が0件であることを確認する
+ - python bench.py hash    : パスワードハッシュのコストごとに /login のレイテンシとスループットを測る
+ - python bench.py login-storm : 学期初めのようにログインを集中させ、レート制限・検証キャッシュ込みのレイテンシを測る
+ - python bench.py events : 予約表のライブ更新 (SSE) を数百の購読者で開き、予約・キャンセルの差分が全員に届くまでの遅延を測る
+ - python bench.py serve  : 書き込みと並行して閲覧するときのレイテンシを、同期書き込みと PORTAL_ASYNC_WRITES で比べる (--asgi で ASGI 経由)
+ - データは一時ディレクトリに作るので、既存の portal_*.json / portal.db には触れない
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from urllib.parse import urlencode
+
+def load_app(storage=None):
+    """一時ディレクトリをデータ置き場にして app を読み込む (app はインポート時にデータを読み込むため、環境変数を先に設定する)"""
+    os.environ["PORTAL_DATA_DIR"] = tempfile.mkdtemp(prefix="portal-bench-")
+    if storage: os.environ["PORTAL_STORAGE"] = storage
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    return app
+
+def logged_in_client(portal, uid, pw="bench"):
+    client = portal.app.test_client()
+    client.post("/register", data={"uid": uid, "pw": pw}); client.post("/login", data={"uid": uid, "pw": pw})
+    return client
+
+def percentile(values, p):
+    values = sorted(values); return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+def run_threads(n, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+# ───────── 予約の同時実行テスト ─────────
+def bench_reserve(args):
+    portal = load_app(args.storage)
+    sys.setswitchinterval(1e-6)  # スレッド切り替えを頻発させて check-then-write の競合を起こりやすくする
+    portal.VIOLATION_LIMIT = 10 ** 9  # 予約失敗による違反カウントで途中から利用停止にならないようにする
+    d_str, rooms = "2030-04-01", args.rooms
+    clients = [logged_in_client(portal, f"bench{i}") for i in range(args.threads)]
+    attempts, barrier = [0] * args.threads, threading.Barrier(args.threads)
+    def worker(i):
+        rnd = random.Random(i); barrier.wait()
+        for _ in range(args.requests):
+            start = rnd.randrange(portal.OPEN_TIME, portal.CLOSE_TIME)
+            clients[i].post("/reservations/reserve", data={"campus": "ariake", "room": str(rnd.randint(1, rooms)), "date": d_str, "start": str(start), "dur": "1"})
+            attempts[i] += 1
+    t0 = time.perf_counter(); run_threads(args.threads, worker); elapsed = time.perf_counter() - t0
+    # 成功した予約数 (= 各ユーザーの reservations カウンタ) と、実際に埋まっている枠の数が一致すれば二重予約はない
+    succeeded = sum(portal.um.get_user(f"bench{i}")["reservations"] for i in range(args.threads))
+    booked = sum(len(hours) for hours in portal.rs.get_day_reservations("ariake", d_str).values())
+    users, day = [f"bench{i}" for i in range(args.threads)], portal.rs.get_day_reservations("ariake", d_str)
+    over_quota = [u for u in users if portal.rs.get_user_reservations_for_day(d_str, u) > portal.MAX_HOURS_PER_DAY]
+    # 予約者インデックス上は自分の枠なのに、実際には別人に上書きされている枠
+    lost = [(u, r) for u in users for r in portal.rs.get_user_reservations(u) if day.get(r["room"], {}).get(str(r["hour"])) != u]
+    stored = portal.store.load("reservations").get(d_str, {}).get("ariake", {})
+    print(f"requests={sum(attempts)} threads={args.threads} elapsed={elapsed:.2f}s ({sum(attempts) / elapsed:.0f} req/s)")
+    print(f"succeeded={succeeded} booked_slots={booked} double_bookings={succeeded - booked + len(lost)} over_quota_users={len(over_quota)}")
+    print(f"persisted_matches_memory={stored == day}")
+    return 0 if succeeded == booked and not lost and not over_quota and stored == day else 1
+
+# ───────── パスワードハッシュのコスト別ログイン性能 ─────────
+def bench_hash(args):
+    portal = load_app(args.storage)
+    costs = [int(c) for c in args.costs.split(",")] if args.costs else {"scrypt": [12, 13, 14, 15], "pbkdf2_sha256": [100000, 300000, 600000]}[args.scheme]
+    print(f"scheme={args.scheme} threads={args.threads} logins/thread={args.logins} (現在の設定: {portal.PASSWORD_HASHER} cost={portal.PASSWORD_COST})")
+    # 測りたいのは毎回のハッシュ計算なので、レート制限と検証済みキャッシュは効かないようにする (それらは login-storm で測る)
+    portal.auth.ip_limiter = portal.auth.uid_limiter = portal.RateLimiter(float("inf"), 0)
+    portal.AUTH_VERIFY_TTL = 0
+    failed = 0
+    for cost in costs:
+        portal.PASSWORD_HASHER, portal.PASSWORD_COST = args.scheme, cost
+        uids = [f"hash{cost}-{i}" for i in range(args.threads)]
+        for uid in uids: portal.um.register(uid, "bench")
+        latencies = [[] for _ in uids]
+        def worker(i):
+            nonlocal failed
+            client = portal.app.test_client()
+            for _ in range(args.logins):
+                t0 = time.perf_counter(); r = client.post("/login", data={"uid": uids[i], "pw": "bench"}); latencies[i].append(time.perf_counter() - t0)
+                if r.status_code != 302: failed += 1  # 成功時はトップページへリダイレクトする
+        t0 = time.perf_counter(); run_threads(args.threads, worker); elapsed = time.perf_counter() - t0
+        lat = [x * 1000 for per_thread in latencies for x in per_thread]
+        print(f"cost={cost:<8} p50={percentile(lat, 50):7.1f}ms p95={percentile(lat, 95):7.1f}ms p99={percentile(lat, 99):7.1f}ms throughput={len(lat) / elapsed:7.1f} logins/s")
+    return 1 if failed else 0
+
+# ───────── ログイン集中 ─────────
+def bench_login_storm(args):
+    portal = load_app(args.storage)
+    if args.cost: portal.PASSWORD_COST = args.cost
+    uids = [f"storm{i}" for i in range(args.users)]
+    for uid in uids: portal.um.register(uid, "bench")
+    statuses, latencies, page_latencies = [Counter() for _ in range(args.threads)], [[] for _ in range(args.threads)], [[] for _ in range(args.threads)]
+    def worker(i):
+        rnd, client = random.Random(i), portal.app.test_client()
+        client.environ_base["REMOTE_ADDR"] = f"10.0.{i % args.ips // 256}.{i % args.ips % 256}"  # --ips 個の送信元に分散させる
+        for _ in range(args.logins):
+            uid, pw = rnd.choice(uids), "bench" if rnd.random() >= args.bad else "wrong"
+            t0 = time.perf_counter(); r = client.post("/login", data={"uid": uid, "pw": pw}); latencies[i].append((time.perf_counter() - t0) * 1000)
+            statuses[i][r.status_code] += 1
+            if r.status_code == 302:  # ログインできたらトップページを開く (login_required の確認キャッシュを通る)
+                t0 = time.perf_counter(); client.get("/"); page_latencies[i].append((time.perf_counter() - t0) * 1000)
+    t0 = time.perf_counter(); run_threads(args.threads, worker); elapsed = time.perf_counter() - t0
+    lat, page = [x for l in latencies for x in l], [x for l in page_latencies for x in l]
+    print(f"logins={len(lat)} threads={args.threads} users={args.users} ips={args.ips} elapsed={elapsed:.2f}s ({len(lat) / elapsed:.1f} logins/s)")
+    print("status: " + " ".join(f"{code}={n}" for code, n in sorted(sum(statuses, Counter()).items())) + " (302=成功, 200=失敗, 429=レート制限)")
+    print(f"client /login p50={percentile(lat, 50):.1f}ms p95={percentile(lat, 95):.1f}ms p99={percentile(lat, 99):.1f}ms")
+    print(f"client /      p50={percentile(page, 50):.1f}ms p95={percentile(page, 95):.1f}ms p99={percentile(page, 99):.1f}ms")
+    for outcome, m in portal.auth.metrics().items(): print(f"server {outcome:<8} count={m['count']:<6} p50={m['p50_ms']}ms p95={m['p95_ms']}ms p99={m['p99_ms']}ms")
+    return 0
+
+# ───────── ライブ更新 (SSE) の配信 ─────────
+def bench_events(args):
+    portal = load_app(args.storage)
+    portal.EVENT_KEEPALIVE = 0.5  # イベントが届かなくても購読者が締め切りに気づけるよう、頻繁にコメントを送らせる
+    campus, d_str = "ariake", "2030-04-01"
+    viewer, writer = logged_in_client(portal, "viewer"), logged_in_client(portal, "writer")
+    url = f"/events/reservations/{campus}/{d_str}?since={portal.event_version(portal.rs.version(campus, d_str))}"
+    sent, received, resets = [0.0] * args.events, [[] for _ in range(args.subscribers)], Counter()
+    barrier = threading.Barrier(args.subscribers + 1)
+    def subscriber(i):
+        r = viewer.get(url, buffered=False); barrier.wait()  # ビューが返った時点で購読済み
+        deadline = time.perf_counter() + args.timeout
+        try:
+            for chunk in r.response:
+                if chunk.startswith(b"event: reset") or b"\nevent: reset" in chunk: resets[i] += 1
+                elif b"event: slots" in chunk: received[i].append((time.perf_counter() - sent[len(received[i])]) * 1000)
+                if len(received[i]) == args.events or time.perf_counter() > deadline: break
+        finally: r.close()  # ジェネレータを閉じて購読を解除させる
+    threads = [threading.Thread(target=subscriber, args=(i,)) for i in range(args.subscribers)]
+    for t in threads: t.start()
+    barrier.wait(); print(f"subscribers={portal.bus.subscribers()} events={args.events}")
+    publish = []
+    t0 = time.perf_counter()
+    for k in range(args.events):
+        hour = portal.OPEN_TIME + k // 2 % (portal.CLOSE_TIME - portal.OPEN_TIME)
+        sent[k] = time.perf_counter()
+        if k % 2 == 0: writer.post("/reservations/reserve", data={"campus": campus, "room": "1", "date": d_str, "start": str(hour), "dur": "1"})
+        else: writer.post("/reservations/cancel", data={"campus": campus, "room": "1", "date": d_str, "hour": str(hour)})
+        publish.append((time.perf_counter() - sent[k]) * 1000)
+        if args.interval: time.sleep(args.interval)
+    for t in threads: t.join()
+    elapsed, lat = time.perf_counter() - t0, [x for l in received for x in l]
+    delivered, expected = len(lat), args.subscribers * args.events
+    print(f"delivered={delivered}/{expected} resets={sum(resets.values())} elapsed={elapsed:.2f}s ({delivered / elapsed:.0f} deliveries/s)")
+    print(f"delivery latency p50={percentile(lat, 50):.1f}ms p95={percentile(lat, 95):.1f}ms p99={percentile(lat, 99):.1f}ms max={max(lat, default=0):.1f}ms")
+    print(f"reserve/cancel   p50={percentile(publish, 50):.1f}ms p99={percentile(publish, 99):.1f}ms (購読者への配信込み)")
+    print(f"subscribers_after_close={portal.bus.subscribers()}")
+    return 0 if delivered == expected and not portal.bus.subscribers() else 1
+
+# ───────── 同期書き込みと非同期書き込みのレイテンシ比較 ─────────
+def asgi_request(asgi_app, method, path, cookie, form=None):
+    """ASGI アプリを直接呼び出し、(ステータス, 秒) を返す"""
+    body = urlencode(form).encode() if form else b""
+    headers = [(b"cookie", f"session={cookie}".encode()), (b"content-type", b"application/x-www-form-urlencoded"), (b"content-length", str(len(body)).encode())]
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+             "query_string": b"", "root_path": "", "headers": headers, "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80)}
+    sent, status = False, []
+    async def receive():
+        nonlocal sent
+        if sent: await asyncio.Event().wait()  # 応答後の切断待ちには何も返さない
+        sent = True; return {"type": "http.request", "body": body, "more_body": False}
+    async def send(message):
+        if message["type"] == "http.response.start": status.append(message["status"])
+    async def run():
+        t0 = time.perf_counter(); await asgi_app(scope, receive, send); return status[0], time.perf_counter() - t0
+    return run()
+def bench_serve(args):
+    portal = load_app(args.storage)
+    if args.asgi and portal.asgi_app is None: print("--asgi には asgiref が必要です ('pip install asgiref')"); return 1
+    write_batch = portal.store._write_batch
+    def slow_write_batch(items): time.sleep(args.disk_delay / 1000); write_batch(items)  # 遅いディスク (fsync やネットワークストレージ) を模す
+    portal.store._write_batch = slow_write_batch
+    readers = [logged_in_client(portal, f"reader{i}") for i in range(args.readers)]
+    writers = [logged_in_client(portal, f"writer{i}") for i in range(args.writers)]
+    # 読む側のページが書き込みで重くならないよう、回答は別の質問に付ける
+    for title in ("閲覧用の質問", "回答用の質問"): readers[0].post("/ask", data={"title": title, "content": "本文", "tags": "bench"})
+    read_qid, write_qid = sorted(portal.pm.posts, key=lambda q: portal.pm.posts[q]["title"] != "閲覧用の質問")
+    portal.store.flush()
+    def read_req(i, k): return "GET", f"/question/{read_qid}" if k % 2 else "/schedule", None
+    def write_req(i, k):
+        if k % 2: return "POST", f"/answer/{write_qid}", {"content": f"回答{k}"}
+        return "POST", "/schedule/add", {"date": f"2030-05-{k % 28 + 1:02d}", "time": "10:00", "title": f"予定{k}"}
+    def run_threads_mode():
+        lat = {"read": [], "write": []}
+        def worker(i):
+            client, kind, make = (readers[i], "read", read_req) if i < args.readers else (writers[i - args.readers], "write", write_req)
+            for k in range(args.requests):
+                method, path, form = make(i, k)
+                t0 = time.perf_counter(); r = client.open(path, method=method, data=form); lat[kind].append((time.perf_counter() - t0) * 1000)
+                if r.status_code >= 400: raise RuntimeError(f"{method} {path} -> {r.status_code}")
+        run_threads(args.readers + args.writers, worker); return lat
+    def run_asgi_mode():
+        lat = {"read": [], "write": []}
+        cookies = [c.get_cookie("session").value for c in readers + writers]
+        async def worker(i):
+            kind, make = ("read", read_req) if i < args.readers else ("write", write_req)
+            for k in range(args.requests):
+                method, path, form = make(i, k)
+                status, elapsed = await asgi_request(portal.asgi_app, method, path, cookies[i], form); lat[kind].append(elapsed * 1000)
+                if status >= 400: raise RuntimeError(f"{method} {path} -> {status}")
+        async def main(): await asyncio.gather(*(worker(i) for i in range(args.readers + args.writers)))
+        asyncio.run(main()); return lat
+    print(f"transport={'asgi' if args.asgi else 'threads'} readers={args.readers} writers={args.writers} requests={args.requests} disk_delay={args.disk_delay}ms storage={portal.STORAGE_BACKEND}")
+    for mode in ("sync", "async"):
+        if mode == "async": portal.store.start_writer()
+        t0 = time.perf_counter(); lat = run_asgi_mode() if args.asgi else run_threads_mode(); portal.store.flush(); elapsed = time.perf_counter() - t0
+        for kind in ("read", "write"):
+            print(f"{mode:<5} {kind:<5} p50={percentile(lat[kind], 50):7.1f}ms p99={percentile(lat[kind], 99):7.1f}ms")
+        print(f"{mode:<5} total {elapsed:.2f}s")
+    portal.store.stop_writer()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage", choices=["sqlite", "journal", "json"], help="PORTAL_STORAGE を上書きする")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("reserve", help="予約の同時実行で二重予約が起きないことを確認する")
+    p.add_argument("--threads", type=int, default=32); p.add_argument("--requests", type=int, default=50)
+    p.add_argument("--rooms", type=int, default=4, help="競合を増やすため対象教室を絞る")
+    p.set_defaults(func=bench_reserve)
+    p = sub.add_parser("hash", help="パスワードハッシュのコストごとにログインのレイテンシとスループットを測る")
+    p.add_argument("--scheme", choices=["scrypt", "pbkdf2_sha256"], default="scrypt")
+    p.add_argument("--costs", help="カンマ区切りのコスト (scrypt は log2 N、pbkdf2_sha256 は反復回数)")
+    p.add_argument("--threads", type=int, default=8); p.add_argument("--logins", type=int, default=20)
+    p.set_defaults(func=bench_hash)
+    p = sub.add_parser("login-storm", help="ログインを集中させ、レート制限と検証キャッシュ込みの認証レイテンシを測る")
+    p.add_argument("--threads", type=int, default=32); p.add_argument("--logins", type=int, default=20)
+    p.add_argument("--users", type=int, default=200); p.add_argument("--ips", type=int, default=32, help="送信元 IP の数 (1 にすると学内 NAT 相当)")
+    p.add_argument("--bad", type=float, default=0.05, help="パスワードを間違える割合")
+    p.add_argument("--cost", type=int, help="PORTAL_PASSWORD_COST を上書きする")
+    p.set_defaults(func=bench_login_storm)
+    p = sub.add_parser("events", help="数百の SSE 購読者に予約の差分を配り、全員に届くまでの遅延を測る")
+    p.add_argument("--subscribers", type=int, default=300); p.add_argument("--events", type=int, default=50)
+    p.add_argument("--interval", type=float, default=0.01, help="予約・キャンセルの間隔 (秒)")
+    p.add_argument("--timeout", type=float, default=60, help="購読者ごとの締め切り (秒)")
+    p.set_defaults(func=bench_events)
+    p = sub.add_parser("serve", help="書き込みと並行した閲覧のレイテンシを、同期書き込みと非同期書き込み (PORTAL_ASYNC_WRITES) で比べる")
+    p.add_argument("--readers", type=int, default=8); p.add_argument("--writers", type=int, default=4); p.add_argument("--requests", type=int, default=50)
+    p.add_argument("--disk-delay", type=float, default=20, help="1回の書き込みに足す遅延 (ミリ秒)")
+    p.add_argument("--asgi", action="store_true", help="asgi_app 経由で呼ぶ (ハンドラはスレッドプールで動く)")
+    p.set_defaults(func=bench_serve)
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()